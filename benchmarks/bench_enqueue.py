@@ -0,0 +1,49 @@
+"""
+Enqueue throughput: BeanstalkClient.call in a loop versus call_many.
+
+    python benchmarks/bench_enqueue.py [job count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from fake_beanstalkd import FakeBeanstalkdServer
+from django_beanstalkd import BeanstalkClient
+from django_beanstalkd.connection import close_pools
+
+
+def bench(label, count, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print "%-12s %8d jobs  %8.3fs  %10.0f jobs/s" % (label, count, elapsed, count / elapsed)
+
+
+def main(count):
+    server = FakeBeanstalkdServer()
+    port = server.start()
+    client = BeanstalkClient(server='127.0.0.1', port=port)
+    args = [str(i) for i in range(count)]
+
+    def call_loop():
+        for arg in args:
+            client.call('bench.enqueue', arg)
+
+    def call_many():
+        client.call_many('bench.enqueue', args)
+
+    bench('call', count, call_loop)
+    bench('call_many', count, call_many)
+
+    close_pools()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
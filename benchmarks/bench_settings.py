@@ -0,0 +1,23 @@
+"""
+Settings of the benchmark suite and the workers it starts, which find the
+fake beanstalkd and the SQLite database through the environment.
+"""
+import os
+
+SECRET_KEY = 'benchmarks'
+
+INSTALLED_APPS = [
+    'django_beanstalkd',
+    'benchapp',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCH_DATABASE', ':memory:'),
+    },
+}
+
+BEANSTALK_SERVER = '127.0.0.1:%s' % os.environ.get('BENCH_BEANSTALKD_PORT', '11300')
+
+BEANSTALK_JOBDATA_DELETE_INTERVAL = 1
@@ -0,0 +1,58 @@
+"""
+Per-job worker overhead: finding the tube of a reserved job with a stats-job
+round trip versus reading it from the job envelope.
+
+    python benchmarks/bench_worker.py [job count]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from fake_beanstalkd import FakeBeanstalkdServer
+from django_beanstalkd import BeanstalkClient, connect_beanstalkd
+from django_beanstalkd.connection import close_pools
+from django_beanstalkd.envelope import job_tube
+
+TUBE = 'bench.worker'
+
+
+def run_worker(port, count, get_tube):
+    beanstalk = connect_beanstalkd('127.0.0.1', port)
+    beanstalk.watch(TUBE)
+    beanstalk.ignore('default')
+    start = time.time()
+    for i in range(count):
+        job = beanstalk.reserve()
+        tube = get_tube(job)
+        assert tube == TUBE
+        job.delete()
+    elapsed = time.time() - start
+    beanstalk.close()
+    return elapsed
+
+
+def bench(label, port, count, envelope, get_tube):
+    settings.BEANSTALK_JOB_ENVELOPE = envelope
+    client = BeanstalkClient(server='127.0.0.1', port=port)
+    client.call_many(TUBE, [str(i) for i in range(count)])
+    close_pools()
+    elapsed = run_worker(port, count, get_tube)
+    print "%-10s %8d jobs  %8.3fs  %8.1f us/job" % (label, count, elapsed, elapsed / count * 1e6)
+
+
+def main(count):
+    server = FakeBeanstalkdServer()
+    port = server.start()
+    bench('stats-job', port, count, False, lambda job: job.stats()['tube'])
+    bench('envelope', port, count, True, lambda job: job_tube(job)[0])
+    server.stop()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
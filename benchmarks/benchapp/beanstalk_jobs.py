@@ -0,0 +1,46 @@
+"""
+Jobs run by the benchmark suite. io waits BENCH_JOB_SLEEP milliseconds (2)
+like a job talking to another service; the flaky jobs always ask for a retry,
+each with a different retry policy.
+"""
+import os
+import random
+import time
+
+from django_beanstalkd import beanstalk_job, backoff_beanstalk_job, data_beanstalk_job
+from django_beanstalkd.errors import BeanstalkRetryError
+from django_beanstalkd.retry import RetryPolicy
+
+
+JOB_SLEEP = float(os.environ.get('BENCH_JOB_SLEEP', 2)) / 1000
+
+
+@beanstalk_job(uses_db=False)
+def noop(arg):
+    pass
+
+
+@beanstalk_job(uses_db=False)
+def io(arg):
+    time.sleep(JOB_SLEEP)
+
+
+@data_beanstalk_job()
+def record(data):
+    return len(data.data_dict)
+
+
+@backoff_beanstalk_job(max_retries=10, retry_policy=RetryPolicy(jitter=False), uses_db=False)
+def flaky_fixed(data):
+    raise BeanstalkRetryError("dependency down")
+
+
+@backoff_beanstalk_job(max_retries=10, retry_policy=RetryPolicy(random=random.Random(0)), uses_db=False)
+def flaky_jittered(data):
+    raise BeanstalkRetryError("dependency down")
+
+
+@backoff_beanstalk_job(max_retries=10, retry_policy=RetryPolicy('decorrelated', random=random.Random(0)),
+                       uses_db=False)
+def flaky_decorrelated(data):
+    raise BeanstalkRetryError("dependency down")
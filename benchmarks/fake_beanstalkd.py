@@ -0,0 +1,490 @@
+"""
+A small in-memory beanstalkd stand-in for benchmarks.
+
+It speaks the parts of the beanstalkd protocol used by django_beanstalkd:
+use, put, watch, ignore, reserve, reserve-with-timeout, delete, release,
+bury, touch, kick, kick-job, peek, peek-ready, peek-delayed, peek-buried,
+pause-tube, list-tubes, stats, stats-tube and stats-job. Priorities, delays,
+pauses and burying behave like in beanstalkd, and the jobs reserved by a
+connection are released when it closes. Jobs are kept in memory and their
+TTR is never enforced.
+
+Run it in-process:
+
+    server = FakeBeanstalkdServer()
+    port = server.start()
+    ...
+    server.stop()
+
+or on a local port with "python benchmarks/fake_beanstalkd.py 11300".
+"""
+import collections
+import heapq
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+
+DEFAULT_PRIORITY = 2 ** 31
+
+
+class Job(object):
+    __slots__ = ('jid', 'tube', 'body', 'pri', 'ttr', 'state', 'created', 'ready_at', 'reserves', 'releases', 'buries',
+                 'kicks')
+
+    def __init__(self, jid, tube, body, pri, ttr):
+        self.jid = jid
+        self.tube = tube
+        self.body = body
+        self.pri = pri
+        self.ttr = ttr
+        self.state = 'ready'
+        self.created = time.time()
+        self.ready_at = 0
+        self.reserves = self.releases = self.buries = self.kicks = 0
+
+
+class FakeBeanstalkd(object):
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.next_id = 1
+        self.jobs = {}  # jid -> Job
+        # heaps with lazy deletion: entries whose job changed state are skipped
+        self.ready = collections.defaultdict(list)  # tube -> [(pri, jid)]
+        self.delayed = []  # [(ready_at, jid)]
+        self.buried = collections.defaultdict(collections.deque)  # tube -> jids
+        self.paused = {}  # tube -> (until, delay)
+        self.tubes = set(['default'])
+        self.counts = collections.defaultdict(collections.Counter)  # tube -> state -> jobs
+        self.totals = collections.defaultdict(collections.Counter)  # tube -> 'jobs' and 'deletes' so far
+        self.closed = False
+        self.total_jobs = 0
+
+    def _set_state(self, job, state):
+        counts = self.counts[job.tube]
+        counts[job.state] -= 1
+        counts[state] += 1
+        job.state = state
+
+    def _make_ready(self, job):
+        self._set_state(job, 'ready')
+        heapq.heappush(self.ready[job.tube], (job.pri, job.jid))
+        self.lock.notify_all()
+
+    def _promote(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            ready_at, jid = heapq.heappop(self.delayed)
+            job = self.jobs.get(jid)
+            if job is not None and job.state == 'delayed' and job.ready_at == ready_at:
+                self._make_ready(job)
+
+    def _delay(self, job, delay):
+        self._set_state(job, 'delayed')
+        job.ready_at = time.time() + delay
+        heapq.heappush(self.delayed, (job.ready_at, job.jid))
+
+    def _peek_ready(self, tube):
+        heap = self.ready[tube]
+        while heap:
+            pri, jid = heap[0]
+            job = self.jobs.get(jid)
+            if job is not None and job.state == 'ready' and job.pri == pri:
+                return job
+            heapq.heappop(heap)
+        return None
+
+    def _is_paused(self, tube, now):
+        until = self.paused.get(tube)
+        if until is None:
+            return False
+        if until[0] <= now:
+            del self.paused[tube]
+            return False
+        return True
+
+    def put(self, tube, body, pri=DEFAULT_PRIORITY, delay=0, ttr=120):
+        with self.lock:
+            jid = self.next_id
+            self.next_id += 1
+            self.total_jobs += 1
+            self.totals[tube]['jobs'] += 1
+            self.tubes.add(tube)
+            job = self.jobs[jid] = Job(jid, tube, body, pri, ttr)
+            self.counts[tube]['ready'] += 1
+            if delay > 0:
+                self._delay(job, delay)
+                self.lock.notify_all()
+            else:
+                self._make_ready(job)
+            return jid
+
+    def reserve(self, tubes, timeout=None):
+        """Returns (jid, body), or None if the timeout passed or the server is stopping"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while not self.closed:
+                now = time.time()
+                self._promote(now)
+                best = None
+                for tube in tubes:
+                    if self._is_paused(tube, now):
+                        continue
+                    job = self._peek_ready(tube)
+                    if job is not None and (best is None or (job.pri, job.jid) < (best.pri, best.jid)):
+                        best = job
+                if best is not None:
+                    heapq.heappop(self.ready[best.tube])
+                    self._set_state(best, 'reserved')
+                    best.reserves += 1
+                    return best.jid, best.body
+                wakeups = [until for until, delay in self.paused.values()]
+                if self.delayed:
+                    wakeups.append(self.delayed[0][0])
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wakeups.append(deadline)
+                self.lock.wait(max(0, min(wakeups) - now) if wakeups else None)
+            return None
+
+    def delete(self, jid):
+        with self.lock:
+            job = self.jobs.pop(jid, None)
+            if job is None:
+                return False
+            if job.state == 'buried':
+                self.buried[job.tube].remove(jid)
+            self.counts[job.tube][job.state] -= 1
+            self.totals[job.tube]['deletes'] += 1
+            return True
+
+    def release(self, jid, pri=None, delay=0):
+        with self.lock:
+            job = self.jobs.get(jid)
+            if job is None or job.state != 'reserved':
+                return False
+            job.releases += 1
+            if pri is not None:
+                job.pri = pri
+            if delay > 0:
+                self._delay(job, delay)
+                self.lock.notify_all()
+            else:
+                self._make_ready(job)
+            return True
+
+    def bury(self, jid, pri=None):
+        with self.lock:
+            job = self.jobs.get(jid)
+            if job is None or job.state != 'reserved':
+                return False
+            job.buries += 1
+            if pri is not None:
+                job.pri = pri
+            self._set_state(job, 'buried')
+            self.buried[job.tube].append(jid)
+            return True
+
+    def touch(self, jid):
+        with self.lock:
+            job = self.jobs.get(jid)
+            return job is not None and job.state == 'reserved'
+
+    def kick(self, tube, bound):
+        """Kick up to bound buried jobs of tube, or delayed ones if none are buried"""
+        with self.lock:
+            kicked = 0
+            buried = self.buried[tube]
+            if buried:
+                while buried and kicked < bound:
+                    job = self.jobs[buried.popleft()]
+                    job.kicks += 1
+                    self._make_ready(job)
+                    kicked += 1
+                return kicked
+            for job in sorted(self.jobs.values(), key=lambda job: job.ready_at):
+                if kicked == bound:
+                    break
+                if job.tube == tube and job.state == 'delayed':
+                    job.kicks += 1
+                    self._make_ready(job)
+                    kicked += 1
+            return kicked
+
+    def kick_job(self, jid):
+        with self.lock:
+            job = self.jobs.get(jid)
+            if job is None or job.state not in ('buried', 'delayed'):
+                return False
+            if job.state == 'buried':
+                self.buried[job.tube].remove(jid)
+            job.kicks += 1
+            self._make_ready(job)
+            return True
+
+    def peek(self, jid):
+        with self.lock:
+            job = self.jobs.get(jid)
+            return None if job is None else (job.jid, job.body)
+
+    def peek_state(self, tube, state):
+        with self.lock:
+            self._promote(time.time())
+            if state == 'ready':
+                job = self._peek_ready(tube)
+            elif state == 'buried':
+                job = self.jobs[self.buried[tube][0]] if self.buried[tube] else None
+            else:
+                delayed = [job for job in self.jobs.values() if job.tube == tube and job.state == 'delayed']
+                job = min(delayed, key=lambda job: job.ready_at) if delayed else None
+            return None if job is None else (job.jid, job.body)
+
+    def pause(self, tube, delay):
+        with self.lock:
+            if tube not in self.tubes:
+                return False
+            self.paused[tube] = (time.time() + delay, delay)
+            self.lock.notify_all()
+            return True
+
+    def stop(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def stats_job(self, jid):
+        with self.lock:
+            job = self.jobs.get(jid)
+            if job is None:
+                return None
+            return {
+                'id': jid,
+                'tube': job.tube,
+                'state': job.state,
+                'pri': job.pri,
+                'age': int(time.time() - job.created),
+                'delay': max(0, int(job.ready_at - time.time())) if job.state == 'delayed' else 0,
+                'ttr': job.ttr,
+                'time-left': job.ttr if job.state == 'reserved' else 0,
+                'reserves': job.reserves,
+                'releases': job.releases,
+                'buries': job.buries,
+                'kicks': job.kicks,
+            }
+
+    def _counts(self, tube=None):
+        self._promote(time.time())
+        if tube is not None:
+            return self.counts[tube]
+        return sum(self.counts.values(), collections.Counter())
+
+    def stats_tube(self, tube, watching=0):
+        with self.lock:
+            if tube not in self.tubes:
+                return None
+            counts = self._counts(tube)
+            paused = self._is_paused(tube, time.time())
+            until, delay = self.paused.get(tube, (0, 0))
+            return {
+                'name': tube,
+                'current-jobs-urgent': 0,
+                'current-jobs-ready': counts['ready'],
+                'current-jobs-reserved': counts['reserved'],
+                'current-jobs-delayed': counts['delayed'],
+                'current-jobs-buried': counts['buried'],
+                'total-jobs': self.totals[tube]['jobs'],
+                'current-watching': watching,
+                'cmd-delete': self.totals[tube]['deletes'],
+                'pause': delay if paused else 0,
+                'pause-time-left': max(0, int(until - time.time())) if paused else 0,
+            }
+
+    def stats(self):
+        with self.lock:
+            counts = self._counts()
+            return {
+                'current-jobs-ready': counts['ready'],
+                'current-jobs-reserved': counts['reserved'],
+                'current-jobs-delayed': counts['delayed'],
+                'current-jobs-buried': counts['buried'],
+                'current-tubes': len(self.tubes),
+                'total-jobs': self.total_jobs,
+            }
+
+
+class FakeBeanstalkdHandler(SocketServer.StreamRequestHandler):
+    wbufsize = -1
+
+    def setup(self):
+        # reply to pipelined commands right away instead of waiting for acks
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+        self.using = 'default'
+        self.watching = ['default']
+        self.reserved = set()
+        self.server.connections.add(self)
+
+    def finish(self):
+        # like beanstalkd, put back the jobs of a connection that went away
+        for jid in self.reserved:
+            self.server.backend.release(jid)
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+        self.server.connections.discard(self)
+
+    def reply(self, line, body=None):
+        if body is None:
+            self.wfile.write('%s\r\n' % line)
+        else:
+            self.wfile.write('%s %d\r\n%s\r\n' % (line, len(body), body))
+
+    def reply_job(self, status, job):
+        if job is None:
+            self.reply('NOT_FOUND')
+        else:
+            self.reply('%s %d' % (status, job[0]), job[1])
+
+    def reply_stats(self, stats):
+        if stats is None:
+            self.reply('NOT_FOUND')
+        else:
+            self.reply('OK', '---\n' + ''.join('%s: %s\n' % item for item in stats.items()))
+
+    def pending_input(self):
+        # socket._fileobject keeps already received data in _rbuf
+        return self.rfile._rbuf.tell() > 0
+
+    def handle(self):
+        backend = self.server.backend
+        while True:
+            # like beanstalkd, answer a pipelined batch with as few writes as possible
+            if not self.pending_input():
+                self.wfile.flush()
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command, args = parts[0], parts[1:]
+
+            if command == 'quit':
+                return
+            elif command == 'use':
+                self.using = args[0]
+                backend.tubes.add(self.using)
+                self.reply('USING %s' % self.using)
+            elif command == 'put':
+                body = self.rfile.read(int(args[3]))
+                self.rfile.read(2)
+                jid = backend.put(self.using, body, int(args[0]), int(args[1]), int(args[2]))
+                self.reply('INSERTED %d' % jid)
+            elif command == 'watch':
+                if args[0] not in self.watching:
+                    self.watching.append(args[0])
+                    backend.tubes.add(args[0])
+                self.reply('WATCHING %d' % len(self.watching))
+            elif command == 'ignore':
+                if self.watching == [args[0]]:
+                    self.reply('NOT_IGNORED')
+                    continue
+                if args[0] in self.watching:
+                    self.watching.remove(args[0])
+                self.reply('WATCHING %d' % len(self.watching))
+            elif command in ('reserve', 'reserve-with-timeout'):
+                timeout = int(args[0]) if args else None
+                self.wfile.flush()
+                job = backend.reserve(self.watching, timeout)
+                if job is None:
+                    if backend.closed:
+                        return
+                    self.reply('TIMED_OUT')
+                else:
+                    self.reserved.add(job[0])
+                    self.reply('RESERVED %d' % job[0], job[1])
+            elif command == 'delete':
+                self.reserved.discard(int(args[0]))
+                self.reply('DELETED' if backend.delete(int(args[0])) else 'NOT_FOUND')
+            elif command == 'release':
+                released = backend.release(int(args[0]), int(args[1]), int(args[2]))
+                self.reserved.discard(int(args[0]))
+                self.reply('RELEASED' if released else 'NOT_FOUND')
+            elif command == 'bury':
+                buried = backend.bury(int(args[0]), int(args[1]))
+                self.reserved.discard(int(args[0]))
+                self.reply('BURIED' if buried else 'NOT_FOUND')
+            elif command == 'touch':
+                self.reply('TOUCHED' if backend.touch(int(args[0])) else 'NOT_FOUND')
+            elif command == 'kick':
+                self.reply('KICKED %d' % backend.kick(self.using, int(args[0])))
+            elif command == 'kick-job':
+                self.reply('KICKED' if backend.kick_job(int(args[0])) else 'NOT_FOUND')
+            elif command == 'peek':
+                self.reply_job('FOUND', backend.peek(int(args[0])))
+            elif command in ('peek-ready', 'peek-delayed', 'peek-buried'):
+                self.reply_job('FOUND', backend.peek_state(self.using, command[5:]))
+            elif command == 'pause-tube':
+                self.reply('PAUSED' if backend.pause(args[0], int(args[1])) else 'NOT_FOUND')
+            elif command == 'list-tubes':
+                self.reply('OK', '---\n' + ''.join('- %s\n' % tube for tube in sorted(backend.tubes)))
+            elif command == 'stats':
+                self.reply_stats(backend.stats())
+            elif command == 'stats-tube':
+                watching = len([conn for conn in list(self.server.connections) if args[0] in conn.watching])
+                self.reply_stats(backend.stats_tube(args[0], watching))
+            elif command == 'stats-job':
+                self.reply_stats(backend.stats_job(int(args[0])))
+            else:
+                self.reply('UNKNOWN_COMMAND')
+
+
+class FakeBeanstalkdServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.TCPServer.__init__(self, (host, port), FakeBeanstalkdHandler)
+        self.backend = FakeBeanstalkd()
+        self.connections = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serve from a daemon thread, returning the port listened on"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop serving and disconnect all clients"""
+        self.shutdown()
+        self.server_close()
+        self.backend.stop()
+        for conn in list(self.connections):
+            try:
+                conn.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # let the handler threads finish before the interpreter goes away
+        deadline = time.time() + 1
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+
+    def handle_error(self, request, client_address):
+        # clients disconnecting mid-command are expected, anything else is a bug
+        if not isinstance(sys.exc_info()[1], socket.error):
+            SocketServer.TCPServer.handle_error(self, request, client_address)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11300
+    server = FakeBeanstalkdServer(port=port)
+    print "Fake beanstalkd listening on 127.0.0.1:%d" % server.port
+    server.serve_forever()
@@ -0,0 +1,285 @@
+"""
+End-to-end benchmarks against the in-process fake beanstalkd:
+
+    enqueue        BeanstalkClient.call, call_many and call_batched, and
+                   AsyncBeanstalkClient.call when trollius is there
+    worker         jobs per second of beanstalk_worker with each -w count
+    retry_storm    how many retries of jobs that failed together come back
+                   in the same second, for each retry policy
+    data           DataBeanstalkClient.call_many and the worker processing
+                   the jobs, with JobData in SQLite
+
+    python benchmarks/suite.py [--jobs 5000] [--workers 1,2,4] [--only worker,data]
+                               [--output results.json] [--baseline previous.json]
+
+The results are written to a JSON file; with --baseline, the change of each
+rate against an earlier run is printed as well.
+"""
+from optparse import OptionParser
+import collections
+import datetime
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+# the workers started by the suite share the database and the fake server
+TEMP_DIR = tempfile.mkdtemp(prefix='beanstalk-bench-')
+os.environ['DJANGO_SETTINGS_MODULE'] = 'bench_settings'
+os.environ['BENCH_DATABASE'] = os.path.join(TEMP_DIR, 'bench.sqlite3')
+
+from fake_beanstalkd import FakeBeanstalkdServer
+
+server = FakeBeanstalkdServer()
+os.environ['BENCH_BEANSTALKD_PORT'] = str(server.start())
+
+from django.core.management import call_command
+from django_beanstalkd import BeanstalkClient, DataBeanstalkClient
+from django_beanstalkd.connection import close_pools
+from django_beanstalkd.models import JobData
+
+SCENARIOS = ('enqueue', 'worker', 'retry_storm', 'data')
+
+
+def rate(count, elapsed):
+    return round(count / elapsed, 1) if elapsed else None
+
+
+def report(label, count, elapsed):
+    print "%-28s %8d jobs  %8.3fs  %10.0f jobs/s" % (label, count, elapsed, count / elapsed)
+    return {'jobs': count, 'seconds': round(elapsed, 4), 'jobs_per_s': rate(count, elapsed)}
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def wait_for(condition, timeout, interval=0.005):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("Timed out after %ss" % timeout)
+        time.sleep(interval)
+
+
+def tube_stats(tube):
+    return server.backend.stats_tube(tube) or collections.defaultdict(int)
+
+
+def drained(tube):
+    stats = tube_stats(tube)
+    return not stats['current-jobs-ready'] and not stats['current-jobs-reserved']
+
+
+def watching(tube):
+    return len([conn for conn in list(server.connections) if tube in conn.watching])
+
+
+class Worker(object):
+    """beanstalk_worker running in a subprocess"""
+
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'manage.py'), 'beanstalk_worker', '-l', 'warning'] + self.args,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path[:2])))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait()
+
+
+def bench_enqueue(options):
+    count = options.jobs
+    client = BeanstalkClient()
+    args = [str(i) for i in range(count)]
+    results = {}
+
+    def call_loop():
+        for arg in args:
+            client.call('benchapp.noop', arg)
+
+    def call_batched():
+        for arg in args:
+            client.call_batched('benchapp.noop', arg)
+        from django_beanstalkd import batching
+        batching.flush()
+
+    results['call'] = report('enqueue call', count, timed(call_loop))
+    results['call_many'] = report('enqueue call_many', count, timed(lambda: client.call_many('benchapp.noop', args)))
+    results['call_batched'] = report('enqueue call_batched', count, timed(call_batched))
+
+    try:
+        from django_beanstalkd import aio
+        asyncio = aio._asyncio()
+    except Exception:
+        print "enqueue async: skipped, needs trollius"
+    else:
+        loop = asyncio.new_event_loop()
+        async_client = aio.AsyncBeanstalkClient(loop=loop)
+
+        def gather():
+            loop.run_until_complete(asyncio.gather(
+                *[async_client.call('benchapp.noop', arg) for arg in args], loop=loop))
+        results['async_call'] = report('enqueue async call', count, timed(gather))
+        aio.close_pools()
+        loop.close()
+
+    close_pools()
+    return results
+
+
+def bench_worker(options):
+    count = options.jobs
+    client = BeanstalkClient()
+    args = [str(i) for i in range(count)]
+    results = {}
+    for executor in options.executors:
+        for workers in options.workers:
+            with Worker(['-w', str(workers), '-e', executor]):
+                wait_for(lambda: watching('benchapp.io') >= workers, 30)
+                start = time.time()
+                client.call_many('benchapp.io', args)
+                wait_for(lambda: drained('benchapp.io'), 600)
+                elapsed = time.time() - start
+            results['%s_w%d' % (executor, workers)] = report(
+                'worker %s -w %d' % (executor, workers), count, elapsed)
+    close_pools()
+    return results
+
+
+def bench_retry_storm(options):
+    """
+    count jobs failing at the same time on their attempt-th try, as when a
+    service they depend on goes down: when do their retries come back?
+    """
+    from benchapp import beanstalk_jobs
+
+    count = options.jobs
+    attempt = options.attempt
+    results = {}
+    for name in ('flaky_fixed', 'flaky_jittered', 'flaky_decorrelated'):
+        job = getattr(beanstalk_jobs, name)
+        tube = job.get_job_name()
+        body = json.dumps({'__attempt': attempt, '__delay': 2 ** (attempt - 1)})
+        start = time.time()
+        for i in range(count):
+            job(body)
+        elapsed = time.time() - start
+
+        seconds = collections.Counter(
+            int(j.ready_at - start) for j in server.backend.jobs.values() if j.tube == tube)
+        result = report('retry storm %s' % name[6:], count, elapsed)
+        result.update({
+            'peak_per_second': max(seconds.values()),
+            'distinct_seconds': len(seconds),
+            'last_retry_after': max(seconds),
+        })
+        print "%-28s peak %d retries in one second, spread over %d seconds" % (
+            '', result['peak_per_second'], result['distinct_seconds'])
+        results[name[6:]] = result
+    close_pools()
+    return results
+
+
+def bench_data(options):
+    count = options.jobs
+    client = DataBeanstalkClient()
+    data_dicts = [{'id': i, 'payload': 'x' * 100} for i in range(count)]
+    results = {}
+    results['call_many'] = report(
+        'data call_many', count, timed(lambda: client.call_many('benchapp.record', data_dicts)))
+    # hold the jobs back until the worker is ready
+    server.backend.pause('benchapp.record', 3600)
+    with Worker(['-w', '1']):
+        wait_for(lambda: watching('benchapp.record') >= 1, 30)
+        start = time.time()
+        server.backend.pause('benchapp.record', 0)
+        wait_for(lambda: drained('benchapp.record'), 600)
+        results['process'] = report('data process', count, time.time() - start)
+        wait_for(lambda: not JobData.objects.count(), 30, interval=0.1)
+        results['cleaned_after_s'] = round(time.time() - start, 3)
+    close_pools()
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        else:
+            yield prefix + key, value
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict(flatten(json.load(f)['results']))
+    print
+    print "Change against %s:" % baseline_path
+    for key, value in flatten(results):
+        before = baseline.get(key)
+        if key.endswith('jobs_per_s') and before and value:
+            print "%-48s %10.0f -> %10.0f  %+6.1f%%" % (key, before, value, (value / before - 1) * 100)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--jobs', type='int', default=5000, help='Jobs per benchmark.')
+    parser.add_option('--workers', default='1,2,4', help='Worker counts of the worker benchmark.')
+    parser.add_option('--executors', default='prefork', help='Executors of the worker benchmark.')
+    parser.add_option('--attempt', type='int', default=4, help='Attempt on which the retry storm happens.')
+    parser.add_option('--only', default=','.join(SCENARIOS), help='Benchmarks to run.')
+    parser.add_option('--output', default='bench_results.json', help='File the results are written to.')
+    parser.add_option('--baseline', default=None, help='Results of an earlier run to compare with.')
+    options, args = parser.parse_args()
+    options.workers = [int(workers) for workers in options.workers.split(',')]
+    options.executors = options.executors.split(',')
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    results = {}
+    try:
+        for scenario in options.only.split(','):
+            if scenario not in SCENARIOS:
+                parser.error("Unknown benchmark %s" % scenario)
+            results[scenario] = globals()['bench_' + scenario](options)
+    finally:
+        server.stop()
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
+    with open(options.output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {
+                'jobs': options.jobs,
+                'workers': options.workers,
+                'executors': options.executors,
+                'attempt': options.attempt,
+                'job_sleep_ms': float(os.environ.get('BENCH_JOB_SLEEP', 2)),
+            },
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print "Results written to %s" % options.output
+    if options.baseline:
+        compare(results, options.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@
 Django Beanstalk Interface
 """
 from .client import BeanstalkClient, DataBeanstalkClient
-from .connection import connect_beanstalkd
-from .decorators import backoff_beanstalk_job, beanstalk_job, data_beanstalk_job, retry_data_beanstalk_job
-from .errors import BeanstalkError, BeanstalkRetryError
+from .connection import connect_beanstalkd, get_pool
+from .decorators import (backoff_beanstalk_job, batched_beanstalk_job, beanstalk_job, data_beanstalk_job,
+                         periodic_beanstalk_job, retry_data_beanstalk_job)
+from .errors import BeanstalkBatchError, BeanstalkError, BeanstalkRetryError
 from .models import JobData
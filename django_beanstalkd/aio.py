@@ -0,0 +1,408 @@
+"""
+Asynchronous beanstalkd client for code running in a trollius event loop.
+
+AsyncBeanstalkClient speaks the beanstalkd protocol over trollius transports
+instead of blocking on beanstalkc sockets. Its methods return futures,
+waited for in coroutines with "yield From(...)":
+
+    from trollius import From, coroutine, gather
+
+    @coroutine
+    def reindex(pks):
+        client = AsyncBeanstalkClient()
+        job_id = yield From(client.call('myapp.reindex', '123'))
+        job_ids = yield From(gather(*[client.call('myapp.reindex', pk) for pk in pks]))
+
+beanstalkd answers the commands of a connection in order, so concurrent calls
+are pipelined on the same connections: each server gets at most
+BEANSTALK_ASYNC_POOL_SIZE (4) connections per event loop, and a new one is
+only opened while all the others are waiting for replies.
+
+Needs trollius (pip install django-beanstalkd[async]). Like the rest of the
+package this module is Python 2 only, so asyncio and await aren't supported.
+"""
+import collections
+import logging
+import socket
+import time
+
+import beanstalkc
+import yaml
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import dedupe, envelope, metrics
+from .connection import parse_server
+from .errors import BeanstalkError
+from .routing import get_router
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+_asyncio_module = None
+
+
+def _asyncio():
+    global _asyncio_module
+    if _asyncio_module is None:
+        try:
+            import trollius
+        except ImportError:
+            raise ImproperlyConfigured("AsyncBeanstalkClient needs trollius")
+        _asyncio_module = trollius
+    return _asyncio_module
+
+
+def _future(loop):
+    return _asyncio().Future(loop=loop)
+
+
+def _done(loop, result):
+    future = _future(loop)
+    future.set_result(result)
+    return future
+
+
+def _chain(loop, future, callback=None, errback=None):
+    """
+    Returns a future of callback(result of future), or of errback(exception)
+    if future failed. Both may return a future to wait for in turn.
+    """
+    chained = _future(loop)
+
+    def resolve(value):
+        if hasattr(value, 'add_done_callback'):
+            value.add_done_callback(lambda inner: _copy(inner, chained))
+        else:
+            chained.set_result(value)
+
+    def done(future):
+        if future.cancelled():
+            chained.cancel()
+            return
+        error = future.exception()
+        try:
+            if error is None:
+                resolve(callback(future.result()) if callback else future.result())
+            elif errback is not None:
+                resolve(errback(error))
+            else:
+                chained.set_exception(error)
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def _copy(source, target):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class BeanstalkProtocol(object):
+    """
+    One beanstalkd connection. The commands issued during an iteration of
+    the event loop are written together; their replies are matched to them
+    in order.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.tube_used = 'default'
+        self.closed = False
+        self._buffer = ''
+        self._output = []
+        self._replies = collections.deque()  # (future, parse, statuses followed by a body)
+
+    @property
+    def pending(self):
+        return len(self._replies)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        error = BeanstalkError("Connection lost: %s" % (exc or 'closed'))
+        while self._replies:
+            future = self._replies.popleft()[0]
+            if not future.done():
+                future.set_exception(error)
+
+    def eof_received(self):
+        return False
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def data_received(self, data):
+        self._buffer += data
+        while self._replies:
+            end = self._buffer.find('\r\n')
+            if end < 0:
+                return
+            future, parse, body_statuses = self._replies[0]
+            reply = self._buffer[:end].split()
+            status, args = reply[0], reply[1:]
+            body = None
+            if status in body_statuses:
+                size = int(args[-1])
+                if len(self._buffer) < end + size + 4:
+                    return
+                body = self._buffer[end + 2:end + 2 + size]
+                end += size + 2
+            self._buffer = self._buffer[end + 2:]
+            self._replies.popleft()
+            if future.done():
+                continue
+            try:
+                future.set_result(parse(status, args, body))
+            except Exception as e:
+                future.set_exception(e)
+
+    def command(self, line, parse, body=None, body_statuses=()):
+        """Returns a future of parse(status, args, body) of the reply to line"""
+        future = _future(self.loop)
+        if self.closed:
+            future.set_exception(BeanstalkError("Connection closed"))
+            return future
+        if not self._output:
+            self.loop.call_soon(self._flush)
+        if body is None:
+            self._output.append(line + '\r\n')
+        else:
+            self._output.append('%s\r\n%s\r\n' % (line, body))
+        self._replies.append((future, parse, body_statuses))
+        return future
+
+    def _flush(self):
+        output, self._output = self._output, []
+        if not self.closed:
+            self.transport.write(''.join(output))
+
+    def use(self, tube):
+        if tube == self.tube_used:
+            return
+        self.tube_used = tube
+
+        def used(status, args, body):
+            if status != 'USING':
+                # later commands may have gone to the wrong tube
+                self.close()
+                raise beanstalkc.CommandFailed('use', status, args)
+        # a failure shows up in the put that follows
+        self.command('use %s' % tube, used).add_done_callback(lambda future: future.exception())
+
+    def put(self, body, priority, delay, ttr):
+        def inserted(status, args, _):
+            if status == 'INSERTED':
+                return int(args[0])
+            if status in ('JOB_TOO_BIG', 'BURIED', 'DRAINING'):
+                raise beanstalkc.CommandFailed('put', status, args)
+            raise beanstalkc.UnexpectedResponse('put', status, args)
+        return self.command('put %d %d %d %d' % (priority, delay, ttr, len(body)), inserted, body)
+
+    def stats_tube(self, tube):
+        def parsed(status, args, body):
+            if status == 'OK':
+                return yaml.safe_load(body)
+            if status == 'NOT_FOUND':
+                raise beanstalkc.CommandFailed('stats-tube', status, args)
+            raise beanstalkc.UnexpectedResponse('stats-tube', status, args)
+        return self.command('stats-tube %s' % tube, parsed, body_statuses=('OK',))
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncConnectionPool(object):
+    """Connections to one beanstalkd server, for one event loop"""
+
+    def __init__(self, loop, server, port, size=None):
+        self.loop = loop
+        self.server = server
+        self.port = port
+        self.size = size or getattr(settings, 'BEANSTALK_ASYNC_POOL_SIZE', 4)
+        self._connections = []  # futures of BeanstalkProtocols
+
+    def connection(self):
+        """Returns a future of the connection the next command should use"""
+        self._connections = [future for future in self._connections if not self._broken(future)]
+        for future in self._connections:
+            if future.done() and not future.result().pending:
+                return future
+        if len(self._connections) < self.size:
+            future = self._connect()
+            self._connections.append(future)
+            return future
+        # all of them are busy: queue behind the fewest replies
+        return min(self._connections, key=lambda future: future.result().pending if future.done() else 0)
+
+    @staticmethod
+    def _broken(future):
+        if not future.done():
+            return False
+        return future.cancelled() or future.exception() is not None or future.result().closed
+
+    def _connect(self):
+        asyncio = _asyncio()
+        ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+        connecting = ensure_future(self.loop.create_connection(
+            lambda: BeanstalkProtocol(self.loop), self.server, self.port), loop=self.loop)
+
+        def failed(error):
+            raise BeanstalkError(error)
+        return _chain(self.loop, connecting, lambda pair: pair[1], failed)
+
+    def close(self):
+        for future in self._connections:
+            if not self._broken(future):
+                future.result().close()
+        self._connections = []
+
+
+# (event loop, server, port) -> AsyncConnectionPool
+_pools = {}
+
+
+def close_pools():
+    """Close the connections of all AsyncBeanstalkClients"""
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
+
+
+class AsyncBeanstalkClient(object):
+    """
+    beanstalk client returning futures, with the same routing, envelope,
+    dedupe and metrics as BeanstalkClient. Claiming dedupe keys and spilling
+    large bodies to the database still block.
+    """
+
+    def __init__(self, server=None, port=None, loop=None):
+        self.loop = loop or _asyncio().get_event_loop()
+        if server is not None:
+            self._router = get_router([parse_server(server, port)])
+        else:
+            self._router = get_router()
+
+    def _pool(self, pool):
+        key = (self.loop, pool.server, pool.port)
+        if key not in _pools:
+            _pools[key] = AsyncConnectionPool(self.loop, pool.server, pool.port)
+        return _pools[key]
+
+    def _with_connection(self, func, operation):
+        """
+        Returns a future of operation(connection) for a connection using tube
+        func, failing over to the next server if one can't be reached.
+        """
+        pools = self._router.route(func)
+        result = _future(self.loop)
+
+        def attempt(index, error):
+            if index == len(pools):
+                result.set_exception(BeanstalkError(error))
+                return
+            pool = pools[index]
+
+            def run(conn):
+                conn.use(func)
+                return operation(conn)
+
+            def done(future):
+                if future.cancelled():
+                    result.cancel()
+                    return
+                error = future.exception()
+                if error is None:
+                    result.set_result(future.result())
+                elif isinstance(error, (BeanstalkError, socket.error)):
+                    logger.warning("Beanstalk server %s:%s failed: %s" % (pool.server, pool.port, error))
+                    pool.mark_down()
+                    attempt(index + 1, error)
+                else:
+                    result.set_exception(error)
+            connection = self._pool(pool).connection()
+            if connection.done() and not connection.cancelled() and connection.exception() is None:
+                # already connected, skip a round through the event loop
+                try:
+                    future = run(connection.result())
+                except Exception as e:
+                    future = _future(self.loop)
+                    future.set_exception(e)
+            else:
+                future = _chain(self.loop, connection, run)
+            future.add_done_callback(done)
+
+        attempt(0, None)
+        return result
+
+    def call(self, func, arg='', priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR,
+             dedupe_key=None):
+        """Like BeanstalkClient.call; returns a future of the job id (None for duplicates)"""
+        dedupe_key = dedupe.resolve(func, arg, dedupe_key)
+        if dedupe_key is not None:
+            dedupe_key = dedupe.claim(func, dedupe_key)
+            if dedupe_key is None:
+                return _done(self.loop, None)
+
+        start = time.time()
+        body = str(arg)
+        if envelope.enabled():
+            body = envelope.wrap(func, body, start if metrics.enabled() else None, dedupe_key)
+
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                dedupe.release(dedupe_key)
+                return
+            metrics.incr('jobs_enqueued', func)
+            metrics.timing('enqueue_latency', func, time.time() - start)
+            metrics.maybe_flush()
+        future = self._with_connection(func, lambda conn: conn.put(body, priority, delay, ttr))
+        future.add_done_callback(done)
+        return future
+
+    def stats_tube(self, func):
+        """Returns a future of the stats-tube dict of func, adding up the numbers of all servers"""
+        pools = [pool for pool in self._router.pools if not pool.is_down()]
+        futures = [_chain(self.loop, self._pool(pool).connection(), lambda conn: conn.stats_tube(func))
+                   for pool in pools]
+
+        def added(results):
+            stats = None
+            for pool, result in zip(pools, results):
+                if isinstance(result, beanstalkc.CommandFailed):
+                    continue
+                if isinstance(result, Exception):
+                    logger.warning("Beanstalk server %s:%s failed: %s" % (pool.server, pool.port, result))
+                    pool.mark_down()
+                    continue
+                if stats is None:
+                    stats = result
+                    continue
+                for key, value in result.items():
+                    if key.startswith(('current-', 'total-', 'cmd-')):
+                        stats[key] = stats.get(key, 0) + value
+            if stats is None:
+                raise beanstalkc.CommandFailed('stats-tube', 'NOT_FOUND', [])
+            return stats
+        return _chain(self.loop, _asyncio().gather(*futures, return_exceptions=True), added)
+
+    def current_jobs_delayed(self, func):
+        return _chain(self.loop, self.stats_tube(func), lambda stats: stats['current-jobs-delayed'])
+
+    def current_jobs_ready(self, func):
+        return _chain(self.loop, self.stats_tube(func), lambda stats: stats['current-jobs-ready'])
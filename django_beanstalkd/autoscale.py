@@ -0,0 +1,132 @@
+"""
+Queue-depth-driven autoscaling of the worker processes.
+
+    python manage.py beanstalk_worker --autoscale=2,16
+
+keeps between 2 and 16 workers running. Every BEANSTALK_AUTOSCALE_INTERVAL
+seconds (5) the supervisor reads the stats of all served tubes, in one pass
+over the servers, and from their changes since the last poll estimates how
+many jobs arrive and how many the workers finish per second. While jobs are
+waiting, the workers are busy, so the drain rate per worker is what a worker
+can do. The supervisor then wants enough workers to keep up with the
+arrivals and clear the ready jobs within BEANSTALK_AUTOSCALE_DRAIN_TIME
+seconds (30).
+
+It adds workers as soon as it wants more, but at most every
+BEANSTALK_AUTOSCALE_UP_COOLDOWN seconds (10), and retires one worker when it
+wants fewer by a margin of BEANSTALK_AUTOSCALE_HYSTERESIS (0.25, i.e. 25%),
+at most every BEANSTALK_AUTOSCALE_DOWN_COOLDOWN seconds (60). A retired
+worker finishes its current jobs first.
+"""
+import logging
+import math
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+def parse_autoscale(value):
+    """Returns (min, max) of a "min,max" option value"""
+    try:
+        low, high = [int(bound) for bound in value.split(',')]
+    except ValueError:
+        raise ValueError('--autoscale must be "min,max", e.g. "2,16"')
+    if not 0 < low <= high:
+        raise ValueError('--autoscale needs 0 < min <= max')
+    return low, high
+
+
+class TubeStats(object):
+    """stats-tube of tubes, cached for max_age seconds"""
+
+    def __init__(self, client, tubes, max_age=1.0, clock=None):
+        self.client = client
+        self.tubes = tubes
+        self.max_age = max_age
+        self.clock = clock or time.time
+        self._stats = None
+        self._fetched = 0
+
+    def get(self):
+        now = self.clock()
+        if self._stats is None or now - self._fetched >= self.max_age:
+            self._stats = self.client.stats_tubes(self.tubes)
+            self._fetched = now
+        return self._stats
+
+    def total(self, key):
+        return sum(tube_stats.get(key, 0) for tube_stats in self.get().values())
+
+
+class Autoscaler(object):
+    """
+    Decides how many workers to run, between low and high. poll(workers) is
+    called with the number of running workers and returns the number wanted.
+    """
+    # weight of the latest sample in the estimate of a worker's throughput
+    SMOOTHING = 0.3
+
+    def __init__(self, low, high, stats, drain_time=None, hysteresis=None, up_cooldown=None, down_cooldown=None,
+                 clock=None):
+        self.low = low
+        self.high = high
+        self.stats = stats
+        self.drain_time = drain_time or getattr(settings, 'BEANSTALK_AUTOSCALE_DRAIN_TIME', 30)
+        self.hysteresis = getattr(settings, 'BEANSTALK_AUTOSCALE_HYSTERESIS', 0.25) if hysteresis is None \
+            else hysteresis
+        self.up_cooldown = getattr(settings, 'BEANSTALK_AUTOSCALE_UP_COOLDOWN', 10) if up_cooldown is None \
+            else up_cooldown
+        self.down_cooldown = getattr(settings, 'BEANSTALK_AUTOSCALE_DOWN_COOLDOWN', 60) if down_cooldown is None \
+            else down_cooldown
+        self.clock = clock or time.time
+        self.per_worker = None  # jobs per second a busy worker finishes
+        self.last_change = 0
+        self._last = None  # (time, jobs put, jobs deleted) of the previous poll
+
+    def sample(self):
+        """Returns (ready jobs, jobs put per second, jobs deleted per second), the rates None on the first poll"""
+        now = self.clock()
+        ready = self.stats.total('current-jobs-ready')
+        put = self.stats.total('total-jobs')
+        deleted = self.stats.total('cmd-delete')
+        last, self._last = self._last, (now, put, deleted)
+        if last is None or now <= last[0] or put < last[1] or deleted < last[2]:
+            # no earlier poll, or a server restarted or couldn't be reached
+            return ready, None, None
+        return ready, (put - last[1]) / (now - last[0]), (deleted - last[2]) / (now - last[0])
+
+    def wanted(self, workers, ready, arrival, drain):
+        """The number of workers that keeps up with arrival and clears ready within drain_time"""
+        if drain is None:
+            return workers
+        if ready and drain and workers:
+            # the workers are busy, so this is what they can do
+            sample = drain / workers
+            self.per_worker = sample if self.per_worker is None else \
+                self.SMOOTHING * sample + (1 - self.SMOOTHING) * self.per_worker
+        if not self.per_worker:
+            # nothing to go by yet
+            return workers * 2 if ready else workers
+        return int(math.ceil((arrival + ready / float(self.drain_time)) / self.per_worker))
+
+    def poll(self, workers):
+        ready, arrival, drain = self.sample()
+        wanted = max(self.low, min(self.high, self.wanted(workers, ready, arrival, drain)))
+        now = self.clock()
+        if wanted > workers:
+            if now - self.last_change < self.up_cooldown:
+                return workers
+        elif wanted < workers:
+            # only shrink well below the current count, and one worker at a time
+            if wanted * (1 + self.hysteresis) >= workers or now - self.last_change < self.down_cooldown:
+                return workers
+            wanted = workers - 1
+        else:
+            return workers
+        logger.info("Autoscaling from %d to %d workers (%d jobs ready, %.1f put/s, %.1f done/s)"
+                    % (workers, wanted, ready, arrival or 0, drain or 0))
+        self.last_change = now
+        return wanted
@@ -0,0 +1,128 @@
+"""
+Client-side batching of tiny jobs.
+
+BeanstalkClient.call_batched hands its arg to the accumulator instead of
+putting a job. The items queued for the same function (and priority, delay
+and ttr) are put as a single job once max_items of them are pending or the
+first has waited max_wait milliseconds. Jobs decorated with
+batched_beanstalk_job register their max_items and max_wait here, so clients
+that import them don't have to repeat them.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+from . import serializers
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+# job name -> (max_items, max_wait) of batched_beanstalk_job
+_options = {}
+
+
+def register(job_name, max_items, max_wait):
+    _options[job_name] = (max_items, max_wait)
+
+
+def get_options(job_name):
+    return _options.get(job_name, (
+        getattr(settings, 'BEANSTALK_BATCH_MAX_ITEMS', 100),
+        getattr(settings, 'BEANSTALK_BATCH_MAX_WAIT', 500),
+    ))
+
+
+def encode_batch(items, attempt=0, delay=0):
+    """delay is the one the batch was put with, for the backoff of its next retry"""
+    data = {u'items': items}
+    if attempt:
+        data[u'attempt'] = attempt
+        data[u'delay'] = delay
+    return serializers.dumps(data)
+
+
+def decode_batch(body):
+    """Returns (items, attempt, delay) of a batch job"""
+    data = serializers.loads(body)
+    return list(data[u'items']), int(data.get(u'attempt', 0)), int(data.get(u'delay', 0))
+
+
+class Batch(object):
+    def __init__(self, client, func, priority, delay, ttr):
+        self.client = client
+        self.func = func
+        self.priority = priority
+        self.delay = delay
+        self.ttr = ttr
+        self.items = []
+        self.timer = None
+
+    def send(self):
+        return self.client.call(self.func, encode_batch(self.items),
+                                priority=self.priority, delay=self.delay, ttr=self.ttr)
+
+
+class Accumulator(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches = {}
+
+    def add(self, client, func, arg, max_items=None, max_wait=None, priority=None, delay=0, ttr=None):
+        """
+        Queue arg for func. Returns the id of the job if this filled the
+        batch and it was put, None otherwise.
+        """
+        default_items, default_wait = get_options(func)
+        max_items = max_items or default_items
+        max_wait = default_wait if max_wait is None else max_wait
+
+        key = (client._router, func, priority, delay, ttr)
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = Batch(client, func, priority, delay, ttr)
+                batch.timer = threading.Timer(max_wait / 1000.0, self._expire, [key, batch])
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.items.append(arg)
+            full = len(batch.items) >= max_items
+            if full:
+                del self._batches[key]
+        if full:
+            batch.timer.cancel()
+            return batch.send()
+
+    def _expire(self, key, batch):
+        with self._lock:
+            if self._batches.get(key) is not batch:
+                # filled up or flushed in the meantime
+                return
+            del self._batches[key]
+        self._send(batch)
+
+    def _send(self, batch):
+        try:
+            batch.send()
+        except Exception:
+            logger.exception("Unable to put %d batched items for %s" % (len(batch.items), batch.func))
+
+    def flush(self):
+        """Put all pending batches"""
+        with self._lock:
+            batches, self._batches = self._batches.values(), {}
+        for batch in batches:
+            batch.timer.cancel()
+            self._send(batch)
+
+
+accumulator = Accumulator()
+
+
+def flush():
+    """Put pending batches, e.g. before the process exits"""
+    accumulator.flush()
+
+
+atexit.register(flush)
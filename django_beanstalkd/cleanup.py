@@ -0,0 +1,83 @@
+"""
+Buffered deletion of JobData rows.
+
+Jobs hand the rows they're done with to delete_job_data instead of deleting
+them one by one. The rows are deleted with a single DELETE ... WHERE id IN
+(...) once BEANSTALK_JOBDATA_DELETE_BATCH of them are pending or the oldest
+has waited BEANSTALK_JOBDATA_DELETE_INTERVAL seconds. Rows left behind by a
+worker that crashed are removed by the beanstalk_reap_jobdata command.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .models import JobData
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class JobDataCleaner(object):
+    def __init__(self, batch_size=None, interval=None):
+        self._batch_size = batch_size
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._since = None
+
+    @property
+    def batch_size(self):
+        return self._batch_size or getattr(settings, 'BEANSTALK_JOBDATA_DELETE_BATCH', 100)
+
+    @property
+    def interval(self):
+        return self._interval or getattr(settings, 'BEANSTALK_JOBDATA_DELETE_INTERVAL', 5)
+
+    def delete(self, pk):
+        """Schedule the row with primary key pk for deletion"""
+        with self._lock:
+            if not self._pending:
+                self._since = time.time()
+            self._pending.append(pk)
+            due = len(self._pending) >= self.batch_size or time.time() - self._since >= self.interval
+        if due:
+            self.flush()
+
+    def flush_if_due(self):
+        """Delete the pending rows if the oldest has waited long enough"""
+        with self._lock:
+            due = self._pending and time.time() - self._since >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Delete all pending rows"""
+        with self._lock:
+            pks, self._pending = self._pending, []
+        if pks:
+            JobData.objects.filter(pk__in=pks).delete()
+
+
+cleaner = JobDataCleaner()
+
+
+def delete_job_data(pk):
+    cleaner.delete(pk)
+
+
+def flush():
+    """Delete pending rows, e.g. before the worker exits"""
+    try:
+        cleaner.flush()
+    except Exception:
+        logger.exception("Unable to delete job data")
+
+
+def flush_if_due():
+    """Delete pending rows that have waited long enough, e.g. while the worker is idle"""
+    try:
+        cleaner.flush_if_due()
+    except Exception:
+        logger.exception("Unable to delete job data")
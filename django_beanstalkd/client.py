@@ -1,15 +1,83 @@
+import logging
+import time
+import uuid
+
 import beanstalkc
+from beanstalkc import SocketError
 from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, router
 from raven.contrib.django.raven_compat.models import client as raven_client
 
-from .connection import connect_beanstalkd
+from . import batching, dedupe, deferred, envelope, groups, metrics
+from .connection import parse_server
+from .errors import BeanstalkBatchError, BeanstalkError
+from .executors import current_job
 from .models import JobData
+from .routing import get_router
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+# Number of put commands written to the socket before their replies are read.
+# beanstalkd stops reading a connection while it can't write the replies, so
+# the batch has to be small enough for the replies to fit in the socket buffers.
+PIPELINE_CHUNK_SIZE = 500
+
+
+def put_many(beanstalk, bodies, priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR,
+             chunk_size=PIPELINE_CHUNK_SIZE):
+    """
+    Puts all bodies into the tube currently used by the beanstalk connection,
+    writing chunk_size put commands before reading the replies.
+
+    Returns the list of job ids in the order of bodies. Raises
+    BeanstalkBatchError if any of the puts failed.
+    """
+    for body in bodies:
+        # like beanstalkc.Connection.put: the length written must count bytes
+        assert isinstance(body, str), 'Job body must be a str instance'
+    job_ids = []
+    failures = []
+    for start in range(0, len(bodies), chunk_size):
+        chunk = bodies[start:start + chunk_size]
+        commands = ''.join(
+            'put %d %d %d %d\r\n%s\r\n' % (priority, delay, ttr, len(body), body)
+            for body in chunk
+        )
+        try:
+            SocketError.wrap(beanstalk._socket.sendall, commands)
+            for i in range(len(chunk)):
+                status, results = beanstalk._read_response()
+                if status == 'INSERTED':
+                    job_ids.append(int(results[0]))
+                else:
+                    # BURIED still carries the id of the (buried) job
+                    job_ids.append(int(results[0]) if results else None)
+                    failures.append((start + i, status))
+        except SocketError:
+            # the state of the unanswered puts is unknown
+            for index in range(len(job_ids), len(bodies)):
+                job_ids.append(None)
+                failures.append((index, 'SOCKET_ERROR'))
+            raise BeanstalkBatchError(job_ids, failures)
+
+    if failures:
+        raise BeanstalkBatchError(job_ids, failures)
+    return job_ids
 
 
 class BeanstalkClient(object):
-    """beanstalk client, automatically connecting to server"""
+    """
+    beanstalk client, borrowing connections from the shared pools
 
-    def call(self, func, arg='', priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR):
+    Jobs are put on the server the router picks for their tube. If it can't
+    be reached, the next server is tried; a put that failed halfway may
+    then create the job twice.
+    """
+
+    def call(self, func, arg='', priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR,
+             dedupe_key=None):
         """
         Calls the specified function (in beanstalk terms: put the specified arg
         in tube func)
@@ -18,32 +86,300 @@ class BeanstalkClient(object):
                   smaller priority get executed first
         delay: how many seconds to wait before the job can be reserved
         ttr: how many seconds a worker has to process the job before it gets requeued
+        dedupe_key: don't put the job while a job for func with the same key
+                    is pending, see django_beanstalkd.dedupe. Defaults to the
+                    key derived by the job's decorator, if any.
+
+        Returns the job id, or None if the job was a duplicate or is put
+        when the transaction commits (see django_beanstalkd.deferred).
+        """
+        dedupe_key = dedupe.resolve(func, arg, dedupe_key)
+        if dedupe_key is not None:
+            dedupe_key = dedupe.claim(func, dedupe_key)
+            if dedupe_key is None:
+                return None
+        try:
+            return self._put(func, str(arg), priority, delay, ttr, dedupe_key)
+        except Exception:
+            dedupe.release(dedupe_key)
+            raise
+
+    def call_again(self, func, arg='', priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR):
+        """
+        Like call, for the job of func the worker is running to put itself
+        again, e.g. to retry later. No dedupe key is claimed: the new job
+        takes over the running job's key, which would otherwise drop it as a
+        duplicate, and the worker doesn't release the key once the running
+        job is done. Likewise the new job takes the running job's place in
+        its job group, and the running job's result isn't recorded.
+        """
+        task = current_job()
+        if task is None or task.job_name != func:
+            return self._put(func, str(arg), priority, delay, ttr)
+        job_id = self._put(func, str(arg), priority, delay, ttr, task.dedupe_key, task.member)
+        task.dedupe_key = task.member = None
+        return job_id
+
+    def _put(self, func, body, priority, delay, ttr, dedupe_key=None, member=None):
+        start = time.time()
+        if envelope.enabled():
+            body = envelope.wrap(func, body, start if metrics.enabled() else None, dedupe_key, member)
+        if self._deferring():
+            deferred.defer(self._using, self, func, body, priority, delay, ttr, dedupe_key)
+            return None
+        job_id = self._with_connection(
+            func, lambda beanstalk: beanstalk.put(body, priority=priority, delay=delay, ttr=ttr))
+        metrics.incr('jobs_enqueued', func)
+        metrics.timing('enqueue_latency', func, time.time() - start)
+        metrics.maybe_flush()
+        return job_id
+
+    def _deferring(self):
+        """Whether puts wait for the transaction of the client's database to commit"""
+        return self._defer and deferred.in_atomic_block(self._using)
+
+    def call_many(self, func, args, priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR,
+                  chunk_size=PIPELINE_CHUNK_SIZE):
+        """
+        Calls the specified function once for every arg in args, pipelining
+        the puts instead of waiting for each reply.
+
+        Returns the job ids in the order of args. If some of the puts fail,
+        BeanstalkBatchError is raised; its job_ids and failures attributes
+        tell which jobs were created.
         """
-        self._beanstalk.use(func)
-        self._beanstalk.put(str(arg), priority=priority, delay=delay, ttr=ttr)
+        bodies = [str(arg) for arg in args]
+        if envelope.enabled():
+            enqueued_at = time.time() if metrics.enabled() else None
+            bodies = [envelope.wrap(func, body, enqueued_at) for body in bodies]
+        if self._deferring():
+            for body in bodies:
+                deferred.defer(self._using, self, func, body, priority, delay, ttr)
+            return [None] * len(bodies)
+        return self._put_many(func, bodies, priority, delay, ttr, chunk_size)
+
+    def _put_many(self, func, bodies, priority, delay, ttr, chunk_size=PIPELINE_CHUNK_SIZE):
+        start = time.time()
+        job_ids = self._with_connection(
+            func, lambda beanstalk: put_many(beanstalk, bodies, priority=priority, delay=delay, ttr=ttr,
+                                             chunk_size=chunk_size))
+        metrics.incr('jobs_enqueued', func, len(job_ids))
+        metrics.timing('enqueue_latency', func, time.time() - start)
+        metrics.maybe_flush()
+        return job_ids
+
+    def call_group(self, func, args, callback=None, priority=beanstalkc.DEFAULT_PRIORITY, delay=0,
+                   ttr=beanstalkc.DEFAULT_TTR, callback_priority=None, callback_ttr=None,
+                   chunk_size=PIPELINE_CHUNK_SIZE):
+        """
+        Calls the specified function once for every arg in args as a job
+        group, see django_beanstalkd.groups. Once every job returned, the
+        callback function is called with the JSON encoded group id and the
+        values they returned, in the order of args.
+
+        callback_priority, callback_ttr: for the callback job, default to
+                                         priority and ttr
+
+        Returns the group id. The puts are pipelined and fail like in
+        call_many, and the group is forgotten then: it can't complete
+        without the members that weren't put.
+        """
+        envelope.require("Job groups")
+        group_id = uuid.uuid4().hex
+        groups.start(group_id, len(args), callback,
+                     priority if callback_priority is None else callback_priority,
+                     ttr if callback_ttr is None else callback_ttr)
+        if not args:
+            groups.put_callback(self, group_id)
+            return group_id
+        enqueued_at = time.time() if metrics.enabled() else None
+        bodies = [envelope.wrap(func, str(arg), enqueued_at, member=(group_id, index))
+                  for index, arg in enumerate(args)]
+        if self._deferring():
+            for body in bodies:
+                deferred.defer(self._using, self, func, body, priority, delay, ttr)
+            return group_id
+        try:
+            self._put_many(func, bodies, priority, delay, ttr, chunk_size)
+        except Exception:
+            groups.forget(group_id)
+            raise
+        return group_id
+
+    def call_batched(self, func, arg, max_items=None, max_wait=None, priority=beanstalkc.DEFAULT_PRIORITY,
+                     delay=0, ttr=beanstalkc.DEFAULT_TTR):
+        """
+        Queues arg for a job decorated with batched_beanstalk_job. The args
+        queued for the same func are put as a single job once max_items of
+        them are pending or the first has waited max_wait milliseconds.
+        Returns the job id if this call put the job, None otherwise.
+
+        max_items, max_wait: default to the values given to the decorator
+                             if the job module is imported, or
+                             BEANSTALK_BATCH_MAX_ITEMS (100) and
+                             BEANSTALK_BATCH_MAX_WAIT (500)
+        arg: any value the serializer can encode
+        """
+        metrics.incr('items_batched', func)
+        return batching.accumulator.add(self, func, arg, max_items, max_wait, priority, delay, ttr)
+
+    def _with_connection(self, func, operation):
+        """
+        Returns operation(connection) for a connection using tube func,
+        failing over to the next server if one can't be reached.
+        """
+        error = None
+        for pool in self._router.route(func):
+            try:
+                with pool.connection() as beanstalk:
+                    beanstalk.use(func)
+                    return operation(beanstalk)
+            except BeanstalkBatchError:
+                raise
+            except (BeanstalkError, SocketError) as e:
+                logger.warning("Beanstalk server %s:%s failed: %s" % (pool.server, pool.port, e))
+                pool.mark_down()
+                error = e
+        raise BeanstalkError(error)
+
+    def stats_tubes(self, funcs):
+        """
+        Returns {func: stats-tube dict} for the functions whose tube exists,
+        adding up the numbers of all servers
+        """
+        stats = {}
+        for pool in self._router.pools:
+            if pool.is_down():
+                continue
+            try:
+                with pool.connection() as beanstalk:
+                    for func in funcs:
+                        try:
+                            tube_stats = beanstalk.stats_tube(func)
+                        except beanstalkc.CommandFailed:
+                            continue
+                        if func not in stats:
+                            stats[func] = tube_stats
+                            continue
+                        for key, value in tube_stats.items():
+                            if key.startswith(('current-', 'total-', 'cmd-')):
+                                stats[func][key] = stats[func].get(key, 0) + value
+            except (BeanstalkError, SocketError) as e:
+                logger.warning("Beanstalk server %s:%s failed: %s" % (pool.server, pool.port, e))
+                pool.mark_down()
+        return stats
+
+    def pause_tube(self, func, delay):
+        """Keep workers from reserving jobs of func for delay seconds, on all servers"""
+        for pool in self._router.pools:
+            try:
+                with pool.connection() as beanstalk:
+                    beanstalk.pause_tube(func, delay)
+            except beanstalkc.CommandFailed:
+                # the tube doesn't exist on this server
+                pass
+            except (BeanstalkError, SocketError) as e:
+                logger.warning("Beanstalk server %s:%s failed: %s" % (pool.server, pool.port, e))
+                pool.mark_down()
+
+    def stats_tube(self, func):
+        try:
+            return self.stats_tubes([func])[func]
+        except KeyError:
+            raise beanstalkc.CommandFailed('stats-tube', 'NOT_FOUND', [])
 
     def current_jobs_delayed(self, func):
-        stats = self._beanstalk.stats_tube(func)
-        return stats["current-jobs-delayed"]
+        return self.stats_tube(func)["current-jobs-delayed"]
 
     def current_jobs_ready(self, func):
-        stats = self._beanstalk.stats_tube(func)
-        return stats["current-jobs-ready"]
+        return self.stats_tube(func)["current-jobs-ready"]
 
     def __init__(self, **kwargs):
         server = kwargs.get('server', None)
         port = kwargs.get('port', None)
-        self._beanstalk = connect_beanstalkd(server, port)
+        # inside an atomic block of this database, jobs are put once it commits
+        self._defer = deferred.enabled(kwargs.get('defer', None))
+        self._using = kwargs.get('using', None) or self._default_database()
+        # connections are borrowed from the process-wide pools for every call
+        if server is None:
+            self._router = get_router()
+        else:
+            self._router = get_router([parse_server(server, port)])
+
+    def _default_database(self):
+        return DEFAULT_DB_ALIAS
 
 
 class DataBeanstalkClient(BeanstalkClient):
-    def call(self, func, data_dict, *args, **kwargs):
+    def _default_database(self):
+        return router.db_for_write(JobData)
+
+    def call(self, func, data_dict, priority=beanstalkc.DEFAULT_PRIORITY, delay=0, ttr=beanstalkc.DEFAULT_TTR,
+             dedupe_key=None):
+        """
+        Like BeanstalkClient.call, storing data_dict in a JobData row. No row
+        is created for duplicates.
+        """
+        dedupe_key = dedupe.resolve(func, data_dict, dedupe_key)
+        if dedupe_key is not None:
+            dedupe_key = dedupe.claim(func, dedupe_key)
+            if dedupe_key is None:
+                return None
         try:
             data = JobData()
             data.data_dict = data_dict
             data.job_name = func
             data.save()
-            kwargs['arg'] = str(data.pk)
-            super(DataBeanstalkClient, self).call(func, **kwargs)
+            return self._put(func, str(data.pk), priority, delay, ttr, dedupe_key)
         except Exception:
+            dedupe.release(dedupe_key)
             raven_client.captureException()
+
+    def call_many(self, func, data_dicts, chunk_size=PIPELINE_CHUNK_SIZE, **kwargs):
+        """
+        Calls the specified function once for every dictionary in data_dicts.
+        The JobData rows are inserted chunk_size at a time and the puts are
+        pipelined.
+
+        Returns the job ids in the order of data_dicts. If some of the puts
+        fail, BeanstalkBatchError is raised like in BeanstalkClient.call_many;
+        the rows of the jobs that were certainly not created are deleted.
+        """
+        pks = []
+        for start in range(0, len(data_dicts), chunk_size):
+            pks += JobData.objects.create_many(func, data_dicts[start:start + chunk_size])
+        try:
+            return super(DataBeanstalkClient, self).call_many(func, pks, chunk_size=chunk_size, **kwargs)
+        except BeanstalkBatchError as e:
+            # buried jobs exist, and jobs lost with the connection might
+            unused = [pks[index] for index, status in e.failures if status not in ('BURIED', 'SOCKET_ERROR')]
+            if unused:
+                JobData.objects.filter(pk__in=unused).delete()
+            raise
+        except Exception:
+            # nothing was put
+            JobData.objects.filter(pk__in=pks).delete()
+            raise
+
+    def call_group(self, func, data_dicts, callback=None, chunk_size=PIPELINE_CHUNK_SIZE, **kwargs):
+        """
+        Like BeanstalkClient.call_group, storing every dictionary of
+        data_dicts in a JobData row. If some of the puts fail, the rows of the
+        jobs that were certainly not created are deleted.
+        """
+        envelope.require("Job groups")
+        pks = []
+        for start in range(0, len(data_dicts), chunk_size):
+            pks += JobData.objects.create_many(func, data_dicts[start:start + chunk_size])
+        try:
+            return super(DataBeanstalkClient, self).call_group(func, pks, callback, chunk_size=chunk_size, **kwargs)
+        except BeanstalkBatchError as e:
+            # buried jobs exist, and jobs lost with the connection might
+            unused = [pks[index] for index, status in e.failures if status not in ('BURIED', 'SOCKET_ERROR')]
+            if unused:
+                JobData.objects.filter(pk__in=unused).delete()
+            raise
+        except Exception:
+            # nothing was put
+            JobData.objects.filter(pk__in=pks).delete()
+            raise
@@ -1,11 +1,56 @@
+from contextlib import contextmanager
+import os
+import select
+import socket
+import threading
+import time
+
 import beanstalkc
 from django.conf import settings
 
 from .errors import BeanstalkError
 
 
-def connect_beanstalkd(server=None, port=11300):
-    """Connect to beanstalkd server(s) from settings file"""
+DEFAULT_PORT = 11300
+
+
+class Connection(beanstalkc.Connection):
+    """beanstalkc connection remembering the tube it's using"""
+
+    def connect(self):
+        super(Connection, self).connect()
+        self.tube_used = 'default'
+        self.last_used = time.time()
+
+    def use(self, name):
+        """Use a given tube, skipping the round trip if it's already in use"""
+        if name != self.tube_used:
+            self.tube_used = None
+            super(Connection, self).use(name)
+            self.tube_used = name
+        return name
+
+    def is_healthy(self):
+        """
+        Checks without a round trip that the server hasn't closed the
+        connection: an idle connection must not have anything to read.
+        """
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def detach(self):
+        """Close the socket without saying goodbye, e.g. in a forked child"""
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+
+def parse_server(server=None, port=None):
+    """Returns (host, port) for server, falling back to the settings file"""
 
     if server is None:
         server = getattr(settings, 'BEANSTALK_SERVER', '127.0.0.1')
@@ -14,7 +59,172 @@ def connect_beanstalkd(server=None, port=11300):
         server, port = server.split(':', 1)
 
     try:
-        port = int(port)
-        return beanstalkc.Connection(server, port)
-    except (ValueError, beanstalkc.SocketError), e:
+        return server, int(port or DEFAULT_PORT)
+    except ValueError, e:
         raise BeanstalkError(e)
+
+
+def get_servers():
+    """(host, port) of every beanstalkd server from the settings file"""
+    servers = getattr(settings, 'BEANSTALK_SERVERS', None)
+    if not servers:
+        servers = [getattr(settings, 'BEANSTALK_SERVER', '127.0.0.1')]
+    return [parse_server(server) for server in servers]
+
+
+def connect_beanstalkd(server=None, port=DEFAULT_PORT):
+    """Connect to beanstalkd server(s) from settings file"""
+
+    server, port = parse_server(server, port)
+    try:
+        return Connection(server, port)
+    except beanstalkc.SocketError, e:
+        raise BeanstalkError(e)
+
+
+class ConnectionPool(object):
+    """
+    Pool of idle connections to one beanstalkd server.
+
+    size: how many idle connections are kept around. Borrowing never blocks;
+          connections beyond size are closed when they're returned.
+    max_idle: how many seconds a connection may sit unused before it's closed
+    """
+
+    def __init__(self, server, port, size=10, max_idle=300):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.down_until = 0
+        self._reset()
+
+    def __repr__(self):
+        return '<ConnectionPool %s:%s>' % (self.server, self.port)
+
+    def mark_down(self, seconds=5):
+        """Have clients prefer other servers for a while"""
+        self.down_until = time.time() + seconds
+        self.clear()
+
+    def is_down(self):
+        return time.time() < self.down_until
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def reset(self):
+        """
+        Forget all idle connections without closing them cleanly. Called in
+        forked children, which share the sockets with their parent.
+        """
+        idle = self._idle
+        self._reset()
+        for conn in idle:
+            conn.detach()
+
+    def get(self):
+        """Borrow a connection, opening a new one if none is idle"""
+        if self._pid != os.getpid():
+            self.reset()
+
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if now - candidate.last_used > self.max_idle or not candidate.is_healthy():
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+            # the oldest connections are at the start of the list
+            while self._idle and now - self._idle[0].last_used > self.max_idle:
+                expired.append(self._idle.pop(0))
+
+        for candidate in expired:
+            candidate.close()
+        if conn is None:
+            conn = connect_beanstalkd(self.server, self.port)
+        return conn
+
+    def put(self, conn):
+        """Return a borrowed connection to the pool"""
+        if self._pid != os.getpid():
+            conn.detach()
+            return
+
+        conn.last_used = time.time()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """Close a borrowed connection that is in an unknown state"""
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of the with block. Connections
+        are returned to the pool unless something other than a failed
+        command went wrong while using them.
+        """
+        conn = self.get()
+        try:
+            yield conn
+        except beanstalkc.CommandFailed:
+            self.put(conn)
+            raise
+        except:
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(server=None, port=None):
+    """Returns the process-wide connection pool for server"""
+
+    server, port = parse_server(server, port)
+    try:
+        return _pools[(server, port)]
+    except KeyError:
+        with _pools_lock:
+            if (server, port) not in _pools:
+                _pools[(server, port)] = ConnectionPool(
+                    server, port,
+                    size=getattr(settings, 'BEANSTALK_POOL_SIZE', 10),
+                    max_idle=getattr(settings, 'BEANSTALK_POOL_MAX_IDLE', 300),
+                )
+            return _pools[(server, port)]
+
+
+def close_pools():
+    """Close the idle connections of all pools, e.g. at shutdown"""
+    for pool in _pools.values():
+        pool.clear()
+
+
+def reset_pools():
+    """Drop the connections inherited from the parent process after a fork"""
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    for pool in _pools.values():
+        pool.reset()
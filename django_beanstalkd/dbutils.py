@@ -0,0 +1,95 @@
+"""
+Database connection handling around jobs.
+
+Instead of pinging the database and committing before every job, the worker
+only validates a connection that has been idle for more than
+BEANSTALK_DB_PING_AGE seconds (default 30), and only ends a transaction if
+one is open. A connection found gone while doing so is closed, so the job
+connects again. A disconnect while the job runs fails the job like any other
+error: it may have committed writes or sent mail already, so running it
+again isn't safe.
+"""
+import threading
+import time
+
+from django import db
+from django.conf import settings
+from django.db import transaction
+
+try:
+    from _mysql_exceptions import OperationalError as MySQLOperationalError
+except ImportError:
+    MySQLOperationalError = db.utils.DatabaseError
+
+
+DATABASE_ERRORS = (db.utils.DatabaseError, MySQLOperationalError)
+# MySQL client errors: server has gone away, lost connection during query
+DISCONNECT_ERRORS = (2006, 2013)
+
+_local = threading.local()
+
+
+@transaction.commit_manually
+def flush_transaction():
+    transaction.commit()
+
+
+def in_transaction(connection):
+    get_autocommit = getattr(connection, 'get_autocommit', None)
+    if get_autocommit is not None:
+        return not get_autocommit()
+    # before Django 1.6 a transaction is open as soon as the connection is used
+    return True
+
+
+def prepare_connection():
+    """
+    Make the current thread's default connection ready for a job: validate it
+    if it has been idle for long, and end the previous job's transaction so
+    the job sees the latest data.
+    """
+    connection = db.connections['default']
+    if connection.connection is None:
+        return
+
+    last_used = getattr(_local, 'last_used', 0)
+    if time.time() - last_used > getattr(settings, 'BEANSTALK_DB_PING_AGE', 30):
+        ping = getattr(connection.connection, 'ping', None)
+        if ping is not None:
+            try:
+                ping()
+            except Exception:
+                connection.close()
+                return
+
+    if in_transaction(connection):
+        try:
+            flush_transaction()
+        except DATABASE_ERRORS as e:
+            if not is_disconnect(e):
+                raise
+            # gone while idle
+            connection.close()
+
+
+def close_if_idle():
+    """
+    Close the current thread's connection if it has been idle for more than
+    BEANSTALK_DB_PING_AGE seconds, instead of keeping it open until the
+    database times it out.
+    """
+    connection = db.connections['default']
+    if connection.connection is None:
+        return
+    if time.time() - getattr(_local, 'last_used', 0) > getattr(settings, 'BEANSTALK_DB_PING_AGE', 30):
+        connection.close()
+
+
+def mark_used():
+    """Record that the current thread's connection was just used"""
+    _local.last_used = time.time()
+
+
+def is_disconnect(error):
+    """Whether a database error means the connection is gone"""
+    return isinstance(error, DATABASE_ERRORS) and bool(error.args) and error.args[0] in DISCONNECT_ERRORS
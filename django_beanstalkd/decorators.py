@@ -3,30 +3,48 @@ import json
 import logging
 import sys
 
+import beanstalkc
 from django.conf import settings
 from django.core.mail import send_mail
-from django.db import transaction
 from raven.contrib.django.raven_compat.models import client as raven_client
 
+from . import batching, dedupe, metrics, periodic, registry
+from .cleanup import delete_job_data
 from .client import BeanstalkClient
+from .dbutils import flush_transaction
 from .errors import BeanstalkRetryError
+from .executors import mark_failed
 from .models import JobData
-
-
-@transaction.commit_manually
-def flush_transaction():
-    transaction.commit()
+from .retry import RetryPolicy
 
 
 class beanstalk_job(object):
     """
     Decorator marking a function inside some_app/beanstalk_jobs.py as a
     beanstalk job
+
+    Options can be passed as @beanstalk_job(option=value):
+    uses_db: set to False for jobs that never touch the database, so the
+             worker doesn't prepare a connection for them
+    dedupe_key: drop calls while a job with the same arg is pending (True),
+                or with the same key returned by dedupe_key(arg)
+    weight: share of the workers the job gets while other jobs are waiting
+            too, relative to the others' weights (1)
+    concurrency: at most this many of the job run at the same time in the
+                 workers of a beanstalk_worker command
     """
 
-    def __init__(self, f):
+    def __new__(cls, *args, **options):
+        if not args and options:
+            return lambda f: cls(f, **options)
+        return super(beanstalk_job, cls).__new__(cls)
+
+    def __init__(self, f, uses_db=True, dedupe_key=None, weight=1, concurrency=None):
         modname = f.__module__
         self.f = f
+        self.uses_db = uses_db
+        self.weight = weight
+        self.concurrency = concurrency
         self.__name__ = f.__name__
         self.__module__ = modname
 
@@ -37,27 +55,70 @@ class beanstalk_job(object):
         else:
             self.app = ''
 
-        # store function in per-app job list (to be picked up by a worker)
-        __import__(modname)
+        # register the job by name (to be picked up by a worker), and keep
+        # the per-module job list of older versions
+        registry.register(self)
         bs_module = sys.modules[modname]
         try:
-            if self not in bs_module.beanstalk_job_list:
-                bs_module.beanstalk_job_list.append(self)
+            bs_module.beanstalk_job_list.append(self)
         except AttributeError:
             bs_module.beanstalk_job_list = [self]
 
+        if dedupe_key:
+            dedupe.register(self.get_job_name(), dedupe_key)
+
     def __call__(self, arg):
         # call function with argument passed by the client only
         return self.f(arg)
 
+    def get_job_name(self):
+        try:
+            return settings.BEANSTALK_JOB_NAME % {
+                u'app': self.app,
+                u'job': self.__name__,
+            }
+        except AttributeError:
+            return u"{}.{}".format(self.app, self.__name__)
+
+
+class periodic_beanstalk_job(object):
+    """
+    A beanstalk job that's also put on a schedule by the scheduler of
+    "beanstalk_worker --periodic", either every so many seconds (or a
+    timedelta) or according to a cron expression, with arg as its argument.
+    Other options are those of beanstalk_job.
+    """
+
+    def __init__(self, every=None, cron=None, arg='', priority=beanstalkc.DEFAULT_PRIORITY,
+                 ttr=beanstalkc.DEFAULT_TTR, **options):
+        if (every is None) == (cron is None):
+            raise ValueError("Pass either every or cron")
+        self.schedule = periodic.Every(every) if every is not None else periodic.Cron(cron)
+        self.arg = arg
+        self.priority = priority
+        self.ttr = ttr
+        self.options = options
+
+    def __call__(self, f):
+        job = beanstalk_job(f, **self.options)
+        periodic.register(periodic.PeriodicJob(job.get_job_name(), self.schedule, self.arg, self.priority, self.ttr))
+        return job
+
 
 class backoff_beanstalk_job(object):
-    def __init__(self, max_retries, delay=0, priority=1, ttr=3600, warn_after=None):
+    def __init__(self, max_retries, delay=0, priority=1, ttr=3600, warn_after=None, uses_db=True, dedupe_key=None,
+                 retry_policy=None, circuit_breaker=None, weight=1, concurrency=None):
         self.max_retries = max_retries
         self.warn_after = warn_after
         self.delay = delay
         self.priority = priority
         self.ttr = ttr
+        self.uses_db = uses_db
+        self.dedupe_key = dedupe_key
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.weight = weight
+        self.concurrency = concurrency
 
         self.beanstalk_job = None
 
@@ -67,8 +128,9 @@ class backoff_beanstalk_job(object):
             u"""A retryable beanstalk job.
 
             Like a normal beanstalk job, except that it will attempt to retry
-            the job for a max number of retries using an exponential backoff
-            algorithm when BeanstalkRetry exceptions are thrown.
+            the job for a max number of retries, waiting as long as the retry
+            policy says, when BeanstalkRetry exceptions are thrown. Its
+            outcomes are reported to the circuit breaker, if any.
 
             It also forces the wrapped function to take a dictionary vs a
             string. The job is still created with a string argument, but the
@@ -76,25 +138,26 @@ class backoff_beanstalk_job(object):
             """
 
             def __init__(instance):
-                super(wrapper, instance).__init__(f)
+                super(wrapper, instance).__init__(f, uses_db=self.uses_db, dedupe_key=self.dedupe_key,
+                                                  weight=self.weight, concurrency=self.concurrency)
 
             def __call__(instance, arg):
                 try:
                     data = json.loads(arg)
                     attempt = int(data.pop(u'__attempt', 0))
+                    previous_delay = data.pop(u'__delay', None)
                 except (TypeError, ValueError) as e:
                     return instance.f(arg)
 
+                job = instance.get_job_name()
                 try:
-                    return instance.f(data)
+                    val = instance.f(data)
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record(job, True)
+                    return val
                 except BeanstalkRetryError as e:
-                    try:
-                        job = settings.BEANSTALK_JOB_NAME % {
-                            u'app': instance.app,
-                            u'job': instance.__name__,
-                        }
-                    except AttributeError:
-                        job = u"{}.{}".format(instance.app, instance.__name__)
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record(job, False)
 
                     if attempt < self.max_retries:
                         if self.warn_after is not None and attempt == (self.warn_after - 1):
@@ -110,11 +173,16 @@ class backoff_beanstalk_job(object):
                             }
                             raven_client.captureMessage(msg, data=warn_data, stack=True, level=logging.WARN)
 
+                        delay = self.retry_policy.delay(attempt, previous_delay)
                         data[u'__attempt'] = attempt + 1
+                        data[u'__delay'] = delay
 
+                        metrics.incr('jobs_retried', job)
                         beanstalk_client = BeanstalkClient()
-                        beanstalk_client.call(job, json.dumps(data), delay=(2 ** attempt), priority=self.priority, ttr=self.ttr)
+                        beanstalk_client.call_again(job, json.dumps(data), delay=delay, priority=self.priority,
+                                                    ttr=self.ttr)
                     else:
+                        mark_failed()
                         msg = u"Exceeded max retry attempts for {}.".format(job)
                         error_data = e.data if e.data is not None else {}
                         raven_client.captureMessage(msg, data=error_data, stack=True)
@@ -122,14 +190,101 @@ class backoff_beanstalk_job(object):
                         if e.should_email:
                             send_mail(e.email_subject, e.email_body, settings.DEFAULT_FROM_EMAIL, [e.email_address], fail_silently=False)
                 except Exception as e:
+                    mark_failed()
                     raven_client.captureException()
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record(job, False)
+
+        return wrapper()
+
+
+class batched_beanstalk_job(object):
+    def __init__(self, max_items=100, max_wait=500, max_retries=0, ttr=3600, uses_db=True, retry_policy=None,
+                 weight=1, concurrency=None):
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.ttr = ttr
+        self.uses_db = uses_db
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.weight = weight
+        self.concurrency = concurrency
+
+    def __call__(self, f):
+
+        class wrapper(beanstalk_job):
+            u"""A beanstalk job handling many items at once.
+
+            Clients queue the items one by one with
+            BeanstalkClient.call_batched, which puts them as a single job of
+            at most max_items items once max_wait milliseconds have passed.
+            The wrapped function is called with the list of items. It may
+            return a dict mapping the index of each item that failed to its
+            error (an exception or a message); if it raises, all items failed.
+
+            Failed items are put again as a new batch after the delay of the
+            retry policy, up to max_retries times, and are then reported one by
+            one. The job itself always succeeds, so a bad item never buries
+            the rest of its batch.
+            """
+
+            def __init__(instance):
+                super(wrapper, instance).__init__(f, uses_db=self.uses_db, weight=self.weight,
+                                                  concurrency=self.concurrency)
+                batching.register(instance.get_job_name(), self.max_items, self.max_wait)
+
+            def __call__(instance, arg):
+                job = instance.get_job_name()
+                try:
+                    items, attempt, previous_delay = batching.decode_batch(arg)
+                except (TypeError, ValueError, KeyError, AttributeError):
+                    mark_failed()
+                    raven_client.captureMessage(u"Invalid batch for {}.".format(job), extra={'Body': arg}, stack=True)
+                    return
+
+                failed = []
+                for start in range(0, len(items), self.max_items):
+                    chunk = items[start:start + self.max_items]
+                    try:
+                        errors = instance.f(chunk) or {}
+                    except Exception as e:
+                        raven_client.captureException()
+                        errors = dict((index, e) for index in range(len(chunk)))
+                    failed.extend((chunk[index], error) for index, error in sorted(errors.items()))
+
+                metrics.incr('batch_items', job, len(items))
+                if not failed:
+                    return
+                metrics.incr('batch_items_failed', job, len(failed))
+
+                if attempt < self.max_retries:
+                    metrics.incr('jobs_retried', job)
+                    delay = self.retry_policy.delay(attempt, previous_delay)
+                    beanstalk_client = BeanstalkClient()
+                    beanstalk_client.call_again(job, batching.encode_batch([item for item, error in failed], attempt + 1, delay),
+                                                delay=delay, ttr=self.ttr)
+                else:
+                    mark_failed()
+                    for item, error in failed:
+                        error_data = {
+                            'extra': {
+                                'Job': job,
+                                'Item': item,
+                                'Error': repr(error),
+                                'Attempt number': attempt,
+                            }
+                        }
+                        raven_client.captureMessage(u"Batch item failed for {}.".format(job), data=error_data)
 
         return wrapper()
 
 
 class data_beanstalk_job(object):
-    def __init__(self, cleanup=True):
+    def __init__(self, cleanup=True, dedupe_key=None, weight=1, concurrency=None):
         self.cleanup = cleanup
+        self.dedupe_key = dedupe_key
+        self.weight = weight
+        self.concurrency = concurrency
 
     def __call__(self, f):
 
@@ -137,20 +292,22 @@ class data_beanstalk_job(object):
             u"""A beanstalk job where the data for job is stored in db."""
 
             def __init__(instance):
-                super(wrapper, instance).__init__(f)
+                super(wrapper, instance).__init__(f, dedupe_key=self.dedupe_key, weight=self.weight,
+                                                  concurrency=self.concurrency)
 
             def __call__(instance, pk_str):
                 try:
-                    flush_transaction()
                     pk = int(pk_str)
                     data = JobData.objects.get(pk=pk)
                 except (TypeError, ValueError):
+                    mark_failed()
                     error_msg = "Invalid value for pk"
                     error_extra = {
                         "pk tried": pk_str
                     }
                     raven_client.captureMessage(error_msg, extra=error_extra, stack=True)
                 except JobData.DoesNotExist:
+                    mark_failed()
                     error_msg = "Unable to find beanstalk job data."
                     error_extra = {
                         "pk tried": pk
@@ -160,40 +317,46 @@ class data_beanstalk_job(object):
                     try:
                         val = instance.f(data)
                         if self.cleanup:
-                            data.delete()
+                            delete_job_data(data.pk)
                         return val
                     except Exception:
+                        mark_failed()
                         raven_client.captureException()
 
         return wrapper()
 
 
 class retry_data_beanstalk_job(object):
-    def __init__(self, max_retries, ttr=3600, cleanup=True):
+    def __init__(self, max_retries, ttr=3600, cleanup=True, retry_policy=None, circuit_breaker=None, weight=1,
+                 concurrency=None):
         self.max_retries = max_retries
         self.ttr = ttr
         self.cleanup = cleanup
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.weight = weight
+        self.concurrency = concurrency
 
     def get_decorator(self):
         class retry_data_beanstalk_job_decorator(beanstalk_job):
 
             def __init__(instance, f):
-                super(retry_data_beanstalk_job_decorator, instance).__init__(f)
-                instance.attempt = None
-                instance.beanstalk_data = None
-                instance.jobdata_pk = None
+                super(retry_data_beanstalk_job_decorator, instance).__init__(f, weight=self.weight,
+                                                                             concurrency=self.concurrency)
 
             def __call__(instance, beanstalk_data_str):
-
-                if not instance.load_beanstalk_data(beanstalk_data_str):
+                # the decorator instance is shared by the jobs a threads or
+                # gevent worker runs at the same time, so the job's state is
+                # passed around instead of being stored on it
+                beanstalk_data = instance.load_beanstalk_data(beanstalk_data_str)
+                if beanstalk_data is None:
+                    mark_failed()
                     return
 
-                flush_transaction()
-
                 try:
-                    data = JobData.objects.get(pk=instance.jobdata_pk)
+                    data = JobData.objects.get(pk=beanstalk_data["jobdata_pk"])
                 except JobData.DoesNotExist:
-                    instance.handle_missing_data()
+                    instance.handle_missing_data(beanstalk_data)
                 else:
                     instance.run_job(data)
 
@@ -212,13 +375,11 @@ class retry_data_beanstalk_job(object):
                 return job
 
             def load_beanstalk_data(instance, beanstalk_data_str):
+                """Returns the job's data, with its jobdata_pk, or None if it's invalid"""
                 try:
                     beanstalk_data = json.loads(beanstalk_data_str)
-
-                    instance.beanstalk_data = beanstalk_data
-                    instance.jobdata_pk = beanstalk_data["jobdata_pk"]
-                    instance.attempt = beanstalk_data.get("attempt", 1)
-                    return True
+                    beanstalk_data["jobdata_pk"]
+                    return beanstalk_data
                 except (TypeError, ValueError):
                     error_msg = "Unable to load json data."
                     culprit = instance.get_sentry_culprit("load_beanstalk_data")
@@ -240,29 +401,41 @@ class retry_data_beanstalk_job(object):
                     }
                     raven_client.captureMessage(error_msg, data=error_data, stack=True)
 
-                return False
+                return None
 
             def get_sentry_culprit(instance, *args):
                 culprit = '.'.join([instance.__class__.__name__] + list(args))
                 return culprit
 
-            def handle_missing_data(instance):
-                job = instance.get_job_name()
-                if instance.attempt < self.max_retries:
-                    instance.beanstalk_data['attempt'] = instance.attempt + 1
+            def record(instance, succeeded):
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record(instance.get_job_name(), succeeded)
 
-                    backoff = 2 ** instance.attempt
+            def handle_missing_data(instance, beanstalk_data):
+                # Not a failure of the dependency the circuit breaker
+                # watches, usually the row just isn't visible yet. That's
+                # rare since puts made in a transaction wait for the commit,
+                # see django_beanstalkd.deferred.
+                job = instance.get_job_name()
+                metrics.incr('jobs_missing_data', job)
+                attempt = beanstalk_data.get("attempt", 1)
+                if attempt < self.max_retries:
+                    backoff = self.retry_policy.delay(attempt, beanstalk_data.get('delay'))
+                    beanstalk_data['attempt'] = attempt + 1
+                    beanstalk_data['delay'] = backoff
+                    metrics.incr('jobs_retried', job)
                     beanstalk_client = BeanstalkClient()
-                    beanstalk_client.call(job, json.dumps(instance.beanstalk_data), delay=backoff, ttr=self.ttr)
+                    beanstalk_client.call_again(job, json.dumps(beanstalk_data), delay=backoff, ttr=self.ttr)
                 else:
+                    mark_failed()
                     msg = u"Exceeded max retry attempts for {}.".format(job)
                     culprit = instance.get_sentry_culprit("handle_missing_data")
                     error_data = {
                         "culprit": culprit,
                         "extra": {
                             "Job name": job,
-                            "Attempt number": instance.attempt,
-                            "Beanstalk Data": instance.beanstalk_data,
+                            "Attempt number": attempt,
+                            "Beanstalk Data": beanstalk_data,
                         }
                     }
                     raven_client.captureMessage(msg, data=error_data, stack=True)
@@ -271,10 +444,13 @@ class retry_data_beanstalk_job(object):
                 try:
                     val = instance.f(job_data_instance.data_dict)
                     if self.cleanup:
-                        job_data_instance.delete()
+                        delete_job_data(job_data_instance.pk)
+                    instance.record(True)
                     return val
                 except Exception:
+                    mark_failed()
                     raven_client.captureException()
+                    instance.record(False)
         return retry_data_beanstalk_job_decorator
 
     def __call__(self, f):
@@ -0,0 +1,161 @@
+"""
+Dropping duplicates of pending jobs.
+
+A job put with a dedupe key claims the key in a store until a worker deletes
+or buries it (the key travels in the job envelope), or BEANSTALK_DEDUPE_TTL
+seconds have passed. Putting another job for the same function with the same
+key in the meantime does nothing. Dedupe keys need BEANSTALK_JOB_ENVELOPE =
+True; without it, claim raises ImproperlyConfigured. Stores:
+
+    'cache'   the Django cache BEANSTALK_DEDUPE_CACHE ('default'), which must
+              be shared by clients and workers, like memcached or redis.
+              A process-local cache (locmem, dummy) is refused: keys claimed
+              by a client could never be released by the workers.
+    'memory'  an LRU of at most BEANSTALK_DEDUPE_MAX_KEYS keys per process.
+              Workers can't release its keys, so it only coalesces the calls
+              a process makes within BEANSTALK_DEDUPE_MEMORY_TTL seconds (5).
+
+or the dotted path of a class with add(key, ttl) and delete(key) methods.
+"""
+import collections
+import hashlib
+import importlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import envelope, metrics
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+PREFIX = 'beanstalk-dedupe:'
+
+
+def get_shared_cache(alias):
+    """
+    Returns the Django cache alias, raising ImproperlyConfigured if it's local
+    to the process and so can't coordinate clients and workers
+    """
+    from django.core.cache import get_cache
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+    cache = get_cache(alias)
+    if isinstance(cache, (DummyCache, LocMemCache)):
+        raise ImproperlyConfigured("The cache %r is local to the process; beanstalk clients and workers need a "
+                                   "shared one like memcached or redis" % alias)
+    return cache
+
+
+class CacheStore(object):
+    def __init__(self, alias=None):
+        self.cache = get_shared_cache(alias or getattr(settings, 'BEANSTALK_DEDUPE_CACHE', 'default'))
+
+    def add(self, key, ttl):
+        """Store key unless it's there already; returns whether it was stored"""
+        return self.cache.add(key, 1, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class MemoryStore(object):
+    def __init__(self, max_keys=None, ttl=None):
+        self.max_keys = max_keys or getattr(settings, 'BEANSTALK_DEDUPE_MAX_KEYS', 10000)
+        self.ttl = ttl or getattr(settings, 'BEANSTALK_DEDUPE_MEMORY_TTL', 5)
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()  # key -> expiry, least recently added first
+
+    def add(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            if self._keys.get(key, 0) > now:
+                return False
+            self._keys.pop(key, None)
+            # released by workers in other processes, so keys only live shortly
+            self._keys[key] = now + min(ttl, self.ttl)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+STORES = {
+    'cache': CacheStore,
+    'memory': MemoryStore,
+}
+
+_store = None
+# job name -> dedupe_key option of the decorator
+_options = {}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        path = getattr(settings, 'BEANSTALK_DEDUPE_STORE', 'cache')
+        if path in STORES:
+            _store = STORES[path]()
+        else:
+            module, name = path.rsplit('.', 1)
+            _store = getattr(importlib.import_module(module), name)()
+    return _store
+
+
+def set_store(store):
+    """Use store instead of the configured one, e.g. in tests"""
+    global _store
+    _store = store
+
+
+def register(job_name, dedupe_key):
+    _options[job_name] = dedupe_key
+
+
+def resolve(func, arg, dedupe_key=None):
+    """
+    Returns the dedupe key of a call: dedupe_key if given, otherwise the one
+    the job's decorator derives from arg, or None.
+    """
+    if dedupe_key is not None:
+        return dedupe_key
+    option = _options.get(func)
+    if callable(option):
+        return option(arg)
+    if option:
+        return arg if isinstance(arg, basestring) else json.dumps(arg, sort_keys=True)
+    return None
+
+
+def claim(func, dedupe_key):
+    """
+    Claims dedupe_key for a new job of func. Returns the hashed key to put into
+    the job envelope, or None if a job with that key is still pending.
+    """
+    # without the envelope, workers couldn't release the key
+    envelope.require("Dedupe keys")
+    if isinstance(dedupe_key, unicode):
+        dedupe_key = dedupe_key.encode('utf-8')
+    key = hashlib.md5('%s\0%s' % (str(func), dedupe_key)).hexdigest()
+    if get_store().add(PREFIX + key, getattr(settings, 'BEANSTALK_DEDUPE_TTL', 3600)):
+        metrics.incr('dedupe_misses', func)
+        return key
+    metrics.incr('dedupe_hits', func)
+    return None
+
+
+def release(key):
+    """Releases a key returned by claim, once its job is done or wasn't put"""
+    if key is None:
+        return
+    try:
+        get_store().delete(PREFIX + key)
+    except Exception:
+        logger.exception("Unable to release dedupe key %s" % key)
@@ -0,0 +1,154 @@
+"""
+Puts deferred until the transaction commits.
+
+A job put inside an atomic block can be reserved by a worker before the
+transaction commits, and then doesn't see the rows it's about to be given,
+e.g. its JobData row. So the clients don't put jobs called inside an atomic
+block right away, but keep them with the database connection. When the
+transaction commits, they are put in one pipelined batch per tube. When it
+rolls back, or the savepoint of the atomic block they were called in rolls
+back, they are dropped.
+
+Django 1.6 has no commit hooks, so the connection's commit, rollback,
+savepoint_rollback and close methods are wrapped the first time a put is
+deferred on it. Puts made in a transaction that isn't an atomic block, e.g.
+under commit_manually, aren't deferred.
+
+Turn it off with
+
+    BEANSTALK_DEFER_ON_COMMIT = False
+
+or per client with BeanstalkClient(defer=False).
+"""
+import collections
+import logging
+
+from django.conf import settings
+from django.db import connections
+from raven.contrib.django.raven_compat.models import client as raven_client
+
+from . import dedupe, envelope, groups, metrics
+from .errors import BeanstalkBatchError
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class DeferredPut(object):
+    __slots__ = ('client', 'func', 'body', 'priority', 'delay', 'ttr', 'dedupe_key', 'savepoints')
+
+    def __init__(self, client, func, body, priority, delay, ttr, dedupe_key, savepoints):
+        self.client = client
+        self.func = func
+        self.body = body
+        self.priority = priority
+        self.delay = delay
+        self.ttr = ttr
+        self.dedupe_key = dedupe_key
+        # the savepoints of the atomic blocks the put was called in
+        self.savepoints = savepoints
+
+
+def enabled(defer=None):
+    if defer is None:
+        return getattr(settings, 'BEANSTALK_DEFER_ON_COMMIT', True)
+    return defer
+
+
+def in_atomic_block(using):
+    return getattr(connections[using], 'in_atomic_block', False)
+
+
+def defer(using, client, func, body, priority, delay, ttr, dedupe_key=None):
+    """Put body in tube func when the transaction of connection using commits"""
+    connection = connections[using]
+    pending = getattr(connection, 'beanstalk_pending', None)
+    if pending is None:
+        pending = connection.beanstalk_pending = []
+        _install_hooks(connection)
+    pending.append(DeferredPut(client, func, body, priority, delay, ttr, dedupe_key,
+                               frozenset(sid for sid in connection.savepoint_ids if sid is not None)))
+
+
+def pending_count(using):
+    return len(getattr(connections[using], 'beanstalk_pending', None) or ())
+
+
+def _install_hooks(connection):
+    commit = connection.commit
+    rollback = connection.rollback
+    savepoint_rollback = connection.savepoint_rollback
+    close = connection.close
+
+    def commit_and_put():
+        commit()
+        flush(connection)
+
+    def rollback_and_drop():
+        try:
+            rollback()
+        finally:
+            _drop(connection, lambda put: True)
+
+    def savepoint_rollback_and_drop(sid):
+        savepoint_rollback(sid)
+        _drop(connection, lambda put: sid in put.savepoints)
+
+    def close_and_drop():
+        try:
+            close()
+        finally:
+            # an open transaction is lost with the connection
+            _drop(connection, lambda put: True)
+
+    connection.commit = commit_and_put
+    connection.rollback = rollback_and_drop
+    connection.savepoint_rollback = savepoint_rollback_and_drop
+    connection.close = close_and_drop
+
+
+def _drop(connection, which):
+    pending = connection.beanstalk_pending
+    dropped = [put for put in pending if which(put)]
+    if not dropped:
+        return
+    connection.beanstalk_pending = [put for put in pending if not which(put)]
+    for put in dropped:
+        dedupe.release(put.dedupe_key)
+
+
+def flush(connection):
+    """Put the jobs deferred on connection, one pipelined batch per tube and put options"""
+    pending = connection.beanstalk_pending
+    if not pending:
+        return
+    connection.beanstalk_pending = []
+
+    batches = collections.OrderedDict()
+    for put in pending:
+        # clients of the same servers share their router
+        key = (put.client._router, put.func, put.priority, put.delay, put.ttr)
+        batches.setdefault(key, []).append(put)
+    for (router, func, priority, delay, ttr), puts in batches.items():
+        # the transaction is committed already, so errors are reported instead of raised
+        try:
+            puts[0].client._put_many(func, [put.body for put in puts], priority, delay, ttr)
+        except BeanstalkBatchError as e:
+            failed = [puts[index] for index, status in e.failures]
+            unused = [puts[index] for index, status in e.failures if status not in ('BURIED', 'SOCKET_ERROR')]
+            _report(func, puts, failed, unused)
+        except Exception:
+            _report(func, puts, puts, puts)
+
+
+def _report(func, puts, failed, unused):
+    logger.exception("Unable to put %d of %d jobs of %s after the commit" % (len(failed), len(puts), func))
+    raven_client.captureException(extra={'Job name': func, 'Jobs': len(puts), 'Failed': len(failed)})
+    metrics.incr('jobs_lost', func, len(failed))
+    # the keys of the jobs that were certainly not created
+    for put in unused:
+        dedupe.release(put.dedupe_key)
+    # groups missing a member can't complete
+    members = [envelope.unwrap(put.body)[4] for put in failed]
+    for group_id in set(member[0] for member in members if member is not None):
+        groups.forget(group_id)
@@ -0,0 +1,148 @@
+"""
+Self-describing job bodies.
+
+With BEANSTALK_JOB_ENVELOPE = True, BeanstalkClient prefixes every body
+with the name of the tube it's put into, so a worker can tell which job to
+run without asking beanstalkd for the job's stats. Tube names can't contain
+"@", "#", "!" or the control characters delimiting the header, which also
+tells how the body is stored:
+
+    \\0<tube>\\0<body>   the body as it was passed to the client
+    \\0<tube>\\1<data>   the body compressed, see serializers.compress_body
+    \\0<tube>\\2<pk>     the body didn't fit into a job and is stored as the
+                       JobData row pk, see serializers.encode_body
+
+When metrics are enabled, the tube is followed by @<milliseconds since the
+epoch> at which the job was put, so workers can measure how long it waited.
+Jobs put with a dedupe key carry #<hashed key>, released by the worker once
+the job is done. Members of a job group carry !<group id>:<index>, see
+django_beanstalkd.groups.
+
+Bodies larger than BEANSTALK_SPILL_THRESHOLD bytes (default 60000, a little
+below beanstalkd's default max-job-size) are stored in the database. Setting
+BEANSTALK_SPILL_THRESHOLD without the envelope raises ImproperlyConfigured.
+
+Older workers and other consumers of the tubes don't understand the header,
+so it's off by default. Bodies without the header are still understood; the
+worker falls back to a stats-job round trip for them.
+"""
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import serializers
+from .models import JobData
+
+
+MARKER = '\0'
+RAW = '\0'
+ENCODED = '\1'
+SPILLED = '\2'
+
+_header = re.compile(r'\0([^\0\1\2@#!]*)(?:@(\d+))?(?:#([0-9a-f]+))?(?:!([0-9a-f]+):(\d+))?([\0\1\2])')
+
+
+class SpilledBody(object):
+    """Body of a job stored in the database, loaded when the job runs"""
+
+    def __init__(self, pk):
+        self.pk = pk
+
+    def load(self):
+        return serializers.decode_body(JobData.objects.get(pk=self.pk).data)
+
+    def __str__(self):
+        return '<job data %s>' % self.pk
+
+
+def enabled():
+    """Whether clients wrap the bodies they put"""
+    if getattr(settings, 'BEANSTALK_JOB_ENVELOPE', False):
+        return True
+    if getattr(settings, 'BEANSTALK_SPILL_THRESHOLD', None) is not None:
+        require("Spilling large bodies (BEANSTALK_SPILL_THRESHOLD)")
+    return False
+
+
+def require(feature):
+    """Raises ImproperlyConfigured unless the envelope is on; feature needs it"""
+    if not getattr(settings, 'BEANSTALK_JOB_ENVELOPE', False):
+        raise ImproperlyConfigured("%s needs BEANSTALK_JOB_ENVELOPE = True" % feature)
+
+
+def wrap(tube, body, enqueued_at=None, dedupe_key=None, member=None):
+    """
+    Returns body prefixed with the tube header, compressed or spilled if it's
+    large. member is the (group id, index) of a job group member.
+    """
+    # job names built by the decorators are unicode; tube names are ascii
+    tube = str(tube)
+    if enqueued_at is not None:
+        header = '%s%s@%d' % (MARKER, tube, enqueued_at * 1000)
+    else:
+        header = MARKER + tube
+    if dedupe_key is not None:
+        header = '%s#%s' % (header, dedupe_key)
+    if member is not None:
+        header = '%s!%s:%d' % (header, member[0], member[1])
+
+    encoded = serializers.compress_body(body)
+    if encoded is None:
+        wrapped = '%s%s%s' % (header, RAW, body)
+    else:
+        wrapped = '%s%s%s' % (header, ENCODED, encoded)
+
+    if len(wrapped) > getattr(settings, 'BEANSTALK_SPILL_THRESHOLD', 60000):
+        data = JobData(job_name=tube, data=serializers.encode_body(body))
+        data.save()
+        wrapped = '%s%s%d' % (header, SPILLED, data.pk)
+    return wrapped
+
+
+def unwrap(body):
+    """
+    Returns (tube, body, enqueued_at, dedupe_key, member); tube is None if
+    body has no header, enqueued_at is None if the job wasn't timestamped,
+    dedupe_key is None if it wasn't deduplicated and member is None unless
+    it's the (group id, index) of a group member. Bodies stored in the
+    database are returned as a SpilledBody.
+    """
+    match = _header.match(body)
+    if match is None:
+        return None, body, None, None, None
+    tube, enqueued_at, dedupe_key, group_id, index, kind = match.groups()
+    member = (group_id, int(index)) if group_id is not None else None
+    if enqueued_at is not None:
+        enqueued_at = int(enqueued_at) / 1000.0
+    body = body[match.end():]
+    if kind == ENCODED:
+        body = serializers.decode_body(body)
+    elif kind == SPILLED:
+        body = SpilledBody(int(body))
+    return tube, body, enqueued_at, dedupe_key, member
+
+
+def retarget(body, tube):
+    """
+    Returns the already wrapped body with the header of tube, for putting it
+    again. The put time is dropped; bodies without a header are returned as
+    they are.
+    """
+    match = _header.match(body)
+    if match is None:
+        return body
+    header = MARKER + str(tube)
+    if match.group(3) is not None:
+        header = '%s#%s' % (header, match.group(3))
+    if match.group(4) is not None:
+        header = '%s!%s:%s' % (header, match.group(4), match.group(5))
+    return header + body[match.start(6):]
+
+
+def job_tube(job):
+    """Returns (tube, body, enqueued_at, dedupe_key, member) of a reserved beanstalkc job"""
+    tube, body, enqueued_at, dedupe_key, member = unwrap(job.body)
+    if tube is None:
+        tube = job.stats()['tube']
+    return tube, body, enqueued_at, dedupe_key, member
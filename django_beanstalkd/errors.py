@@ -2,6 +2,21 @@ class BeanstalkError(Exception):
     pass
 
 
+class BeanstalkBatchError(BeanstalkError):
+    """
+    Raised by the batch enqueue methods when some of the jobs could not be put.
+
+    job_ids: one entry per submitted job, in order; None where no job was created
+    failures: list of (index, status) tuples for the jobs that failed
+    """
+
+    def __init__(self, job_ids, failures):
+        self.job_ids = job_ids
+        self.failures = failures
+        super(BeanstalkBatchError, self).__init__(
+            "%d of %d jobs failed" % (len(failures), len(job_ids)))
+
+
 class BeanstalkRetryError(Exception):
     def __init__(self, msg='', email_info=None, data=None):
         try:
@@ -0,0 +1,203 @@
+"""
+Bounded pools running jobs concurrently inside one worker process.
+
+Only the thread owning the reserving connection talks to beanstalkd: it
+reserves jobs, hands them to the pool and deletes, buries or touches them
+once the pool reports back. The pool threads only run the job functions.
+
+Workers running one job at a time instead run it on the reserving thread and
+leave touching it to a JobToucher.
+"""
+import logging
+import Queue
+import threading
+import time
+
+from beanstalkc import CommandFailed
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+_local = threading.local()
+
+
+def current_job():
+    """The InFlightJob the current thread is running, or None"""
+    return getattr(_local, 'task', None)
+
+
+def set_current_job(task):
+    _local.task = task
+
+
+def mark_failed():
+    """
+    For decorators reporting a job's errors themselves: the job the current
+    thread runs failed although its function returns. Job group members are
+    buried then, so their group waits until they're kicked and succeed.
+    """
+    task = current_job()
+    if task is not None:
+        task.failed = True
+
+
+class InFlightJob(object):
+    """A reserved job handed to the pool"""
+
+    def __init__(self, job, job_name, body, dedupe_key=None, member=None):
+        self.job = job
+        self.job_name = job_name
+        self.body = body
+        # None once a job put by BeanstalkClient.call_again took them over
+        self.dedupe_key = dedupe_key
+        self.member = member
+        self.started = time.time()
+        self.succeeded = None
+        self.failed = False
+        # set once the job has run long enough to need touching
+        self.ttr = None
+        self.touch_at = None
+
+    def needs_touch(self, now):
+        """Whether touch has to talk to beanstalkd"""
+        if self.ttr is None:
+            # jobs finishing within a second never pay for a stats-job
+            return now - self.started >= 1.0
+        return self.touch_at <= now
+
+    def touch(self, now, margin):
+        """Learn the job's TTR, or touch it margin seconds before it runs out"""
+        try:
+            if self.ttr is None:
+                stats = self.job.stats()
+                self.ttr = stats['ttr']
+                self.touch_at = now + stats['time-left'] - min(margin, self.ttr / 2.0)
+            if self.touch_at <= now:
+                self.job.touch()
+                self.touch_at = now + self.ttr - min(margin, self.ttr / 2.0)
+        except CommandFailed:
+            # the job expired already and may run twice
+            logger.info("Job %s expired before it could be touched" % self.job.jid)
+            self.ttr = self.touch_at = float('inf')
+
+
+class ThreadExecutor(object):
+    """
+    Runs jobs on a fixed number of threads (or greenlets, once gevent has
+    patched the threading module).
+
+    run: callable taking the InFlightJob and returning whether the job
+         succeeded. It's called on the pool threads, so every thread uses its
+         own Django database connection.
+    done: optional callable taking the InFlightJob, called on the pool
+          thread as soon as the job finished
+    """
+
+    def __init__(self, concurrency, run, done=None):
+        self.concurrency = concurrency
+        self.run = run
+        self.done = done
+        self.in_flight = set()  # InFlightJobs, owned by the reserving thread
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        for i in range(concurrency):
+            thread = threading.Thread(target=self._work, name='beanstalk-executor-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                task.succeeded = self.run(task)
+            except Exception:
+                task.succeeded = False
+            if self.done is not None:
+                self.done(task)
+            self._results.put(task)
+
+    def has_capacity(self):
+        return len(self.in_flight) < self.concurrency
+
+    def submit(self, job, job_name, body, dedupe_key=None, member=None):
+        task = InFlightJob(job, job_name, body, dedupe_key, member)
+        self.in_flight.add(task)
+        self._tasks.put(task)
+
+    def finished(self, timeout=0):
+        """
+        Returns the jobs that finished since the last call, waiting up to
+        timeout seconds for the first one.
+        """
+        tasks = []
+        try:
+            if timeout > 0:
+                tasks.append(self._results.get(True, timeout))
+            while True:
+                tasks.append(self._results.get(False))
+        except Queue.Empty:
+            pass
+        for task in tasks:
+            self.in_flight.discard(task)
+        return tasks
+
+
+class JobToucher(object):
+    """
+    Touches the job running on the reserving thread from a background
+    thread, so long jobs aren't handed to another worker when their TTR runs
+    out. Between watch and unwatch, only this thread may use the job's
+    connection.
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self._condition = threading.Condition()
+        self._task = None
+        self._touching = False
+        self._thread = None
+
+    def watch(self, task):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='beanstalk-toucher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._task = task
+            self._condition.notify()
+
+    def unwatch(self):
+        """Stop touching the job; waits for a touch in progress"""
+        with self._condition:
+            self._task = None
+            while self._touching:
+                self._condition.wait()
+
+    def _run(self):
+        with self._condition:
+            while True:
+                task = self._task
+                if task is None:
+                    self._condition.wait()
+                    continue
+                now = time.time()
+                if task.needs_touch(now):
+                    self._touching = True
+                    self._condition.release()
+                    try:
+                        task.touch(now, self.margin)
+                    except Exception:
+                        logger.exception("Unable to touch job %s" % task.job.jid)
+                        task.ttr = task.touch_at = float('inf')
+                    finally:
+                        self._condition.acquire()
+                        self._touching = False
+                        self._condition.notify_all()
+                    continue
+                if task.ttr is None:
+                    self._condition.wait(task.started + 1.0 - now)
+                elif task.touch_at != float('inf'):
+                    self._condition.wait(task.touch_at - now)
+                else:
+                    self._condition.wait()
@@ -0,0 +1,331 @@
+"""
+Job groups: fan-out with a callback once all members are done.
+
+    group_id = client.call_group('myapp.index_shard', shards, callback='myapp.merge_shards')
+
+puts a job of myapp.index_shard per arg of shards, tagged with the group id
+and its index in the group. When a worker finishes a member, it records the
+value the job returned in the group backend. The worker that records the
+last one puts the callback job with the argument
+
+    {"group_id": "...", "results": [result of member 0, result of member 1, ...]}
+
+as JSON, so results must be small and JSON serializable. Without a callback,
+the results can be read with get_results(group_id) until the group expires.
+A member that fails is buried as usual and the group completes once it has
+been kicked and succeeded; so is a member whose decorator reported its error
+itself. A retry put by a decorator takes its job's place in the group, which
+completes once the retry succeeds. If a worker dies right after recording a
+member, the member is run again and counted or the callback put then, so
+like any job the callback may run twice.
+
+If putting the members fails, call_group forgets the group and raises, so
+the members that were put record their results for nothing and the group
+can be called again. When the puts were deferred until a transaction
+commits, the error is logged instead, see django_beanstalkd.deferred.
+
+Backends, chosen with BEANSTALK_GROUP_BACKEND:
+
+    'cache'     (default) the Django cache BEANSTALK_GROUP_CACHE ('default'),
+                which must be shared by the workers and have atomic
+                increments, like memcached or redis; a local memory, dummy,
+                file based or database cache raises ImproperlyConfigured.
+                Entries expire after BEANSTALK_GROUP_TTL seconds (one day).
+    'database'  the JobGroup and JobGroupResult tables. Workers record the
+                members they finished in batches, every
+                BEANSTALK_GROUP_FLUSH_INTERVAL seconds (1) or once
+                BEANSTALK_GROUP_FLUSH_BATCH (100) are pending, and before
+                they exit. A worker that is killed loses the results it
+                hasn't recorded yet, which leaves their groups incomplete.
+
+or the dotted path of a class with the methods of CacheBackend.
+"""
+import importlib
+import json
+import logging
+import threading
+import time
+
+import beanstalkc
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import F
+
+from . import dedupe, metrics, serializers
+from .models import JobGroup, JobGroupResult
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+PREFIX = 'beanstalk-group:'
+
+
+def get_counting_cache(alias):
+    """
+    Like dedupe.get_shared_cache, also raising ImproperlyConfigured if the
+    cache's incr isn't atomic and so loses counts
+    """
+    from django.core.cache.backends.db import DatabaseCache
+    from django.core.cache.backends.filebased import FileBasedCache
+    cache = dedupe.get_shared_cache(alias)
+    if isinstance(cache, (DatabaseCache, FileBasedCache)):
+        raise ImproperlyConfigured("The cache %r has no atomic increments; job groups need a cache like memcached "
+                                   "or redis, or BEANSTALK_GROUP_BACKEND = 'database'" % alias)
+    return cache
+
+
+class CacheBackend(object):
+    def __init__(self, alias=None, ttl=None):
+        self.cache = get_counting_cache(alias or getattr(settings, 'BEANSTALK_GROUP_CACHE', 'default'))
+        self.ttl = ttl or getattr(settings, 'BEANSTALK_GROUP_TTL', 86400)
+
+    def _key(self, group_id, suffix):
+        return '%s%s:%s' % (PREFIX, group_id, suffix)
+
+    def start(self, group_id, size, callback):
+        """Record a new group of size members; callback is None or (job name, priority, ttr)"""
+        self.cache.set_many({
+            self._key(group_id, 'meta'): (size, callback),
+            self._key(group_id, 'done'): 0,
+        }, self.ttl)
+
+    def complete(self, completions):
+        """
+        Record the results of finished members, a list of (group id, index,
+        result). Returns the ids of the groups that are complete now.
+        """
+        complete = []
+        for group_id, index, result in completions:
+            meta = self.cache.get(self._key(group_id, 'meta'))
+            if meta is None:
+                logger.warning("Job group %s is unknown or expired" % group_id)
+                continue
+            size = meta[0]
+            if self.cache.add(self._key(group_id, index), (result,), self.ttl):
+                done = self.cache.incr(self._key(group_id, 'done'))
+                if done < size and self.cache.get(self._key(group_id, 'recount')):
+                    done = self._count(group_id, size)
+            else:
+                # The member ran again: its worker may have died before
+                # putting the callback, or before counting the member, which
+                # leaves the counter short. So the members themselves are
+                # counted, from now on by the other members too.
+                self.cache.set(self._key(group_id, 'recount'), True, self.ttl)
+                done = self._count(group_id, size)
+            if done >= size:
+                complete.append(group_id)
+        return complete
+
+    def _count(self, group_id, size):
+        """The number of members recorded, from their keys"""
+        return len(self.cache.get_many([self._key(group_id, index) for index in range(size)]))
+
+    def get(self, group_id):
+        """Returns (callback, results of the members so far, None for the others), or None if the group is unknown"""
+        meta = self.cache.get(self._key(group_id, 'meta'))
+        if meta is None:
+            return None
+        size, callback = meta
+        keys = [self._key(group_id, index) for index in range(size)]
+        found = self.cache.get_many(keys)
+        return callback, [found[key][0] if key in found else None for key in keys]
+
+    def forget(self, group_id):
+        meta = self.cache.get(self._key(group_id, 'meta'))
+        keys = [self._key(group_id, 'meta'), self._key(group_id, 'done'), self._key(group_id, 'recount')]
+        if meta is not None:
+            keys += [self._key(group_id, index) for index in range(meta[0])]
+        self.cache.delete_many(keys)
+
+
+class DatabaseBackend(object):
+    def start(self, group_id, size, callback):
+        JobGroup.objects.create(group_id=group_id, size=size, callback=json.dumps(callback))
+
+    def complete(self, completions):
+        by_group = {}
+        for group_id, index, result in completions:
+            by_group.setdefault(group_id, {})[index] = result
+        complete = []
+        for group_id, results in by_group.items():
+            with transaction.atomic():
+                # the lock makes exactly one worker see the group complete
+                group = JobGroup.objects.select_for_update().filter(group_id=group_id).first()
+                if group is None:
+                    logger.warning("Job group %s is unknown or expired" % group_id)
+                    continue
+                recorded = set(JobGroupResult.objects.filter(group=group, index__in=results.keys())
+                                                     .values_list('index', flat=True))
+                new = [JobGroupResult(group=group, index=index, result=serializers.dumps(result))
+                       for index, result in results.items() if index not in recorded]
+                if new:
+                    JobGroupResult.objects.bulk_create(new)
+                    JobGroup.objects.filter(group_id=group_id).update(done=F('done') + len(new))
+                    group.done += len(new)
+            if group.done >= group.size:
+                complete.append(group_id)
+        return complete
+
+    def get(self, group_id):
+        group = JobGroup.objects.filter(group_id=group_id).first()
+        if group is None:
+            return None
+        results = [None] * group.size
+        for index, result in JobGroupResult.objects.filter(group=group).values_list('index', 'result'):
+            results[index] = serializers.loads(result)
+        return json.loads(group.callback), results
+
+    def forget(self, group_id):
+        JobGroupResult.objects.filter(group_id=group_id).delete()
+        JobGroup.objects.filter(group_id=group_id).delete()
+
+
+BACKENDS = {
+    'cache': CacheBackend,
+    'database': DatabaseBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'BEANSTALK_GROUP_BACKEND', 'cache')
+        if path in BACKENDS:
+            _backend = BACKENDS[path]()
+        else:
+            module, name = path.rsplit('.', 1)
+            _backend = getattr(importlib.import_module(module), name)()
+    return _backend
+
+
+def set_backend(backend):
+    """Use backend instead of the configured one, e.g. in tests"""
+    global _backend
+    _backend = backend
+
+
+def start(group_id, size, callback=None, priority=beanstalkc.DEFAULT_PRIORITY, ttr=beanstalkc.DEFAULT_TTR):
+    get_backend().start(group_id, size, (callback, priority, ttr) if callback else None)
+
+
+def get_results(group_id):
+    """The results of the members of a group, None for those not done; None if the group is unknown"""
+    group = get_backend().get(group_id)
+    return group[1] if group is not None else None
+
+
+def forget(group_id):
+    get_backend().forget(group_id)
+
+
+def put_callback(client, group_id):
+    """Put the callback of a complete group, and forget the group if it has one"""
+    group = get_backend().get(group_id)
+    if group is None:
+        return
+    callback, results = group
+    if callback is None:
+        # kept for get_results until it expires
+        return
+    name, priority, ttr = callback
+    client.call(name, json.dumps({'group_id': group_id, 'results': results}), priority=priority, ttr=ttr)
+    metrics.incr('groups_completed', name)
+    get_backend().forget(group_id)
+
+
+class Recorder(object):
+    """
+    Collects the results of the members finished by a worker. The cache
+    backend records them right away, the database backend in batches.
+    """
+
+    def __init__(self, batch_size=None, interval=None):
+        self._batch_size = batch_size
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._since = None
+
+    @property
+    def batched(self):
+        return isinstance(get_backend(), DatabaseBackend)
+
+    @property
+    def batch_size(self):
+        return self._batch_size or getattr(settings, 'BEANSTALK_GROUP_FLUSH_BATCH', 100)
+
+    @property
+    def interval(self):
+        return self._interval or getattr(settings, 'BEANSTALK_GROUP_FLUSH_INTERVAL', 1)
+
+    def add(self, member, result):
+        """Record the result of the member (group id, index) that finished"""
+        with self._lock:
+            if not self._pending:
+                self._since = time.time()
+            self._pending.append((member[0], member[1], result))
+            batched = self.batched
+            due = (not batched or len(self._pending) >= self.batch_size or
+                   time.time() - self._since >= self.interval)
+        if not due:
+            return
+        if not batched:
+            # failing the job, which is run again once kicked
+            self.flush()
+            return
+        try:
+            self.flush()
+        except Exception:
+            # the job is done, its result is recorded with the next batch
+            logger.exception("Unable to record the results of job group members")
+
+    def flush_if_due(self):
+        with self._lock:
+            due = self._pending and time.time() - self._since >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            completions, self._pending = self._pending, []
+        if not completions:
+            return
+        try:
+            complete = get_backend().complete(completions)
+        except Exception:
+            if self.batched:
+                # try again with the next batch
+                with self._lock:
+                    self._pending = completions + self._pending
+                    self._since = time.time()
+            raise
+        if complete:
+            from .client import BeanstalkClient
+            client = BeanstalkClient()
+            for group_id in complete:
+                put_callback(client, group_id)
+
+
+recorder = Recorder()
+
+
+def record(member, result):
+    recorder.add(member, result)
+
+
+def flush():
+    """Record pending results, e.g. before the worker exits"""
+    try:
+        recorder.flush()
+    except Exception:
+        logger.exception("Unable to record the results of job group members")
+
+
+def flush_if_due():
+    try:
+        recorder.flush_if_due()
+    except Exception:
+        logger.exception("Unable to record the results of job group members")
@@ -0,0 +1,65 @@
+"""
+Hooks around the jobs run by the worker.
+
+    BEANSTALK_JOB_HOOKS = ['myapp.hooks.Tracing']
+
+lists dotted paths of JobHook classes. The worker creates one of each and
+calls it around every job it runs:
+
+    class Tracing(JobHook):
+        def before(self, job_name, body):
+            ...
+        def after(self, job_name, body, duration):
+            ...
+        def exception(self, job_name, body, exc_info, duration):
+            ...
+
+With the threads and gevent executors, hooks are called concurrently from
+the threads running the jobs. Errors raised by a hook are logged and don't
+affect the job.
+
+The sampling profiler of django_beanstalkd.profiling is added when
+BEANSTALK_PROFILE_SAMPLE_RATE or BEANSTALK_PROFILE_SLOW is set.
+"""
+import importlib
+import logging
+
+from django.conf import settings
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class JobHook(object):
+    def before(self, job_name, body):
+        """Called before the job function"""
+
+    def after(self, job_name, body, duration):
+        """Called after the job function returned, duration in seconds"""
+
+    def exception(self, job_name, body, exc_info, duration):
+        """Called after the job function raised, with sys.exc_info()"""
+
+
+def load_hooks():
+    # profiling imports JobHook from here
+    from . import profiling
+
+    hooks = []
+    for path in getattr(settings, 'BEANSTALK_JOB_HOOKS', ()):
+        module, name = path.rsplit('.', 1)
+        hooks.append(getattr(importlib.import_module(module), name)())
+    if profiling.enabled():
+        hooks.append(profiling.SamplingProfiler())
+    return hooks
+
+
+def call(hooks, method, *args):
+    """Call method of every hook, in reverse order for the calls after the job"""
+    if method != 'before':
+        hooks = reversed(hooks)
+    for hook in hooks:
+        try:
+            getattr(hook, method)(*args)
+        except Exception:
+            logger.exception("Beanstalk job hook %s.%s failed" % (hook.__class__.__name__, method))
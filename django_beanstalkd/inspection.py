@@ -0,0 +1,274 @@
+"""
+Bulk inspection and replay of the jobs of a tube, for beanstalk_admin.
+
+beanstalkd only shows the first job of a tube in each state. Jobs that are
+kicked or put again leave their state, so PeekScan walks the buried or
+delayed jobs of a tube by peeking at the first one after the previous one
+was dealt with, and kick_buried kicks the buried ones with a single kick
+command per batch.
+
+Jobs that stay where they are, e.g. when only exporting them or filtering
+them by their bodies, are found by their ids instead: Scan pipelines
+stats-job for a chunk of ids at a time, and peeks at the jobs in the tube
+and states asked for in a second pipelined round. Each server hands out ids
+in sequence, so scanning them in order finds every job while holding one
+chunk at a time.
+
+Both scans stop once they have found as many jobs as stats-tube counted
+when they started, or at the highest id handed out by then, so jobs put
+meanwhile, e.g. re-put or re-buried ones, aren't scanned again.
+
+Kicks and re-puts are pipelined too, throttled by a TokenBucket so the jobs
+don't all hit a dependency that just came back at once.
+"""
+import time
+
+import beanstalkc
+from beanstalkc import SocketError
+
+from . import envelope
+
+
+STATES = ('ready', 'delayed', 'buried')
+SCAN_CHUNK_SIZE = 1000
+
+
+class InspectedJob(object):
+    __slots__ = ('id', 'stats', 'body')
+
+    def __init__(self, jid, stats, body):
+        self.id = jid
+        self.stats = stats
+        self.body = body
+
+    @property
+    def tube(self):
+        return self.stats['tube']
+
+    @property
+    def state(self):
+        return self.stats['state']
+
+    def unwrapped(self):
+        """The job's body as passed to the client that put it"""
+        return envelope.unwrap(self.body)[1]
+
+
+def _parse_stats(data):
+    stats = {}
+    for line in data.splitlines():
+        key, sep, value = line.partition(': ')
+        if not sep:
+            continue
+        try:
+            stats[key] = int(value)
+        except ValueError:
+            stats[key] = value
+    return stats
+
+
+def _pipeline(beanstalk, commands):
+    """Send commands at once; returns a function reading the reply of one of them"""
+    SocketError.wrap(beanstalk._socket.sendall, ''.join(commands))
+    return beanstalk._read_response
+
+
+def count_jobs(beanstalk, tube, states):
+    """The number of jobs of tube in states, 0 if the tube doesn't exist"""
+    try:
+        stats = beanstalk.stats_tube(tube)
+    except beanstalkc.CommandFailed:
+        return 0
+    return sum(stats.get('current-jobs-%s' % state, 0) for state in states)
+
+
+def highest_id(beanstalk, tube):
+    """
+    The highest id handed out so far. total-jobs counts the puts since the
+    server started, which is less if it restored jobs from its binlog, so
+    the ids of the tube's first jobs count too.
+    """
+    highest = beanstalk.stats()['total-jobs']
+    beanstalk.use(tube)
+    for state in STATES:
+        job = getattr(beanstalk, 'peek_%s' % state)()
+        if job is not None:
+            highest = max(highest, job.jid)
+    return highest
+
+
+class Scan(object):
+    """
+    Iterates over the InspectedJobs of tube in states on the server of the
+    beanstalkc connection beanstalk, in the order of their ids.
+    """
+
+    def __init__(self, beanstalk, tube, states=('buried',), start_id=1, max_id=None, chunk_size=SCAN_CHUNK_SIZE):
+        self.beanstalk = beanstalk
+        self.tube = tube
+        self.states = states
+        self.next_id = start_id
+        self.chunk_size = chunk_size
+        self.expected = count_jobs(beanstalk, tube, states)
+        self.max_id = max_id if max_id is not None else highest_id(beanstalk, tube)
+        self.found = 0
+
+    @property
+    def done(self):
+        return self.next_id > self.max_id or self.found >= self.expected
+
+    def progress(self):
+        return "scanned up to id %d of %d, %d of %d jobs found" % (
+            min(self.next_id - 1, self.max_id), self.max_id, self.found, self.expected)
+
+    def __iter__(self):
+        while not self.done:
+            ids = range(self.next_id, min(self.next_id + self.chunk_size, self.max_id + 1))
+            self.next_id = ids[-1] + 1
+            matches = []
+            read = _pipeline(self.beanstalk, ['stats-job %d\r\n' % jid for jid in ids])
+            for jid in ids:
+                status, results = read()
+                if status != 'OK':
+                    continue
+                stats = _parse_stats(self.beanstalk._read_body(int(results[0])))
+                if stats.get('tube') == self.tube and stats.get('state') in self.states:
+                    matches.append((jid, stats))
+            if not matches:
+                continue
+            self.found += len(matches)
+
+            # all replies are read before yielding, so the connection can be used meanwhile
+            jobs = []
+            read = _pipeline(self.beanstalk, ['peek %d\r\n' % jid for jid, stats in matches])
+            for jid, stats in matches:
+                status, results = read()
+                if status == 'FOUND':
+                    jobs.append(InspectedJob(jid, stats, self.beanstalk._read_body(int(results[1]))))
+            for job in jobs:
+                yield job
+
+
+class PeekScan(object):
+    """
+    Iterates over the InspectedJobs of tube in states, buried or delayed,
+    by peeking at the first job of each state. The caller has to kick or
+    delete every job before taking the next one; a job peeked twice in a row
+    ends the scan.
+    """
+
+    def __init__(self, beanstalk, tube, states=('buried',)):
+        if 'ready' in states:
+            raise ValueError("Ready jobs don't leave their state when put again")
+        self.beanstalk = beanstalk
+        self.tube = tube
+        self.states = states
+        self.expected = count_jobs(beanstalk, tube, states)
+        self.max_id = highest_id(beanstalk, tube)
+        self.found = 0
+
+    def progress(self):
+        return "%d of %d jobs found" % (self.found, self.expected)
+
+    def __iter__(self):
+        for state in self.states:
+            peek = getattr(self.beanstalk, 'peek_%s' % state)
+            previous = None
+            while self.found < self.expected:
+                # re-putting jobs uses another tube
+                self.beanstalk.use(self.tube)
+                job = peek()
+                if job is None or job.jid > self.max_id or job.jid == previous:
+                    break
+                previous = job.jid
+                try:
+                    stats = job.stats()
+                except beanstalkc.CommandFailed:
+                    # done meanwhile
+                    continue
+                self.found += 1
+                yield InspectedJob(job.jid, stats, job.body)
+
+
+def kick_buried(beanstalk, tube, bound):
+    """Kick up to bound buried jobs of tube with one kick command; returns how many were kicked"""
+    # kick takes the delayed jobs once none are buried
+    bound = min(bound, count_jobs(beanstalk, tube, ('buried',)))
+    if bound <= 0:
+        return 0
+    beanstalk.use(tube)
+    return beanstalk.kick(bound)
+
+
+def kick_jobs(beanstalk, jobs):
+    """Kick the buried or delayed jobs at once; returns how many were kicked"""
+    if not jobs:
+        return 0
+    read = _pipeline(beanstalk, ['kick-job %d\r\n' % job.id for job in jobs])
+    return sum(1 for job in jobs if read()[0] == 'KICKED')
+
+
+def reput_jobs(beanstalk, jobs, tube, retarget=True):
+    """
+    Put copies of the jobs into tube, ready to run, and delete the originals.
+    The copies are put first, so a connection lost halfway leaves duplicates
+    rather than losing jobs. A copy whose original couldn't be deleted, e.g.
+    because a worker reserved it meanwhile, is deleted again. retarget
+    rewrites the tube of the bodies' envelopes.
+
+    Returns (jobs put again, jobs whose copy couldn't be put and that were
+    left alone).
+    """
+    if not jobs:
+        return [], []
+    beanstalk.use(tube)
+    bodies = [envelope.retarget(job.body, tube) if retarget else job.body for job in jobs]
+    read = _pipeline(beanstalk, ['put %d 0 %d %d\r\n%s\r\n' % (job.stats['pri'], job.stats['ttr'], len(body), body)
+                                 for job, body in zip(jobs, bodies)])
+    copies = []
+    failed = []
+    for job in jobs:
+        status, results = read()
+        if status == 'INSERTED':
+            copies.append((job, int(results[0])))
+        else:
+            failed.append(job)
+    if not copies:
+        return [], failed
+
+    read = _pipeline(beanstalk, ['delete %d\r\n' % job.id for job, copy_id in copies])
+    put = []
+    orphans = []
+    for job, copy_id in copies:
+        if read()[0] == 'DELETED':
+            put.append(job)
+        else:
+            orphans.append(copy_id)
+    if orphans:
+        read = _pipeline(beanstalk, ['delete %d\r\n' % copy_id for copy_id in orphans])
+        for copy_id in orphans:
+            read()
+    return put, failed
+
+
+class TokenBucket(object):
+    """Allows rate operations per second on average, in bursts of up to burst"""
+
+    def __init__(self, rate, burst=None, clock=None, sleep=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.clock = clock or time.time
+        self.sleep = sleep or time.sleep
+        self.tokens = float(self.burst)
+        self.last = self.clock()
+
+    def take(self, count=1):
+        """Wait until count (at most burst) operations are allowed"""
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            self.sleep((count - self.tokens) / self.rate)
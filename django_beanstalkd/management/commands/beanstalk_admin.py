@@ -0,0 +1,215 @@
+import base64
+import json
+from optparse import make_option
+import re
+import sys
+import time
+
+from beanstalkc import SocketError
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django_beanstalkd import BeanstalkError
+from django_beanstalkd.connection import connect_beanstalkd, get_servers, parse_server
+from django_beanstalkd.envelope import SpilledBody
+from django_beanstalkd.inspection import (STATES, PeekScan, Scan, TokenBucket, count_jobs, kick_buried, kick_jobs,
+                                          reput_jobs)
+
+
+# jobs kicked or re-put per pipelined batch, at most
+MAX_BATCH = 500
+VERBS = {'kick': 'kicked', 'reput': 'put again'}
+
+
+class Command(NoArgsCommand):
+    help = ("Stream the buried, delayed or ready jobs of a tube, export them as JSON lines, kick them or put "
+            "them again at a limited rate")
+    __doc__ = help
+    option_list = NoArgsCommand.option_list + (
+        make_option('-t', '--tube', action='store', dest='tube',
+                    help='The tube, i.e. job name, to inspect.'),
+        make_option('--state', action='store', dest='state',
+                    default='buried', help='Comma separated states of the jobs: "buried" (default), "delayed", '
+                    '"ready".'),
+        make_option('--match', action='store', dest='match',
+                    default=None, help='Only the jobs whose body contains a match of this regular expression.'),
+        make_option('--limit', action='store', dest='limit',
+                    default=None, help='Stop after this many jobs.'),
+        make_option('--export', action='store', dest='export',
+                    default=None, help='Write the jobs to this file as JSON lines ("-" for stdout, the default '
+                    'without --kick and --reput).'),
+        make_option('--kick', action='store_true', dest='kick',
+                    default=False, help='Kick the jobs, making them ready.'),
+        make_option('--reput', action='store_true', dest='reput',
+                    default=False, help='Put the jobs again, ready and with fresh counters, and delete the originals.'),
+        make_option('--to-tube', action='store', dest='to_tube',
+                    default=None, help='Put the jobs into this tube instead, with --reput.'),
+        make_option('--rate', action='store', dest='rate',
+                    default=None, help='Jobs kicked or put per second (default: BEANSTALK_ADMIN_RATE, 100).'),
+        make_option('--burst', action='store', dest='burst',
+                    default=None, help='Jobs kicked or put at once (default: a second\'s worth).'),
+        make_option('-s', '--server', action='store', dest='server',
+                    help='The beanstalk server (default: all servers in BEANSTALK_SERVERS).'),
+        make_option('-p', '--port', action='store', dest='port',
+                    default=11300, help='The port of the beanstalk server.'),
+        make_option('--start-id', action='store', dest='start_id',
+                    default='1', help='The lowest job id to scan.'),
+        make_option('--max-id', action='store', dest='max_id',
+                    default=None, help='The highest job id to scan (default: the highest one handed out).'),
+    )
+
+    def handle_noargs(self, **options):
+        if not options['tube']:
+            raise CommandError('Pass the --tube to inspect')
+        states = tuple(state.strip() for state in options['state'].split(','))
+        if not states or any(state not in STATES for state in states):
+            raise CommandError('--state must be a comma separated list of %s' % ', '.join(STATES))
+        if options['kick'] and options['reput']:
+            raise CommandError('Pass either --kick or --reput')
+        if options['kick'] and 'ready' in states:
+            raise CommandError('Ready jobs can\'t be kicked')
+        if options['to_tube'] and not options['reput']:
+            raise CommandError('--to-tube needs --reput')
+        try:
+            self.pattern = re.compile(options['match']) if options['match'] else None
+        except re.error as e:
+            raise CommandError('Invalid --match: %s' % e)
+        try:
+            limit = int(options['limit']) if options['limit'] else None
+            rate = float(options['rate'] or getattr(settings, 'BEANSTALK_ADMIN_RATE', 100))
+            burst = int(options['burst']) if options['burst'] else None
+            start_id = int(options['start_id'])
+            max_id = int(options['max_id']) if options['max_id'] else None
+        except ValueError:
+            raise CommandError('--limit, --rate, --burst, --start-id and --max-id must be numbers')
+
+        self.action = 'kick' if options['kick'] else 'reput' if options['reput'] else None
+        # jobs that are kicked or put again leave their state, so they can be
+        # found by peeking; the others only by scanning their ids
+        self.by_id = (not self.action or self.pattern is not None or 'ready' in states or start_id != 1 or
+                      max_id is not None)
+        self.to_tube = options['to_tube'] or options['tube']
+        self.bucket = TokenBucket(rate, burst)
+        export = options['export'] or (None if self.action else '-')
+        self.export = None
+        if export == '-':
+            self.export = sys.stdout
+        elif export:
+            try:
+                self.export = open(export, 'w')
+            except IOError as e:
+                raise CommandError('Unable to write %s: %s' % (export, e))
+
+        if options['server']:
+            servers = [parse_server(options['server'], options['port'])]
+        else:
+            servers = get_servers()
+        self.matched = self.acted = 0
+        try:
+            for server, port in servers:
+                if limit is not None and self.matched >= limit:
+                    break
+                try:
+                    self.inspect(server, port, options['tube'], states, start_id, max_id, limit)
+                except (BeanstalkError, SocketError) as e:
+                    raise CommandError('Beanstalk server %s:%s failed: %s' % (server, port, e))
+        finally:
+            if self.export is not None and self.export is not sys.stdout:
+                self.export.close()
+
+        if self.action:
+            sys.stderr.write("%d jobs matched, %d %s\n" % (self.matched, self.acted, VERBS[self.action]))
+        else:
+            sys.stderr.write("%d jobs matched\n" % self.matched)
+
+    def inspect(self, server, port, tube, states, start_id, max_id, limit):
+        beanstalk = connect_beanstalkd(server, port)
+        name = '%s:%s' % (server, port)
+        try:
+            if self.by_id:
+                self.scan(beanstalk, name, Scan(beanstalk, tube, states, start_id, max_id), MAX_BATCH, limit)
+            elif self.action == 'kick' and self.export is None and states == ('buried',):
+                self.kick_all(beanstalk, name, tube, limit)
+            else:
+                # a job is peeked once the one before it was dealt with
+                self.scan(beanstalk, name, PeekScan(beanstalk, tube, states), 1, limit)
+            sys.stderr.write('\n')
+        finally:
+            beanstalk.close()
+
+    def scan(self, beanstalk, name, scan, batch_size, limit):
+        batch = []
+        next_progress = 0
+        for job in scan:
+            if not self.matches(job):
+                continue
+            self.matched += 1
+            if self.export is not None:
+                self.export.write(self.dump(name, job) + '\n')
+            if self.action:
+                batch.append(job)
+                if len(batch) >= min(self.bucket.burst, batch_size):
+                    self.act(beanstalk, batch)
+                    batch = []
+            if time.time() >= next_progress:
+                next_progress = time.time() + 1.0
+                self.progress(name, scan.progress())
+            if limit is not None and self.matched >= limit:
+                break
+        self.act(beanstalk, batch)
+        self.progress(name, scan.progress())
+
+    def kick_all(self, beanstalk, name, tube, limit):
+        """Kick the buried jobs of tube with kick commands, nothing to look at"""
+        expected = remaining = count_jobs(beanstalk, tube, ('buried',))
+        if limit is not None:
+            remaining = min(remaining, limit - self.matched)
+        while remaining > 0:
+            bound = min(remaining, self.bucket.burst, MAX_BATCH)
+            self.bucket.take(bound)
+            kicked = kick_buried(beanstalk, tube, bound)
+            if not kicked:
+                break
+            remaining -= kicked
+            self.matched += kicked
+            self.acted += kicked
+            self.progress(name, "%d of %d jobs found" % (expected - remaining, expected))
+        self.progress(name, "%d of %d jobs found" % (expected - remaining, expected))
+
+    def matches(self, job):
+        if self.pattern is None:
+            return True
+        body = job.unwrapped()
+        return not isinstance(body, SpilledBody) and self.pattern.search(body) is not None
+
+    def act(self, beanstalk, jobs):
+        if not jobs:
+            return
+        self.bucket.take(len(jobs))
+        if self.action == 'kick':
+            self.acted += kick_jobs(beanstalk, jobs)
+        else:
+            put, failed = reput_jobs(beanstalk, jobs, self.to_tube)
+            self.acted += len(put)
+            for job in failed:
+                sys.stderr.write("\nJob %d couldn't be put again and was left alone\n" % job.id)
+
+    def progress(self, name, status):
+        line = "\r%s: %s, %d matched" % (name, status, self.matched)
+        if self.action:
+            line += ", %d %s" % (self.acted, VERBS[self.action])
+        sys.stderr.write(line)
+        sys.stderr.flush()
+
+    def dump(self, server, job):
+        record = {'server': server, 'id': job.id}
+        for key in ('tube', 'state', 'pri', 'age', 'delay', 'ttr', 'reserves', 'releases', 'buries', 'kicks'):
+            record[key] = job.stats.get(key)
+        body = job.unwrapped()
+        if isinstance(body, SpilledBody):
+            record['jobdata_pk'] = body.pk
+        else:
+            try:
+                record['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                record['body_base64'] = base64.b64encode(body)
+        return json.dumps(record, sort_keys=True)
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django_beanstalkd import registry
+
+
+class Command(NoArgsCommand):
+    help = "Write the manifest of all Beanstalk jobs, so workers only import the modules of the jobs they serve"
+    __doc__ = help
+    option_list = NoArgsCommand.option_list + (
+        make_option('-o', '--output', action='store', dest='output',
+                    default=None, help='The file to write (default: BEANSTALK_MANIFEST).'),
+    )
+
+    def handle_noargs(self, **options):
+        path = options['output'] or getattr(settings, 'BEANSTALK_MANIFEST', None)
+        if not path:
+            raise CommandError('Pass --output or set BEANSTALK_MANIFEST')
+        try:
+            manifest = registry.write_manifest(path)
+        except (IOError, OSError) as e:
+            raise CommandError('Unable to write %s: %s' % (path, e))
+        self.stdout.write("Wrote %d jobs to %s\n" % (len(manifest['jobs']), path))
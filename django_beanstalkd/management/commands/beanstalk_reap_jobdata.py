@@ -0,0 +1,53 @@
+import datetime
+import logging
+from optparse import make_option
+import time
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django_beanstalkd import JobData
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class Command(NoArgsCommand):
+    help = "Delete JobData rows whose jobs were buried or lost"
+    __doc__ = help
+    option_list = NoArgsCommand.option_list + (
+        make_option('-a', '--age', action='store', dest='age',
+                    default='168', help='Delete rows created more than this many hours ago (default: one week).'),
+        make_option('-j', '--job-name', action='append', dest='job_names',
+                    default=[], help='Only delete rows of this job. Can be given more than once.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+                    default='1000', help='Number of rows deleted per statement.'),
+        make_option('--sleep', action='store', dest='sleep',
+                    default='0.1', help='Seconds to pause between chunks, letting other queries take the locks.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            age = float(options['age'])
+            chunk_size = int(options['chunk_size'])
+            pause = float(options['sleep'])
+        except ValueError:
+            raise CommandError('--age, --chunk-size and --sleep must be numbers')
+
+        rows = JobData.objects.filter(created__lt=datetime.datetime.now() - datetime.timedelta(hours=age))
+        if options['job_names']:
+            rows = rows.filter(job_name__in=options['job_names'])
+
+        deleted = 0
+        while True:
+            # the created index finds the next chunk; deleting it by primary
+            # key only locks those rows
+            pks = list(rows.order_by('created').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            JobData.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            logger.info("Deleted %d rows" % deleted)
+            if len(pks) < chunk_size:
+                break
+            time.sleep(pause)
+
+        self.stdout.write("Deleted %d orphaned job data rows\n" % deleted)
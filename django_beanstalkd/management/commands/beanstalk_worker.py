@@ -1,20 +1,29 @@
+import errno
+import gc
 import logging
 from optparse import make_option
 import os
+import resource
+import signal
 import sys
 import time
 import traceback
 
-from beanstalkc import SocketError
+from beanstalkc import DEFAULT_PRIORITY, CommandFailed, SocketError
 from django import db
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
-from django_beanstalkd import BeanstalkError, connect_beanstalkd
-from _mysql_exceptions import OperationalError
+from django.core.management.base import CommandError, NoArgsCommand
+from django_beanstalkd import (BeanstalkClient, BeanstalkError, batching, cleanup, dbutils, dedupe, groups,
+                               hooks, metrics, periodic, registry)
+from django_beanstalkd.autoscale import Autoscaler, TubeStats, parse_autoscale
+from django_beanstalkd.connection import get_servers, parse_server, reset_pools
+from django_beanstalkd.envelope import SpilledBody, job_tube
+from django_beanstalkd.executors import InFlightJob, JobToucher, ThreadExecutor, set_current_job
+from django_beanstalkd.periodic import PeriodicScheduler
+from django_beanstalkd.reserver import Reserver
+from django_beanstalkd.scheduling import SlotCounts, TubeScheduler, get_options, select_tubes
 from raven.contrib.django.raven_compat.models import client as raven_client
 
-from content_utils.utils import flush_transaction
-
 
 logger = logging.getLogger('django_beanstalkd')
 logger.addHandler(logging.StreamHandler())
@@ -26,16 +35,70 @@ class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
         make_option('-w', '--workers', action='store', dest='worker_count',
                     default='1', help='Number of workers to spawn.'),
+        make_option('--autoscale', action='store', dest='autoscale',
+                    default=None, help='Run between min and max workers, as many as the ready jobs need, '
+                    'e.g. "2,16". Overrides --workers.'),
         make_option('-s', '--server', action='store', dest='server',
-                    help='The beanstalk server to pull jobs.'),
+                    help='The beanstalk server to pull jobs (default: all servers in BEANSTALK_SERVERS).'),
         make_option('-p', '--port', action='store', dest='port',
                     default=11300, help='The port of the beanstalk server to pull jobs.'),
+        make_option('-e', '--executor', action='store', dest='executor',
+                    default='prefork', help='How each worker runs jobs (one of "prefork", "threads", "gevent"). '
+                    'With "threads" and "gevent", a worker runs up to --concurrency jobs at the same time.'),
+        make_option('-c', '--concurrency', action='store', dest='concurrency',
+                    default='10', help='Number of jobs a threads or gevent worker runs concurrently.'),
+        make_option('--tubes', action='store', dest='tubes',
+                    default=None, help='Only serve the jobs matching these comma separated patterns, e.g. '
+                    '"emails.*,search.reindex".'),
+        make_option('--exclude-tubes', action='store', dest='exclude_tubes',
+                    default=None, help='Don\'t serve the jobs matching these comma separated patterns.'),
+        make_option('--periodic', action='store_true', dest='periodic',
+                    default=False, help='Also run a scheduler putting the periodic jobs served on schedule. '
+                    'With -w 0, only run the scheduler.'),
+        make_option('--manifest', action='store', dest='manifest',
+                    default=None, help='Only import the modules of the jobs served, as listed in this manifest '
+                    'written by beanstalk_manifest (default: BEANSTALK_MANIFEST).'),
+        make_option('--max-jobs', action='store', dest='max_jobs',
+                    default=None, help='Replace a worker after it has processed this many jobs.'),
+        make_option('--max-memory', action='store', dest='max_memory',
+                    default=None, help='Replace a worker once its resident memory exceeds this many MB.'),
+        make_option('--metrics-port', action='store', dest='metrics_port',
+                    default=None, help='Serve the metrics of all workers in the Prometheus text format on this port.'),
         make_option('-l', '--log-level', action='store', dest='log_level',
                     default=logging.getLevelName(logger.level), help='Log level of worker process (one of '
                     '"debug", "info", "warning", "error")'),
     )
-    children = []  # list of worker processes
+    children = {}  # worker processes, pid -> start time
+    periodic = False
+    periodic_pid = None  # the process of the periodic scheduler
+    rows = {}  # worker processes, pid -> row of the worker in the SlotCounts
+    retiring = set()  # workers stopped by the autoscaler
+    autoscaler = None
+    stats = None  # TubeStats of the served tubes, in the supervisor
     jobs = {}
+    tubes = []  # the tubes of the jobs served
+    scheduler = None
+    executor = None  # ThreadExecutor of the current worker process, if any
+    hooks = None  # JobHooks called around the jobs of the current worker process
+
+    # set by signal handlers: workers finish their current jobs and exit,
+    # the supervisor stops (or, when reloading, re-executes itself) once
+    # all workers have exited
+    stopping = False
+    reloading = False
+    # whether a prefork worker can exit right away on SIGTERM, i.e. it's
+    # waiting for a job instead of running one
+    interruptible = False
+    jobs_done = 0
+    max_jobs = None
+    max_memory = None
+    metrics_port = None
+
+    # seconds before the end of a job's TTR at which it's touched
+    touch_margin = 5.0
+    toucher = None  # JobToucher of a prefork worker
+    next_housekeeping = 0
+    next_heartbeat = 0
 
     def handle_noargs(self, **options):
         # set log level
@@ -43,97 +106,324 @@ class Command(NoArgsCommand):
         self.beanstalk_port = options['port']
         logger.setLevel(getattr(logging, options['log_level'].upper()))
 
-        # find beanstalk job modules
-        bs_modules = []
-        for app in settings.INSTALLED_APPS:
+        self.executor_type = options['executor']
+        if self.executor_type not in ('prefork', 'threads', 'gevent'):
+            raise CommandError('Unknown executor "%s"' % self.executor_type)
+        try:
+            self.concurrency = int(options['concurrency'])
+            assert(self.concurrency > 0)
+        except (ValueError, AssertionError):
+            raise CommandError('--concurrency must be a positive number')
+        if self.executor_type == 'gevent':
             try:
-                modname = "%s.beanstalk_jobs" % app
-                __import__(modname)
-                bs_modules.append(sys.modules[modname])
+                from gevent import monkey
             except ImportError:
-                pass
-        if not bs_modules:
-            logger.error("No beanstalk_jobs modules found!")
-            return
+                raise CommandError('The gevent executor requires gevent to be installed')
+            # threads, queues and sockets become cooperative greenlets from here on
+            monkey.patch_all()
 
-        # find all jobs
-        jobs = []
-        for bs_module in bs_modules:
+        manifest_path = options['manifest'] or getattr(settings, 'BEANSTALK_MANIFEST', None)
+        if manifest_path and not os.path.exists(manifest_path):
+            logger.warning("Beanstalk manifest %s not found, importing all apps' jobs" % manifest_path)
+            manifest_path = None
+        if manifest_path:
+            # only import the modules of the jobs served
             try:
-                jobs += bs_module.beanstalk_job_list
-            except AttributeError:
-                pass
-        if not jobs:
-            logger.error("No beanstalk jobs found!")
-            return
+                manifest = registry.read_manifest(manifest_path)
+                self.tubes = select_tubes(manifest, options['tubes'], options['exclude_tubes'])
+                registry.load(self.tubes, manifest)
+            except (ValueError, ImportError) as e:
+                raise CommandError('Invalid manifest %s: %s' % (manifest_path, e))
+        else:
+            if not registry.discover():
+                logger.error("No beanstalk_jobs modules found!")
+                return
+            if not registry.jobs:
+                logger.error("No beanstalk jobs found!")
+                return
+            self.tubes = select_tubes(registry.jobs, options['tubes'], options['exclude_tubes'])
+        self.jobs = dict(registry.jobs)
+
+        if not self.tubes:
+            raise CommandError('No jobs match --tubes and --exclude-tubes')
         logger.info("Available jobs:")
-        for job in jobs:
-            # determine right name to register function with
-            app = job.app
-            jobname = job.__name__
-            try:
-                func = settings.BEANSTALK_JOB_NAME % {
-                    'app': app,
-                    'job': jobname,
-                }
-            except AttributeError:
-                func = '%s.%s' % (app, jobname)
-            self.jobs[func] = job
+        for func in self.tubes:
             logger.info("* %s" % func)
 
+        try:
+            self.max_jobs = int(options['max_jobs']) if options['max_jobs'] else None
+            self.max_memory = int(options['max_memory']) * 1024 if options['max_memory'] else None
+            self.metrics_port = int(options['metrics_port']) if options['metrics_port'] else None
+        except ValueError:
+            raise CommandError('--max-jobs, --max-memory and --metrics-port must be numbers')
+
         # spawn all workers and register all jobs
         try:
             worker_count = int(options['worker_count'])
-            assert(worker_count > 0)
+            assert(worker_count > 0 or (worker_count == 0 and options['periodic']))
         except (ValueError, AssertionError):
             worker_count = 1
-        self.spawn_workers(worker_count)
+        self.periodic = options['periodic']
+        max_workers = worker_count
+        if options['autoscale']:
+            try:
+                worker_count, max_workers = parse_autoscale(options['autoscale'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.autoscaler = Autoscaler(worker_count, max_workers, self.get_stats())
+
+        weights, limits = get_options(self.jobs)
+        try:
+            self.scheduler = TubeScheduler(self.tubes, weights, limits,
+                                           SlotCounts([tube for tube in limits if tube in self.tubes], max_workers))
+        except ValueError as e:
+            raise CommandError(str(e))
 
         # start working
         logger.info("Starting to work... (press ^C to exit)")
         try:
-            for child in self.children:
-                os.waitpid(child, 0)
+            # no need for a supervisor if there's only one worker that's never replaced
+            if (worker_count == 1 and self.max_jobs is None and self.max_memory is None and self.metrics_port is None
+                    and not self.periodic and self.autoscaler is None):
+                self.work()
+            else:
+                self.supervise(worker_count)
         except KeyboardInterrupt:
             sys.exit(0)
 
-    def spawn_workers(self, worker_count):
+    def supervise(self, worker_count):
         """
-        Spawn as many workers as desired (at least 1).
-        Accepts:
-        - worker_count, positive int
+        Keep worker_count workers running, replacing those that exit.
+
+        SIGTERM and SIGINT make the workers finish their current jobs and
+        exit. SIGHUP does the same, after which the supervisor re-executes
+        itself to pick up new code. The job modules are imported before
+        forking, so the workers share those pages with the supervisor.
         """
-        # no need for forking if there's only one worker
-        if worker_count == 1:
-            return self.work()
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        if self.metrics_port is not None:
+            # threads of the supervisor aren't carried over into the workers
+            metrics.MetricsExporter(self.metrics_port, self.tube_stats).start()
+
+        # don't hand garbage to the children, and don't make them copy pages to collect it
+        db.connections['default'].close()
+        gc.collect()
 
         logger.info("Spawning %s worker(s)" % worker_count)
+        interval = getattr(settings, 'BEANSTALK_AUTOSCALE_INTERVAL', 5)
+        next_poll = time.time() + interval
         # spawn children and make them work (hello, 19th century!)
-        for i in range(worker_count):
-            child = os.fork()
-            if child:
-                self.children.append(child)
+        while not self.stopping or self.children or self.periodic_pid:
+            # retiring workers still hold their rows in the SlotCounts
+            while (not self.stopping and len(self.children) - len(self.retiring) < worker_count
+                   and len(self.children) < self.scheduler.counts.workers):
+                self.spawn_worker()
+            if self.periodic and not self.stopping and self.periodic_pid is None:
+                self.spawn_periodic()
+
+            try:
+                if self.autoscaler is None:
+                    pid, status = os.waitpid(-1, 0)
+                else:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        if time.time() >= next_poll and not self.stopping:
+                            next_poll = time.time() + interval
+                            worker_count = self.autoscale(worker_count)
+                        time.sleep(min(0.5, max(0, next_poll - time.time())))
+                        continue
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.children.clear()
+                    if self.autoscaler is not None:
+                        time.sleep(0.5)
+                    continue
+                raise
+
+            if pid == self.periodic_pid:
+                self.periodic_pid = None
+                if not self.stopping:
+                    logger.error("Periodic scheduler %s died unexpectedly (status %s), replacing it" % (pid, status))
+                    time.sleep(1.0)
+                continue
+            started = self.children.pop(pid, None)
+            if pid in self.rows:
+                # the jobs it was running are over
+                self.scheduler.counts.clear(self.rows.pop(pid))
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if started is None or self.stopping:
                 continue
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                logger.error("Worker %s died unexpectedly (status %s), replacing it" % (pid, status))
+                # don't respawn in a tight loop if workers die on startup
+                if time.time() - started < 1.0:
+                    time.sleep(1.0)
             else:
-                self.work()
-                break
+                logger.info("Worker %s retired, replacing it" % pid)
+
+        if self.reloading:
+            logger.info("Reloading...")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def autoscale(self, worker_count):
+        """Ask the autoscaler how many workers to run; retires the extra ones. Returns the count."""
+        try:
+            wanted = self.autoscaler.poll(len(self.children) - len(self.retiring))
+        except (BeanstalkError, SocketError, CommandFailed) as e:
+            logger.warning("Unable to read the tube stats for autoscaling: %s" % e)
+            return worker_count
+        # retire the youngest workers, which have the least warmed-up caches
+        running = sorted((started, pid) for pid, started in self.children.items() if pid not in self.retiring)
+        for started, pid in running[wanted:]:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        return wanted
+
+    def spawn_worker(self):
+        row = min(set(range(len(self.children) + 1)) - set(self.rows.values()))
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            self.rows[pid] = row
+            return pid
+
+        exit_code = 0
+        try:
+            self.children = {}
+            self.rows = {}
+            self.retiring = set()
+            self.scheduler.counts.row = row
+            signal.signal(signal.SIGTERM, self.handle_worker_stop)
+            self.set_interruptible(False)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            # don't share the parent's pooled client connections or unsent metrics
+            reset_pools()
+            if self.metrics_port is not None:
+                metrics.set_backend(metrics.SupervisorBackend(self.metrics_port))
+            else:
+                metrics.set_backend(None)
+            self.work()
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.error("Worker crashed:\n%s" % traceback.format_exc())
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # never return into the supervisor's code
+            os._exit(exit_code)
+
+    def spawn_periodic(self):
+        """Fork the scheduler of the periodic jobs served"""
+        pid = os.fork()
+        if pid:
+            self.periodic_pid = pid
+            return pid
+
+        exit_code = 0
+        try:
+            self.children = {}
+            self.periodic_pid = None
+            reset_pools()
+            metrics.set_backend(None)
+            scheduler = PeriodicScheduler(dict(
+                (name, periodic_job) for name, periodic_job in periodic.periodic_jobs.items() if name in self.tubes))
+            signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            scheduler.run()
+        except BaseException:
+            logger.error("Periodic scheduler crashed:\n%s" % traceback.format_exc())
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def get_stats(self):
+        if self.stats is None:
+            client = BeanstalkClient(server=self.beanstalk_server, port=self.beanstalk_port)
+            self.stats = TubeStats(client, self.tubes)
+        return self.stats
+
+    def tube_stats(self):
+        """stats-tube of every served tube, for the metrics exporter"""
+        return self.get_stats().get()
+
+    def handle_stop(self, signum, frame):
+        logger.info("Stopping workers...")
+        self.stopping = True
+        for pid in self.children.keys() + ([self.periodic_pid] if self.periodic_pid else []):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+        self.handle_stop(signum, frame)
+
+    def set_interruptible(self, interruptible):
+        self.interruptible = interruptible
+        # a running job's system calls are restarted after SIGTERM, while a
+        # reserve is interrupted so the worker can exit
+        signal.siginterrupt(signal.SIGTERM, interruptible)
+
+    def handle_worker_stop(self, signum, frame):
+        self.stopping = True
+        if self.interruptible:
+            raise SystemExit(0)
+
+    def should_retire(self):
+        """Whether this worker should exit once its current jobs are done"""
+        if self.stopping:
+            return True
+        if self.max_jobs is not None and self.jobs_done >= self.max_jobs:
+            logger.info("Worker %s processed %s jobs, retiring" % (os.getpid(), self.jobs_done))
+            return True
+        if self.max_memory is not None and rss_kb() > self.max_memory:
+            logger.info("Worker %s uses more than %s KB, retiring" % (os.getpid(), self.max_memory))
+            return True
+        return False
 
     def work(self):
         """children only: watch tubes for all jobs, start working"""
+        if self.beanstalk_server:
+            servers = [parse_server(self.beanstalk_server, self.beanstalk_port)]
+        else:
+            servers = get_servers()
+        if self.hooks is None:
+            self.hooks = hooks.load_hooks()
         try:
 
             while True:
+                reserver = Reserver(servers, self.tubes, scheduler=self.scheduler)
                 try:
                     # Reattempt Beanstalk connection if connection attempt fails or is dropped
-                    beanstalk = connect_beanstalkd(server=self.beanstalk_server, port=self.beanstalk_port)
-                    for job in self.jobs.keys():
-                        beanstalk.watch(job)
-                    beanstalk.ignore('default')
+                    reserver.connect()
 
                     # Connected to Beanstalk queue, continually process jobs until an error occurs
-                    # Each worker will have their own connection
+                    # Each worker will have their own connections
                     db.connections['default'].close()
-                    self.process_jobs(beanstalk)
+                    if self.executor_type == 'prefork':
+                        self.process_jobs(reserver)
+                    else:
+                        if self.executor is None:
+                            self.executor = ThreadExecutor(self.concurrency, self.call_job,
+                                                           lambda task: self.scheduler.done(task.job))
+                        self.process_jobs_concurrently(reserver)
 
                 except (BeanstalkError, SocketError) as e:
                     msg = "Beanstalk connection error: " + str(e)
@@ -151,43 +441,233 @@ class Command(NoArgsCommand):
                     logger.info(msg)
                     time.sleep(2.0)
                     logger.info("retrying Beanstalk connection...")
+                finally:
+                    reserver.close()
 
         except KeyboardInterrupt:
             sys.exit(0)
+        finally:
+            # delete the job data of the jobs done so far, put the items they batched
+            cleanup.flush()
+            batching.flush()
+            groups.flush()
+            metrics.flush()
 
-    def process_jobs(self, beanstalk):
+    def process_jobs(self, reserver):
+        """
+        Reserve and run one job at a time. Reserves time out after a second,
+        doubling up to BEANSTALK_RESERVE_TIMEOUT seconds while the worker is
+        idle, so it does its housekeeping and notices it should stop.
+        """
+        if self.toucher is None:
+            self.toucher = JobToucher(self.touch_margin)
+        max_timeout = getattr(settings, 'BEANSTALK_RESERVE_TIMEOUT', 10)
+        timeout = 1
+        logger.debug("Beanstalk connection established, waiting for jobs")
         while True:
-            logger.debug("Beanstalk connection established, waiting for jobs")
-            job = beanstalk.reserve()
-            job_name = job.stats()['tube']
+            self.housekeeping()
+            self.set_interruptible(True)
+            if self.stopping:
+                raise SystemExit(0)
+            job = reserver.reserve(timeout=timeout)
+            self.set_interruptible(False)
+            if job is None:
+                timeout = min(timeout * 2, max_timeout)
+                continue
+            timeout = 1
+            # nothing is reserved while the job runs, don't hold jobs of other servers
+            reserver.give_back()
+            job_name, body, enqueued_at, dedupe_key, member = job_tube(job)
             if job_name in self.jobs:
-                logger.debug("Calling %s with arg: %s" % (job_name, job.body))
+                self.job_reserved(job_name, enqueued_at)
+                task = InFlightJob(job, job_name, body, dedupe_key, member)
+                self.toucher.watch(task)
                 try:
-                    connection = db.connections['default']
-                    if connection.connection:
-                        try:
-                            connection.connection.ping()
-                        except OperationalError as e:
-                            connection.close()
-
-                    flush_transaction()
-                    self.jobs[job_name](job.body)
-                except Exception, e:
-                    tp, value, tb = sys.exc_info()
-                    logger.error('Error while calling "%s" with arg "%s": '
-                        '%s' % (
-                            job_name,
-                            job.body,
-                            e,
-                        )
-                    )
-                    logger.debug("%s:%s" % (tp.__name__, value))
-                    logger.debug("\n".join(traceback.format_tb(tb)))
-
-                    raven_client.captureMessage(str(e), stack=True, level=logging.ERROR)
-
-                    job.bury()
-                else:
-                    job.delete()
+                    succeeded = self.call_job(task)
+                finally:
+                    self.toucher.unwatch()
+                    self.scheduler.done(job)
+                self.finish_job(job, job_name, succeeded, task.dedupe_key)
+                self.jobs_done += 1
+                if self.should_retire():
+                    raise SystemExit(0)
             else:
-                job.release()
+                self.scheduler.done(job)
+                self.release_unknown(reserver, job, job_name)
+
+    def process_jobs_concurrently(self, reserver):
+        """
+        Reserve jobs while the executor has free slots and acknowledge them as
+        they finish. Jobs stay reserved by the reserver's connections, so this
+        is also the only place that touches them.
+        """
+        executor = self.executor
+        logger.debug("Beanstalk connection established, waiting for jobs")
+        while True:
+            if executor.has_capacity() and not self.stopping:
+                finished = executor.finished()
+            else:
+                finished = executor.finished(timeout=1.0)
+            self.jobs_done += len(finished)
+            for task in finished:
+                if not reserver.owns(task.job.conn):
+                    # reserved by a connection that was lost; beanstalkd released it already
+                    continue
+                try:
+                    reserver.settle(task.job.conn)
+                    self.finish_job(task.job, task.job_name, task.succeeded, task.dedupe_key)
+                except CommandFailed:
+                    logger.info("Job %s expired before it finished" % task.job.jid)
+
+            self.touch_jobs(reserver)
+            self.housekeeping()
+
+            if self.stopping or self.should_retire():
+                # stop reserving, exit once the jobs in flight are done
+                self.stopping = True
+                if not executor.in_flight:
+                    raise SystemExit(0)
+                continue
+            if not executor.has_capacity():
+                continue
+            job = reserver.reserve(timeout=1)
+            if job is None:
+                continue
+            job_name, body, enqueued_at, dedupe_key, member = job_tube(job)
+            if job_name in self.jobs:
+                self.job_reserved(job_name, enqueued_at)
+                executor.submit(job, job_name, body, dedupe_key, member)
+            else:
+                self.scheduler.done(job)
+                self.release_unknown(reserver, job, job_name)
+
+    def housekeeping(self):
+        """Chores done at most once a second, whenever the reserving loop wakes up"""
+        now = time.time()
+        if now < self.next_housekeeping:
+            return
+        self.next_housekeeping = now + 1.0
+        metrics.maybe_flush()
+        cleanup.flush_if_due()
+        groups.flush_if_due()
+        dbutils.close_if_idle()
+        heartbeat_file = getattr(settings, 'BEANSTALK_HEARTBEAT_FILE', None)
+        if heartbeat_file and now >= self.next_heartbeat:
+            self.next_heartbeat = now + getattr(settings, 'BEANSTALK_HEARTBEAT_INTERVAL', 10)
+            try:
+                with open(heartbeat_file, 'a'):
+                    os.utime(heartbeat_file, None)
+            except (IOError, OSError) as e:
+                logger.warning("Unable to touch heartbeat file %s: %s" % (heartbeat_file, e))
+
+    def release_unknown(self, reserver, job, job_name):
+        """
+        Put back a job of a tube this worker has no function for. It's
+        delayed by BEANSTALK_UNKNOWN_JOB_DELAY seconds so workers that know
+        it get a chance, and its tube is no longer watched. The job gets the
+        default priority, which saves a stats-job round trip per job.
+        """
+        job.release(priority=DEFAULT_PRIORITY, delay=getattr(settings, 'BEANSTALK_UNKNOWN_JOB_DELAY', 10))
+        metrics.incr('jobs_released', job_name)
+        if job_name in reserver.tubes:
+            logger.info("Ignoring tube %s, no job is registered for it" % job_name)
+            reserver.ignore(job_name)
+
+    def job_reserved(self, job_name, enqueued_at):
+        metrics.incr('jobs_reserved', job_name)
+        if enqueued_at is not None:
+            metrics.timing('queue_wait', job_name, time.time() - enqueued_at)
+
+    def finish_job(self, job, job_name, succeeded, dedupe_key=None):
+        """Delete a job that succeeded, bury one that failed"""
+        if succeeded:
+            job.delete()
+            metrics.incr('jobs_deleted', job_name)
+        else:
+            job.bury()
+            metrics.incr('jobs_buried', job_name)
+        # the job isn't pending anymore, new calls with its key must be put
+        dedupe.release(dedupe_key)
+        metrics.maybe_flush()
+
+    def touch_jobs(self, reserver):
+        """Touch in-flight jobs that are about to run out of time"""
+        now = time.time()
+        for task in self.executor.in_flight:
+            if reserver.owns(task.job.conn) and task.needs_touch(now):
+                reserver.settle(task.job.conn)
+                task.touch(now, self.touch_margin)
+
+    def call_job(self, task):
+        """
+        Call the function of the InFlightJob task, returning whether it
+        succeeded. The result of a job group member is recorded for the
+        group's callback.
+        """
+        job_name, body = task.job_name, task.body
+        logger.debug("Calling %s with arg: %s" % (job_name, body))
+        job = self.jobs[job_name]
+        spilled = body if isinstance(body, SpilledBody) else None
+        uses_db = getattr(job, 'uses_db', True) or spilled is not None
+        try:
+            if uses_db:
+                # the connection belongs to the current thread
+                dbutils.prepare_connection()
+            if spilled is not None:
+                body = spilled.load()
+            start = time.time()
+            if self.hooks:
+                hooks.call(self.hooks, 'before', job_name, body)
+            # for the decorators putting the job again, see BeanstalkClient.call_again
+            set_current_job(task)
+            try:
+                # Not retried on a database disconnect, which may come after
+                # the job committed. Only plain beanstalk_job functions raise
+                # here: the retrying and data decorators catch every exception.
+                result = job(body)
+            except Exception:
+                exc_info = sys.exc_info()
+                if self.hooks:
+                    hooks.call(self.hooks, 'exception', job_name, body, exc_info, time.time() - start)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                set_current_job(None)
+                metrics.timing('job_duration', job_name, time.time() - start)
+            if self.hooks:
+                hooks.call(self.hooks, 'after', job_name, body, time.time() - start)
+            if task.member is not None:
+                if task.failed:
+                    # buried, its group completes once it's kicked and succeeds
+                    logger.error('Job group member "%s" with arg "%s" failed' % (job_name, body))
+                    return False
+                groups.record(task.member, result)
+            if spilled is not None:
+                cleanup.delete_job_data(spilled.pk)
+        except Exception, e:
+            tp, value, tb = sys.exc_info()
+            logger.error('Error while calling "%s" with arg "%s": '
+                '%s' % (
+                    job_name,
+                    body,
+                    e,
+                )
+            )
+            logger.debug("%s:%s" % (tp.__name__, value))
+            logger.debug("\n".join(traceback.format_tb(tb)))
+
+            raven_client.captureMessage(str(e), stack=True, level=logging.ERROR)
+            return False
+        finally:
+            if uses_db:
+                dbutils.mark_used()
+        return True
+
+
+def rss_kb():
+    """Resident memory of the current process in KB"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        # peak rather than current usage, but good enough to find leaks
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,339 @@
+"""
+Instrumentation of clients and workers.
+
+Clients and workers report counters and timings per tube to the configured
+backend:
+
+    jobs_enqueued, jobs_reserved, jobs_deleted, jobs_buried, jobs_released,
+    jobs_retried                                   (counters)
+    enqueue_latency, queue_wait, job_duration      (timings in seconds)
+
+Settings:
+    BEANSTALK_METRICS_BACKEND: None (default, metrics are discarded), "statsd",
+                               "memory" or the dotted path of a Backend class
+    BEANSTALK_STATSD_HOST, BEANSTALK_STATSD_PORT, BEANSTALK_STATSD_PREFIX:
+                               where the statsd backend sends its packets
+    BEANSTALK_METRICS_FLUSH_INTERVAL: seconds between flushes (default 10)
+
+A worker started with --metrics-port collects the metrics of all its worker
+processes and serves them in the Prometheus text format instead; the
+processes aggregate them and send the deltas to the supervisor on every flush.
+"""
+import bisect
+import BaseHTTPServer
+import importlib
+import json
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Collector(object):
+    """Counters and histograms per (name, tube), aggregated in memory"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        # (name, tube) -> [observations per bucket..., observations above all buckets, sum]
+        self.histograms = {}
+
+    def incr(self, name, tube, value=1):
+        key = (name, tube)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, tube, value):
+        key = (name, tube)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def drain(self):
+        """Returns (counters, histograms) and starts over"""
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        return counters, histograms
+
+    def merge(self, counters, histograms):
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        histogram[i] += value
+
+    def prometheus(self, prefix='beanstalk'):
+        """Renders the collected values in the Prometheus text format"""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        last_name = None
+        for (name, tube), value in counters:
+            metric = '%s_%s_total' % (prefix, name)
+            if name != last_name:
+                lines.append('# TYPE %s counter' % metric)
+                last_name = name
+            lines.append('%s{tube="%s"} %s' % (metric, tube, value))
+
+        last_name = None
+        for (name, tube), values in histograms:
+            metric = '%s_%s_seconds' % (prefix, name)
+            if name != last_name:
+                lines.append('# TYPE %s histogram' % metric)
+                last_name = name
+            count = 0
+            for bound, observations in zip(BUCKETS + ('+Inf',), values[:-1]):
+                count += observations
+                lines.append('%s_bucket{tube="%s",le="%s"} %d' % (metric, tube, bound, count))
+            lines.append('%s_sum{tube="%s"} %s' % (metric, tube, values[-1]))
+            lines.append('%s_count{tube="%s"} %d' % (metric, tube, count))
+        return '\n'.join(lines) + '\n'
+
+
+class Backend(object):
+    """Discards all metrics"""
+
+    enabled = False
+
+    def incr(self, name, tube, value=1):
+        pass
+
+    def timing(self, name, tube, seconds):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MemoryBackend(Backend):
+    """Keeps the metrics in the process, e.g. for tests"""
+
+    enabled = True
+
+    def __init__(self):
+        self.collector = Collector()
+
+    def incr(self, name, tube, value=1):
+        self.collector.incr(name, tube, value)
+
+    def timing(self, name, tube, seconds):
+        self.collector.observe(name, tube, seconds)
+
+
+class StatsdBackend(MemoryBackend):
+    """
+    Aggregates the metrics per flush interval and sends them to statsd: one
+    total per counter, and the mean of each timing sampled at 1/count so that
+    statsd still counts every observation.
+    """
+
+    max_packet_size = 1400
+
+    def __init__(self, host=None, port=None, prefix=None):
+        super(StatsdBackend, self).__init__()
+        self.address = (
+            host or getattr(settings, 'BEANSTALK_STATSD_HOST', '127.0.0.1'),
+            port or getattr(settings, 'BEANSTALK_STATSD_PORT', 8125),
+        )
+        self.prefix = prefix or getattr(settings, 'BEANSTALK_STATSD_PREFIX', 'beanstalk')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def lines(self, counters, histograms):
+        lines = ['%s.%s.%s:%d|c' % (self.prefix, tube, name, value)
+                 for (name, tube), value in sorted(counters.items())]
+        for (name, tube), values in sorted(histograms.items()):
+            count = sum(values[:-1])
+            line = '%s.%s.%s:%.3f|ms' % (self.prefix, tube, name, values[-1] * 1000 / count)
+            if count > 1:
+                line += '|@%g' % (1.0 / count)
+            lines.append(line)
+        return lines
+
+    def flush(self):
+        packet = []
+        size = 0
+        for line in self.lines(*self.collector.drain()):
+            if packet and size + len(line) >= self.max_packet_size:
+                self._send(packet)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send(packet)
+
+    def _send(self, lines):
+        try:
+            self._socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+
+class SupervisorBackend(MemoryBackend):
+    """Aggregates the metrics of a worker process for the supervisor's MetricsExporter"""
+
+    # entries per datagram, keeping them well below the maximum size
+    chunk_size = 50
+
+    def __init__(self, port, host='127.0.0.1'):
+        super(SupervisorBackend, self).__init__()
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def flush(self):
+        counters, histograms = self.collector.drain()
+        entries = [['c', name, tube, value] for (name, tube), value in counters.items()]
+        entries += [['h', name, tube, values] for (name, tube), values in histograms.items()]
+        for start in range(0, len(entries), self.chunk_size):
+            try:
+                self._socket.sendto(json.dumps(entries[start:start + self.chunk_size]), self.address)
+            except socket.error:
+                pass
+
+
+class MetricsExporter(object):
+    """
+    Serves the metrics of all worker processes over HTTP on port, receiving
+    them from their SupervisorBackends over UDP on the same port number.
+
+    tube_stats: optional callable returning {tube: stats-tube dict}, added to
+                every scrape as queue depth gauges
+    """
+
+    def __init__(self, port, tube_stats=None):
+        self.port = port
+        self.tube_stats = tube_stats
+        self.collector = Collector()
+
+    def start(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', self.port))
+        thread = threading.Thread(target=self._receive, args=(receiver,))
+        thread.daemon = True
+        thread.start()
+
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                body = exporter.render()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug(format % args)
+
+        server = BaseHTTPServer.HTTPServer(('', self.port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self, receiver):
+        while True:
+            try:
+                entries = json.loads(receiver.recv(65536))
+            except (socket.error, ValueError):
+                continue
+            counters = {}
+            histograms = {}
+            for kind, name, tube, value in entries:
+                if kind == 'c':
+                    counters[(name, tube)] = value
+                else:
+                    histograms[(name, tube)] = value
+            self.collector.merge(counters, histograms)
+
+    def render(self):
+        body = self.collector.prometheus()
+        if self.tube_stats is not None:
+            try:
+                stats = self.tube_stats()
+            except Exception:
+                logger.exception("Unable to get tube stats")
+                stats = {}
+            for state in ('ready', 'delayed', 'reserved', 'buried'):
+                metric = 'beanstalk_tube_jobs_%s' % state
+                body += '# TYPE %s gauge\n' % metric
+                for tube, tube_stats in sorted(stats.items()):
+                    body += '%s{tube="%s"} %s\n' % (metric, tube, tube_stats.get('current-jobs-%s' % state, 0))
+        return body
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'statsd': StatsdBackend,
+}
+
+_backend = None
+_last_flush = time.time()
+
+
+def load_backend():
+    path = getattr(settings, 'BEANSTALK_METRICS_BACKEND', None)
+    if not path:
+        return Backend()
+    if path in BACKENDS:
+        return BACKENDS[path]()
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = load_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the backend, e.g. with a MemoryBackend in tests; None reloads it from the settings"""
+    global _backend
+    _backend = backend
+
+
+def enabled():
+    return get_backend().enabled
+
+
+def incr(name, tube, value=1):
+    get_backend().incr(name, tube, value)
+
+
+def timing(name, tube, seconds):
+    get_backend().timing(name, tube, seconds)
+
+
+def flush():
+    global _last_flush
+    _last_flush = time.time()
+    try:
+        get_backend().flush()
+    except Exception:
+        logger.exception("Unable to flush metrics")
+
+
+def maybe_flush():
+    """Flush if the last flush is longer ago than the flush interval"""
+    if time.time() - _last_flush >= getattr(settings, 'BEANSTALK_METRICS_FLUSH_INTERVAL', 10):
+        flush()
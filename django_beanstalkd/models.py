@@ -1,19 +1,79 @@
-import json
+import uuid
 
 from django.db import models
 
+from . import serializers
+
+
+class JobDataManager(models.Manager):
+    def create_many(self, job_name, data_dicts):
+        """
+        Inserts one row per dictionary in a single query and returns their
+        primary keys in the order of data_dicts.
+        """
+        batch = uuid.uuid4().hex
+        rows = []
+        for data_dict in data_dicts:
+            row = self.model(job_name=job_name, batch=batch)
+            row.data_dict = data_dict
+            rows.append(row)
+
+        last_pk = list(self.order_by('-pk').values_list('pk', flat=True)[:1])
+        self.bulk_create(rows)
+        if all(row.pk is not None for row in rows):
+            return [row.pk for row in rows]
+
+        # bulk_create didn't set the primary keys. The new rows are the ones of
+        # this batch above the previous maximum, which keeps the lookup on the
+        # primary key index.
+        pks = self.filter(batch=batch)
+        if last_pk:
+            pks = pks.filter(pk__gt=last_pk[0])
+        return list(pks.order_by('pk').values_list('pk', flat=True))
+
 
 class JobData(models.Model):
     data = models.TextField()
     job_name = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # identifies the rows inserted together by JobData.objects.create_many
+    batch = models.CharField(max_length=32, blank=True, default='')
+
+    objects = JobDataManager()
 
     @property
     def data_dict(self):
+        # parsed once for every value of data
+        cached = getattr(self, '_data_dict_cache', None)
+        if cached is not None and cached[0] is self.data:
+            return cached[1]
         try:
-            return json.loads(self.data)
+            val = serializers.loads(self.data)
         except:
-            return {}
+            val = {}
+        self._data_dict_cache = (self.data, val)
+        return val
 
     @data_dict.setter
     def data_dict(self, val):
-        self.data = json.dumps(val)
+        self.data = serializers.dumps(val)
+        self._data_dict_cache = (self.data, val)
+
+
+class JobGroup(models.Model):
+    """A job group tracked by the database backend of django_beanstalkd.groups"""
+    group_id = models.CharField(max_length=32, primary_key=True)
+    size = models.IntegerField()
+    done = models.IntegerField(default=0)
+    # the callback job and its put options, serialized
+    callback = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class JobGroupResult(models.Model):
+    group = models.ForeignKey(JobGroup, related_name='results', on_delete=models.CASCADE)
+    index = models.IntegerField()
+    result = models.TextField()
+
+    class Meta:
+        unique_together = ('group', 'index')
@@ -0,0 +1,299 @@
+"""
+Periodic jobs.
+
+    @periodic_beanstalk_job(every=300)
+    def refresh_rates(arg): ...
+
+    @periodic_beanstalk_job(cron='30 4 * * mon-fri')
+    def send_digest(arg): ...
+
+are beanstalk jobs that are also put on schedule by the scheduler process of
+"beanstalk_worker --periodic". Cron expressions have the usual five fields
+(minute, hour, day of month, month, day of week) with lists, ranges, steps
+and names, or are one of @hourly, @daily, @weekly, @monthly and @yearly.
+They're evaluated in the local time zone, i.e. Django's TIME_ZONE. every
+runs are aligned to multiples of the interval since the epoch, so all
+schedulers agree on them.
+
+Only one scheduler puts jobs at a time: the leader, which holds the single
+job of the BEANSTALK_PERIODIC_LOCK_TUBE tube ('django_beanstalkd.periodic')
+reserved on the first server, and touches it to keep it. When the leader
+exits or hangs, beanstalkd releases the job and another scheduler reserves
+it and takes over.
+
+The leader puts each run BEANSTALK_PERIODIC_LOOKAHEAD seconds (10) ahead of
+time, with the delay left until the run, so it fires on time without the
+scheduler waking up for it. A leader that stops hands over a new lock job
+saying up to when it put the runs. A leader that died can't, so its
+successor skips the runs within the lookahead, which its predecessor may
+have put already: those runs may be lost, but aren't doubled.
+"""
+import calendar
+import datetime
+import heapq
+import logging
+import math
+import random
+import time
+
+import beanstalkc
+from beanstalkc import SocketError
+from django.conf import settings
+
+from . import metrics
+from .client import BeanstalkClient
+from .connection import connect_beanstalkd, get_servers
+from .errors import BeanstalkError
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class Every(object):
+    def __init__(self, seconds):
+        if isinstance(seconds, datetime.timedelta):
+            seconds = seconds.total_seconds()
+        if seconds <= 0:
+            raise ValueError("every must be positive")
+        self.seconds = seconds
+
+    def next_after(self, t):
+        """The first run strictly after timestamp t"""
+        return (t // self.seconds + 1) * self.seconds
+
+    def __repr__(self):
+        return 'every %ss' % self.seconds
+
+
+class Cron(object):
+    ALIASES = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+    MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.ALIASES.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression %r must have five fields" % expression)
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, self.MONTHS, 1)
+        # 7 is Sunday too
+        self.weekdays = set(day % 7 for day in self._parse(fields[4], 0, 7, self.DAYS, 0))
+        # like cron, a day matches either field if both are restricted; a
+        # field starting with * (like */2) isn't
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def _parse(self, field, low, high, names=(), first=0):
+        values = set()
+        for part in field.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            else:
+                bounds = [names.index(bound) + first if bound in names else int(bound) for bound in part.split('-')]
+                start, end = bounds[0], bounds[-1]
+                if len(bounds) == 1 and step > 1:
+                    end = high
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("Invalid cron field %r in %r" % (field, self.expression))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day):
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, t):
+        """The first run strictly after timestamp t"""
+        start = datetime.datetime.fromtimestamp(t).replace(second=0, microsecond=0)
+        moment = start + datetime.timedelta(minutes=1)
+        while moment.year <= start.year + 5:
+            if moment.month not in self.months:
+                days = calendar.monthrange(moment.year, moment.month)[1]
+                moment = moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=days)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(moment.timetuple())
+        raise ValueError("Cron expression %r never matches" % self.expression)
+
+    def __repr__(self):
+        return 'cron %r' % self.expression
+
+
+class PeriodicJob(object):
+    def __init__(self, name, schedule, arg='', priority=beanstalkc.DEFAULT_PRIORITY, ttr=beanstalkc.DEFAULT_TTR):
+        self.name = name
+        self.schedule = schedule
+        self.arg = arg
+        self.priority = priority
+        self.ttr = ttr
+
+
+# job name -> PeriodicJob
+periodic_jobs = {}
+
+
+def register(periodic_job):
+    periodic_jobs[periodic_job.name] = periodic_job
+
+
+class PeriodicScheduler(object):
+    """
+    Puts the periodic_jobs (job name -> PeriodicJob) while it's the leader.
+    run() loops until stop() is called.
+    """
+
+    def __init__(self, periodic_jobs, client=None, server=None, lookahead=None, lease=None, clock=None):
+        self.periodic_jobs = periodic_jobs
+        self.client = client or BeanstalkClient()
+        self.server = server or get_servers()[0]
+        self.lookahead = lookahead or getattr(settings, 'BEANSTALK_PERIODIC_LOOKAHEAD', 10)
+        self.lease = lease or getattr(settings, 'BEANSTALK_PERIODIC_LEASE', 30)
+        self.tube = getattr(settings, 'BEANSTALK_PERIODIC_LOCK_TUBE', 'django_beanstalkd.periodic')
+        self.clock = clock or time.time
+        self.conn = None
+        self.lock = None  # the lock job, while this scheduler is the leader
+        self.next_touch = 0
+        self.horizon = None  # the runs up to this time were put
+        self.stopping = False
+        self._runs = []  # heap of (time of the next run, job name)
+
+    def stop(self):
+        self.stopping = True
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = connect_beanstalkd(*self.server)
+            self.conn.use(self.tube)
+            self.conn.watch(self.tube)
+            self.conn.ignore('default')
+
+    def close(self):
+        self.lock = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def lock_jobs(self):
+        try:
+            stats = self.conn.stats_tube(self.tube)
+        except beanstalkc.CommandFailed:
+            return 0
+        return sum(stats['current-jobs-%s' % state] for state in ('ready', 'reserved', 'delayed', 'buried'))
+
+    def elect(self, timeout):
+        """Try to become the leader for up to timeout seconds; returns whether it did"""
+        self.connect()
+        if not self.lock_jobs():
+            self.conn.put('', ttr=self.lease)
+        job = self.conn.reserve(timeout=timeout)
+        if job is None:
+            return False
+        if self.lock_jobs() > 1:
+            # schedulers that started together put a lock job each: all of
+            # them give theirs up and try again at random times
+            job.delete()
+            time.sleep(random.uniform(0, 1))
+            return False
+        self.lock = job
+        self.next_touch = self.clock() + self.lease / 3.0
+        logger.info("Leading the scheduling of %d periodic jobs" % len(self.periodic_jobs))
+        metrics.incr('scheduler_elections', self.tube)
+
+        now = self.clock()
+        if job.stats()['reserves'] == 1:
+            # a new lock job: put by a leader that stopped, or the first one
+            self.horizon = float(job.body) if job.body else now
+        else:
+            # the previous leader died and may have put the runs within its lookahead
+            self.horizon = now + self.lookahead
+        self._runs = [(periodic_job.schedule.next_after(self.horizon), name)
+                      for name, periodic_job in self.periodic_jobs.items()]
+        heapq.heapify(self._runs)
+        return True
+
+    def hand_over(self):
+        """Replace the lock job by one telling the next leader up to when runs were put"""
+        self.lock.delete()
+        self.lock = None
+        self.conn.put(repr(self.horizon), ttr=self.lease)
+
+    def still_leading(self):
+        """Touch the lock job; returns whether this scheduler still holds it"""
+        try:
+            self.lock.touch()
+        except beanstalkc.CommandFailed:
+            logger.warning("Lost the lead of periodic jobs")
+            self.lock = None
+            return False
+        self.next_touch = self.clock() + self.lease / 3.0
+        return True
+
+    def put_due(self):
+        """Put the runs within the lookahead; returns how long to sleep before the next one"""
+        now = self.clock()
+        if self._runs and self._runs[0][0] <= now + self.lookahead and not self.still_leading():
+            return 0
+        while self._runs and self._runs[0][0] <= now + self.lookahead:
+            run, name = heapq.heappop(self._runs)
+            periodic_job = self.periodic_jobs[name]
+            if run < now - self.lookahead:
+                # the clock jumped, or the scheduler was stuck
+                logger.warning("Skipping the run of %s at %s" % (name, datetime.datetime.fromtimestamp(run)))
+            else:
+                try:
+                    self.client.call(name, periodic_job.arg, priority=periodic_job.priority,
+                                     delay=max(0, int(math.ceil(run - now))), ttr=periodic_job.ttr)
+                    metrics.incr('periodic_runs', name)
+                except BeanstalkError as e:
+                    logger.error("Unable to put the run of %s: %s" % (name, e))
+            heapq.heappush(self._runs, (periodic_job.schedule.next_after(run), name))
+        self.horizon = max(self.horizon, now + self.lookahead)
+        wake = self.next_touch
+        if self._runs:
+            wake = min(wake, self._runs[0][0] - self.lookahead)
+        return max(0, wake - self.clock())
+
+    def run(self):
+        while not self.stopping:
+            try:
+                if self.lock is None:
+                    self.elect(timeout=1)
+                    continue
+                wait = self.put_due()
+                if self.clock() >= self.next_touch and not self.still_leading():
+                    continue
+                # sleep in short steps to notice stop()
+                time.sleep(min(wait, 1.0))
+            except (BeanstalkError, SocketError, beanstalkc.CommandFailed) as e:
+                logger.warning("Beanstalk error in the periodic scheduler: %s" % e)
+                self.close()
+                time.sleep(2.0)
+        if self.lock is not None:
+            try:
+                self.hand_over()
+            except (beanstalkc.CommandFailed, SocketError):
+                pass
+        self.close()
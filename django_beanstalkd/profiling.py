@@ -0,0 +1,120 @@
+"""
+Sampling profiler of the worker's jobs.
+
+    BEANSTALK_PROFILE_SAMPLE_RATE = 100   # cProfile one in every 100 jobs of each tube
+    BEANSTALK_PROFILE_SLOW = 5.0          # seconds that make a job slow
+    BEANSTALK_PROFILE_DIR = '/var/tmp/beanstalk-profiles'
+
+The profiles of the sampled jobs of a tube add up in DIR/<tube>.<pid>.pstats,
+written again after every sample, which pstats, snakeviz or flameprof read:
+
+    python -m pstats /var/tmp/beanstalk-profiles/myapp.reindex.1234.pstats
+
+A job slower than BEANSTALK_PROFILE_SLOW is logged as a warning. If it was
+profiled, the warning has its profile's top functions and the profile is
+also written to DIR/<tube>.<pid>.slow-<time>.pstats. If it wasn't, the next
+job of its tube is profiled.
+
+Jobs that aren't sampled only cost a counter increment.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import StringIO
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from .hooks import JobHook
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+# functions listed in the log message of a slow job
+TOP_FUNCTIONS = 30
+
+
+def enabled():
+    return bool(getattr(settings, 'BEANSTALK_PROFILE_SAMPLE_RATE', 0) or
+                getattr(settings, 'BEANSTALK_PROFILE_SLOW', None))
+
+
+class SamplingProfiler(JobHook):
+    def __init__(self, sample_rate=None, slow=None, directory=None):
+        self.sample_rate = sample_rate or getattr(settings, 'BEANSTALK_PROFILE_SAMPLE_RATE', 0)
+        self.slow = slow or getattr(settings, 'BEANSTALK_PROFILE_SLOW', None)
+        self.directory = directory or getattr(settings, 'BEANSTALK_PROFILE_DIR', None) or \
+            os.path.join(tempfile.gettempdir(), 'beanstalk-profiles')
+        self.seen = {}  # tube -> jobs run
+        self.stats = {}  # tube -> pstats.Stats of its sampled jobs
+        self.trace = set()  # tubes the next job of which is profiled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def should_profile(self, job_name):
+        with self.lock:
+            seen = self.seen[job_name] = self.seen.get(job_name, 0) + 1
+            if job_name in self.trace:
+                self.trace.discard(job_name)
+                return True
+        return bool(self.sample_rate) and seen % self.sample_rate == 1 % self.sample_rate
+
+    def before(self, job_name, body):
+        self.local.profile = None
+        if self.should_profile(job_name):
+            self.local.profile = cProfile.Profile()
+            self.local.profile.enable()
+
+    def after(self, job_name, body, duration):
+        profile = self.local.profile
+        if profile is None:
+            if self.slow and duration >= self.slow:
+                logger.warning("Job %s took %.2fs, profiling the next one" % (job_name, duration))
+                with self.lock:
+                    self.trace.add(job_name)
+            return
+        profile.disable()
+        self.local.profile = None
+        self.record(job_name, profile)
+        if self.slow and duration >= self.slow:
+            self.report_slow(job_name, body, profile, duration)
+
+    def exception(self, job_name, body, exc_info, duration):
+        self.after(job_name, body, duration)
+
+    def path(self, job_name, suffix=''):
+        return os.path.join(self.directory, '%s.%d%s.pstats' % (job_name, os.getpid(), suffix))
+
+    def record(self, job_name, profile):
+        """Add profile to the stats of job_name's tube and write them"""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        except OSError:
+            # made by another worker meanwhile
+            pass
+        with self.lock:
+            stats = self.stats.get(job_name)
+            if stats is None:
+                stats = self.stats[job_name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            try:
+                stats.dump_stats(self.path(job_name))
+            except (IOError, OSError) as e:
+                logger.warning("Unable to write the profile of %s: %s" % (job_name, e))
+
+    def report_slow(self, job_name, body, profile, duration):
+        output = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        path = self.path(job_name, '.slow-%d' % time.time())
+        try:
+            stats.dump_stats(path)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write the profile of %s: %s" % (job_name, e))
+        logger.warning("Job %s with arg %r took %.2fs, profile in %s:\n%s"
+                       % (job_name, str(body)[:200], duration, path, output.getvalue()))
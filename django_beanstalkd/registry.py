@@ -0,0 +1,91 @@
+"""
+The registry of beanstalk jobs, by job name.
+
+Decorating a function with beanstalk_job registers it here. The worker
+finds the jobs by importing the beanstalk_jobs module of every installed
+app, or, with a manifest written by the beanstalk_manifest command, only the
+modules of the jobs it serves:
+
+    python manage.py beanstalk_manifest --output /srv/app/beanstalk_manifest.json
+    BEANSTALK_MANIFEST = '/srv/app/beanstalk_manifest.json'
+
+A manifest maps each job name to its module. Write it again whenever jobs
+are added, renamed or moved, e.g. as a deployment step.
+"""
+import collections
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+MODULE_NAME = 'beanstalk_jobs'
+MANIFEST_VERSION = 1
+
+# job name -> job
+jobs = collections.OrderedDict()
+
+
+def register(job):
+    name = job.get_job_name()
+    if name in jobs and jobs[name].f is not job.f:
+        logger.warning("Beanstalk job %s is defined twice, using the one of %s" % (name, job.__module__))
+    jobs[name] = job
+
+
+def get_job(name):
+    return jobs.get(name)
+
+
+def discover():
+    """Import the beanstalk_jobs module of every installed app; returns the modules' names"""
+    modules = []
+    for app in settings.INSTALLED_APPS:
+        app_module = import_module(app)
+        if not module_has_submodule(app_module, MODULE_NAME):
+            continue
+        # errors inside the module must not pass for a missing module
+        modules.append(import_module('%s.%s' % (app, MODULE_NAME)).__name__)
+    return modules
+
+
+def write_manifest(path):
+    """Write the manifest of all jobs to path; returns it"""
+    discover()
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'jobs': dict((name, job.__module__) for name, job in jobs.items()),
+    }
+    temp_path = '%s.%d' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    # workers starting meanwhile never read half a manifest
+    os.rename(temp_path, path)
+    return manifest
+
+
+def read_manifest(path):
+    """Returns the job name -> module map of the manifest at path"""
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version %r" % manifest.get('version'))
+    return manifest['jobs']
+
+
+def load(names, manifest):
+    """
+    Import the modules of the jobs names according to manifest (job name ->
+    module). Raises ImportError or ValueError if the modules are gone or
+    don't define all of them, i.e. the manifest is stale.
+    """
+    for module in sorted(set(manifest[name] for name in names)):
+        import_module(module)
+    missing = [name for name in names if name not in jobs]
+    if missing:
+        raise ValueError("The manifest is stale, jobs %s were not found" % ', '.join(sorted(missing)))
@@ -0,0 +1,248 @@
+"""
+Reserving jobs from several beanstalkd servers at once.
+"""
+import collections
+import logging
+import select
+import time
+
+import beanstalkc
+from beanstalkc import SocketError
+
+from .connection import connect_beanstalkd
+from .errors import BeanstalkError
+from .scheduling import SHARED
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class Reserver(object):
+    """
+    Reserves jobs from the watched tubes of several servers over one
+    connection per server, waiting on all of them with select.
+
+    A reserve stays pending on every server that didn't return a job, so a
+    job may arrive while another one is being processed. Jobs that were kept
+    waiting like that for more than a second are touched before they're
+    returned, which skips those whose TTR ran out in the meantime. Workers
+    that won't reserve again for a while call give_back instead, so those
+    jobs aren't held up.
+
+    Servers that can't be reached are retried every reconnect_interval
+    seconds; BeanstalkError is raised only if none can be reached.
+
+    With a TubeScheduler, there's a connection per server for each of its
+    slots. Idle slots are asked for a job that's ready right away before
+    every job, and the scheduler chooses which of the jobs they return runs
+    next; the others stay reserved until it's their turn, or until
+    give_back.
+    """
+
+    def __init__(self, servers, tubes, reconnect_interval=5, scheduler=None):
+        self.servers = servers
+        self.tubes = tubes
+        self.reconnect_interval = reconnect_interval
+        self.scheduler = scheduler
+        if scheduler is not None:
+            self.slots = [(slot, list(watched)) for slot, watched in scheduler.slots]
+        else:
+            self.slots = [(SHARED, list(tubes))]
+        self.connections = {}  # (server, slot) -> Connection
+        self._pending = {}  # socket -> Connection with a reserve in flight
+        self._buffered = collections.deque()
+        self._retry_at = {}
+
+    def connect(self):
+        now = time.time()
+        for server in self.servers:
+            for slot, watched in self.slots:
+                if (server, slot) in self.connections or now < self._retry_at.get(server, 0):
+                    continue
+                try:
+                    conn = connect_beanstalkd(*server)
+                    for tube in watched:
+                        conn.watch(tube)
+                    if 'default' not in watched:
+                        conn.ignore('default')
+                except (BeanstalkError, SocketError) as e:
+                    logger.info("Unable to connect to beanstalk server %s:%s: %s" % (server[0], server[1], e))
+                    self._retry_at[server] = now + self.reconnect_interval
+                    break
+                conn.server = server
+                conn.slot = slot
+                self.connections[server, slot] = conn
+        if not self.connections:
+            raise BeanstalkError("Unable to connect to any beanstalk server")
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+        self._pending.clear()
+        self._buffered.clear()
+
+    def ignore(self, tube):
+        """Stop watching tube on all servers"""
+        if tube not in self.tubes:
+            return
+        self.tubes = [watched for watched in self.tubes if watched != tube]
+        slots = set()
+        for slot, watched in self.slots:
+            if tube in watched:
+                watched.remove(tube)
+                slots.add(slot)
+        for conn in self.connections.values():
+            if conn.slot not in slots:
+                continue
+            self.settle(conn)
+            if self.owns(conn):
+                try:
+                    conn.ignore(tube)
+                except beanstalkc.CommandFailed:
+                    # it's the only tube watched
+                    pass
+
+    def owns(self, conn):
+        """Whether jobs reserved by conn can still be acknowledged"""
+        return self.connections.get((getattr(conn, 'server', None), getattr(conn, 'slot', None))) is conn
+
+    def _drop(self, conn, error):
+        logger.info("Lost beanstalk server %s:%s: %s" % (conn.server[0], conn.server[1], error))
+        self.connections.pop((conn.server, conn.slot), None)
+        self._pending.pop(conn._socket, None)
+        self._retry_at[conn.server] = time.time() + self.reconnect_interval
+        conn.detach()
+
+    def _read(self, conn):
+        del self._pending[conn._socket]
+        try:
+            status, results = conn._read_response()
+            if status == 'RESERVED':
+                job = beanstalkc.Job(conn, int(results[0]), conn._read_body(int(results[1])), True)
+                job.received = time.time()
+                job.slot = conn.slot
+                self._buffered.append(job)
+            elif status not in ('TIMED_OUT', 'DEADLINE_SOON'):
+                raise beanstalkc.UnexpectedResponse('reserve', status, results)
+        except (SocketError, beanstalkc.UnexpectedResponse) as e:
+            self._drop(conn, e)
+
+    def give_back(self):
+        """
+        Close the connections with a reserve pending or a job not returned
+        yet, so beanstalkd hands those jobs to other workers right away; the
+        next reserve reconnects. Jobs returned already are left alone, as
+        long as their connections are reserving nothing else.
+        """
+        conns = list(self._pending.values()) + [job.conn for job in self._buffered]
+        for conn in conns:
+            if self.owns(conn):
+                self.connections.pop((conn.server, conn.slot))
+                conn.detach()
+        self._pending.clear()
+        self._buffered.clear()
+
+    def settle(self, conn):
+        """Wait for the reserve pending on conn, so other commands can be sent on it"""
+        if conn._socket in self._pending:
+            self._read(conn)
+
+    def _send(self, command, conns):
+        for conn in conns:
+            try:
+                SocketError.wrap(conn._socket.sendall, command)
+                self._pending[conn._socket] = conn
+            except SocketError as e:
+                self._drop(conn, e)
+
+    def _idle(self):
+        """Connections that may reserve a job: no reserve in flight, no job waiting to be returned"""
+        waiting = set(job.conn for job in self._buffered)
+        return [conn for conn in self.connections.values()
+                if conn._socket not in self._pending and conn not in waiting
+                and (self.scheduler is None or self.scheduler.can_reserve(conn.slot))]
+
+    def _probe(self):
+        """Have the idle connections reserve the jobs that are ready right away"""
+        probed = self._idle()
+        self._send('reserve-with-timeout 0\r\n', probed)
+        for conn in probed:
+            self.settle(conn)
+        if self._pending:
+            readable, _, _ = select.select(list(self._pending), [], [], 0)
+            for sock in readable:
+                if sock in self._pending:
+                    self._read(self._pending[sock])
+
+    def _next(self):
+        """The buffered job to return next, if any"""
+        for job in list(self._buffered):
+            if not self.owns(job.conn):
+                # reserved by a connection that was lost; beanstalkd released it already
+                self._buffered.remove(job)
+        if self.scheduler is None or not self._buffered:
+            return self._buffered.popleft() if self._buffered else None
+        ready = dict((job.slot, job) for job in reversed(self._buffered))
+        for slot in self.scheduler.candidates(ready.keys()):
+            job = ready[slot]
+            self._buffered.remove(job)
+            if self.scheduler.acquire(slot):
+                return job
+            # the tube reached its limit meanwhile, let another worker have the job
+            try:
+                job.release(priority=job.stats()['pri'])
+            except beanstalkc.CommandFailed:
+                pass
+        return None
+
+    def _held_back(self):
+        """Whether a slot doesn't reserve jobs because its tube reached its concurrency limit"""
+        return self.scheduler is not None and not all(self.scheduler.can_reserve(slot) for slot, _ in self.slots)
+
+    def reserve(self, timeout=None):
+        """
+        Returns the next job from any server, or None if none arrived within
+        timeout seconds. With timeout=None, pending reserves never time out
+        and settle and ignore block until they return a job.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        scheduled = self.scheduler is not None and self.scheduler.enabled
+        while True:
+            self.connect()
+            if scheduled:
+                self._probe()
+            while self._buffered:
+                job = self._next()
+                if job is None:
+                    continue
+                if time.time() - job.received > 1.0:
+                    try:
+                        job.touch()
+                    except beanstalkc.CommandFailed:
+                        if self.scheduler is not None:
+                            self.scheduler.done(job)
+                        continue
+                return job
+
+            if timeout is None:
+                command = 'reserve\r\n'
+            else:
+                command = 'reserve-with-timeout %d\r\n' % max(0, int(round(deadline - time.time())))
+            self._send(command, self._idle())
+
+            wait = None if deadline is None else max(0, deadline - time.time())
+            if self._held_back():
+                # look again soon whether the limit still holds
+                wait = 0.1 if wait is None else min(wait, 0.1)
+            elif not self._pending:
+                continue
+            if self._pending:
+                readable, _, _ = select.select(list(self._pending), [], [], wait)
+                for sock in readable:
+                    if sock in self._pending:
+                        self._read(self._pending[sock])
+            else:
+                time.sleep(wait)
+            if not self._buffered and deadline is not None and time.time() >= deadline:
+                return None
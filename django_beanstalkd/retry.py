@@ -0,0 +1,131 @@
+"""
+Retry delays and circuit breaking for the retrying decorators.
+
+A RetryPolicy computes how long a failed job waits before its next attempt:
+
+    "exponential"   base * 2 ** attempt seconds, or a random delay up to
+                    that with jitter (the default), so jobs that failed
+                    together don't all come back at the same moment
+    "decorrelated"  a random delay between base and three times the
+                    previous one
+
+Either way the delay never exceeds max_delay. The defaults come from
+BEANSTALK_RETRY_STRATEGY ('exponential'), BEANSTALK_RETRY_BASE (1) and
+BEANSTALK_RETRY_MAX_DELAY (600).
+
+A CircuitBreaker watches the outcomes of a tube's jobs in a worker. Once at
+least min_calls jobs finished within the last window seconds and the share
+of failures among them reaches threshold, it pauses the tube on all servers
+with pause-tube for pause seconds, so no worker takes its jobs while the
+dependency they need recovers.
+
+Both take a random source and a clock, so tests can pass random.Random(seed)
+and a ManualClock and get the same delays and trips every time.
+"""
+import collections
+import logging
+import random as _random
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .client import BeanstalkClient
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class RetryPolicy(object):
+    STRATEGIES = ('exponential', 'decorrelated')
+
+    def __init__(self, strategy=None, base=None, max_delay=None, jitter=True, random=None):
+        if strategy is None:
+            strategy = getattr(settings, 'BEANSTALK_RETRY_STRATEGY', 'exponential')
+        self.strategy = strategy
+        if self.strategy not in self.STRATEGIES:
+            raise ValueError("Unknown retry strategy %r" % self.strategy)
+        self.base = base if base is not None else getattr(settings, 'BEANSTALK_RETRY_BASE', 1)
+        self.max_delay = max_delay if max_delay is not None else getattr(settings, 'BEANSTALK_RETRY_MAX_DELAY', 600)
+        self.jitter = jitter
+        self.random = random if random is not None else _random.Random()
+
+    def delay(self, attempt, previous=None):
+        """
+        Returns the delay in whole seconds before retry number attempt + 1.
+        previous is the delay before the last attempt, used by the
+        decorrelated strategy.
+        """
+        if self.strategy == 'decorrelated':
+            delay = self.random.uniform(self.base, max(previous or self.base, self.base) * 3)
+        else:
+            # don't compute huge powers for jobs retried forever
+            delay = self.base * 2 ** min(attempt, 62)
+            if self.jitter:
+                delay = self.random.uniform(0, min(delay, self.max_delay))
+        return int(round(min(delay, self.max_delay)))
+
+
+class ManualClock(object):
+    """A clock for tests, only moving when advanced"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=None, min_calls=None, window=None, pause=None, clock=None, client=None):
+        self.threshold = threshold if threshold is not None else getattr(settings, 'BEANSTALK_BREAKER_THRESHOLD', 0.5)
+        self.min_calls = min_calls if min_calls is not None else getattr(settings, 'BEANSTALK_BREAKER_MIN_CALLS', 20)
+        self.window = window if window is not None else getattr(settings, 'BEANSTALK_BREAKER_WINDOW', 60)
+        self.pause = pause if pause is not None else getattr(settings, 'BEANSTALK_BREAKER_PAUSE', 30)
+        self.clock = clock if clock is not None else time.time
+        self.client = client
+        self._lock = threading.Lock()
+        self._outcomes = collections.defaultdict(collections.deque)  # tube -> (time, succeeded)
+        self._failures = collections.defaultdict(int)
+        self._open_until = {}
+
+    def is_open(self, tube):
+        """Whether tube is paused by this breaker"""
+        return self.clock() < self._open_until.get(tube, 0)
+
+    def record(self, tube, succeeded):
+        """Record the outcome of a job of tube; returns whether this tripped the breaker"""
+        now = self.clock()
+        with self._lock:
+            if now < self._open_until.get(tube, 0):
+                # jobs that were running when the tube was paused
+                return False
+            outcomes = self._outcomes[tube]
+            outcomes.append((now, succeeded))
+            if not succeeded:
+                self._failures[tube] += 1
+            while outcomes[0][0] <= now - self.window:
+                if not outcomes.popleft()[1]:
+                    self._failures[tube] -= 1
+            tripped = len(outcomes) >= self.min_calls and self._failures[tube] >= self.threshold * len(outcomes)
+            if tripped:
+                self._open_until[tube] = now + self.pause
+                outcomes.clear()
+                self._failures[tube] = 0
+        if tripped:
+            self.trip(tube)
+        return tripped
+
+    def trip(self, tube):
+        logger.warning("Too many failures in %s, pausing the tube for %s seconds" % (tube, self.pause))
+        metrics.incr('breaker_trips', tube)
+        try:
+            if self.client is None:
+                self.client = BeanstalkClient()
+            self.client.pause_tube(tube, self.pause)
+        except Exception:
+            logger.exception("Unable to pause tube %s" % tube)
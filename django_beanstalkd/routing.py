@@ -0,0 +1,149 @@
+"""
+Choosing the beanstalkd server a job is put on.
+
+With several servers in BEANSTALK_SERVERS, the router configured with
+BEANSTALK_ROUTER decides which server a client tries first for a tube; the
+others are tried in order if it's down:
+
+    "hash"          consistent hashing of the tube name (default), so jobs of
+                    a tube stay on the same server as long as it's up
+    "round_robin"   every put goes to the next server
+    "least_loaded"  the server with the fewest ready jobs, from stats that
+                    are refreshed every BEANSTALK_ROUTER_STATS_INTERVAL seconds
+
+or the dotted path of a Router subclass.
+"""
+import bisect
+import hashlib
+import importlib
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .connection import get_pool, get_servers
+
+
+logger = logging.getLogger('django_beanstalkd')
+
+
+class Router(object):
+    def __init__(self, pools):
+        self.pools = pools
+
+    def order(self, tube):
+        """Returns the pools to try for tube, best first"""
+        return list(self.pools)
+
+    def route(self, tube):
+        """Like order, but servers that recently failed are tried last"""
+        pools = self.order(tube)
+        if len(pools) == 1:
+            return pools
+        return [pool for pool in pools if not pool.is_down()] + [pool for pool in pools if pool.is_down()]
+
+
+class HashRouter(Router):
+    # points per server on the ring, evening out the distribution
+    replicas = 100
+
+    def __init__(self, pools):
+        super(HashRouter, self).__init__(pools)
+        ring = []
+        for pool in pools:
+            for i in range(self.replicas):
+                ring.append((self._hash('%s:%s-%d' % (pool.server, pool.port, i)), pool))
+        ring.sort(key=lambda point: point[0])
+        self._keys = [point[0] for point in ring]
+        self._ring = [point[1] for point in ring]
+        self._orders = {}
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def order(self, tube):
+        try:
+            return self._orders[tube]
+        except KeyError:
+            pass
+        order = []
+        start = bisect.bisect(self._keys, self._hash(tube))
+        for i in range(len(self._ring)):
+            pool = self._ring[(start + i) % len(self._ring)]
+            if pool not in order:
+                order.append(pool)
+                if len(order) == len(self.pools):
+                    break
+        self._orders[tube] = order
+        return order
+
+
+class RoundRobinRouter(Router):
+    def __init__(self, pools):
+        super(RoundRobinRouter, self).__init__(pools)
+        self._counter = itertools.count()
+
+    def order(self, tube):
+        start = next(self._counter) % len(self.pools)
+        return self.pools[start:] + self.pools[:start]
+
+
+class LeastLoadedRouter(Router):
+    def __init__(self, pools):
+        super(LeastLoadedRouter, self).__init__(pools)
+        self.interval = getattr(settings, 'BEANSTALK_ROUTER_STATS_INTERVAL', 5)
+        self._lock = threading.Lock()
+        self._loads = {}
+        self._refreshed = 0
+
+    def refresh(self):
+        loads = {}
+        for pool in self.pools:
+            if pool.is_down():
+                continue
+            try:
+                with pool.connection() as beanstalk:
+                    loads[pool] = beanstalk.stats()['current-jobs-ready']
+            except Exception as e:
+                logger.info("Unable to get stats of %r: %s" % (pool, e))
+                pool.mark_down()
+        self._loads = loads
+
+    def order(self, tube):
+        if time.time() - self._refreshed > self.interval and self._lock.acquire(False):
+            try:
+                self._refreshed = time.time()
+                self.refresh()
+            finally:
+                self._lock.release()
+        loads = self._loads
+        return sorted(self.pools, key=lambda pool: loads.get(pool, float('inf')))
+
+
+ROUTERS = {
+    'hash': HashRouter,
+    'round_robin': RoundRobinRouter,
+    'least_loaded': LeastLoadedRouter,
+}
+
+_routers = {}
+
+
+def get_router(servers=None):
+    """Returns the process-wide router for servers, by default all servers from the settings"""
+    servers = tuple(servers or get_servers())
+    try:
+        return _routers[servers]
+    except KeyError:
+        pass
+    path = getattr(settings, 'BEANSTALK_ROUTER', 'hash')
+    if path in ROUTERS:
+        router_class = ROUTERS[path]
+    else:
+        module, name = path.rsplit('.', 1)
+        router_class = getattr(importlib.import_module(module), name)
+    router = _routers[servers] = router_class([get_pool(server, port) for server, port in servers])
+    return router
@@ -0,0 +1,144 @@
+"""
+Weighted, concurrency-limited tube scheduling in the worker.
+
+Jobs can be given a weight and a concurrency limit, in their decorator or
+per tube with BEANSTALK_TUBE_WEIGHTS and BEANSTALK_TUBE_CONCURRENCY
+({'app.job': value}), which take precedence.
+
+Each tube with a weight other than 1 or a concurrency limit gets a slot of
+its own: a connection per server watching only that tube. All other tubes
+share one slot. When several slots have a job ready, the worker runs the
+one of the slot that got the least of the worker relative to its weight
+(stride scheduling): with weights 10 and 1, ten jobs of the first tube run
+for each job of the second while both have work, and a flood in one tube
+can't starve another. The jobs of the other slots stay reserved meanwhile.
+
+A slot whose tube reached its concurrency limit doesn't reserve jobs. The
+limit holds across all the workers of a beanstalk_worker command.
+"""
+import fnmatch
+import multiprocessing
+
+from django.conf import settings
+
+
+# the slot of the tubes without a weight or concurrency limit of their own
+SHARED = '*'
+
+
+def get_options(jobs):
+    """Returns (weights, limits) of the jobs in jobs (job name -> job)"""
+    weights = {}
+    limits = {}
+    for name, job in jobs.items():
+        if getattr(job, 'weight', 1) != 1:
+            weights[name] = job.weight
+        if getattr(job, 'concurrency', None):
+            limits[name] = job.concurrency
+    weights.update(getattr(settings, 'BEANSTALK_TUBE_WEIGHTS', {}))
+    limits.update(getattr(settings, 'BEANSTALK_TUBE_CONCURRENCY', {}))
+    return weights, dict((tube, limit) for tube, limit in limits.items() if limit)
+
+
+def select_tubes(tubes, include=None, exclude=None):
+    """
+    The tubes matching one of the comma separated shell patterns of include
+    (all if None) and none of those of exclude
+    """
+    def matches(tube, patterns):
+        return any(fnmatch.fnmatchcase(tube, pattern.strip()) for pattern in patterns.split(','))
+    return sorted(tube for tube in tubes
+                  if (include is None or matches(tube, include)) and (exclude is None or not matches(tube, exclude)))
+
+
+class SlotCounts(object):
+    """
+    Jobs running per limited tube, in shared memory so the workers forked
+    by the same supervisor see each other's. Each worker counts its own jobs
+    in a row of its own, which the supervisor clears when the worker exits.
+    """
+
+    def __init__(self, tubes, workers=1):
+        self.columns = dict((tube, index) for index, tube in enumerate(sorted(tubes)))
+        self.row = 0
+        self.workers = workers
+        self._counts = multiprocessing.Array('i', len(self.columns) * workers) if self.columns else None
+
+    def _cells(self, tube):
+        return self._counts[self.columns[tube]::len(self.columns)]
+
+    def running(self, tube):
+        return sum(self._cells(tube))
+
+    def acquire(self, tube, limit):
+        """Count a job of tube in this worker, unless limit of them are running already"""
+        with self._counts.get_lock():
+            if self.running(tube) >= limit:
+                return False
+            self._counts[self.row * len(self.columns) + self.columns[tube]] += 1
+        return True
+
+    def release(self, tube):
+        with self._counts.get_lock():
+            self._counts[self.row * len(self.columns) + self.columns[tube]] -= 1
+
+    def clear(self, row):
+        """Forget the jobs of the worker of row, which exited"""
+        if self._counts is None:
+            return
+        with self._counts.get_lock():
+            for column in range(len(self.columns)):
+                self._counts[row * len(self.columns) + column] = 0
+
+
+class TubeScheduler(object):
+    def __init__(self, tubes, weights=None, limits=None, counts=None):
+        weights = weights or {}
+        self.limits = dict((tube, limit) for tube, limit in (limits or {}).items() if tube in tubes)
+        self.weights = dict((tube, weights.get(tube, 1)) for tube in tubes)
+        for tube, weight in self.weights.items():
+            if weight <= 0:
+                raise ValueError("The weight of %s must be positive" % tube)
+
+        own = sorted(tube for tube in tubes if self.weights[tube] != 1 or tube in self.limits)
+        shared = [tube for tube in tubes if tube not in own]
+        # (slot, tubes watched by the slot)
+        self.slots = [(tube, [tube]) for tube in own] + ([(SHARED, shared)] if shared else [])
+        self.weights[SHARED] = 1
+        self.counts = counts or SlotCounts(self.limits)
+        self._passes = dict((slot, 0.0) for slot, watched in self.slots)
+        self._now = 0.0
+
+    @property
+    def enabled(self):
+        """Whether there's anything to schedule, i.e. more than one slot"""
+        return len(self.slots) > 1
+
+    def can_reserve(self, slot):
+        limit = self.limits.get(slot)
+        return limit is None or self.counts.running(slot) < limit
+
+    def candidates(self, slots):
+        """slots that have a job ready, in the order they should be run"""
+        for slot in slots:
+            # a slot that had no work doesn't get to catch up on the others
+            self._passes[slot] = max(self._passes[slot], self._now)
+        return sorted(slots, key=lambda slot: (self._passes[slot], slot))
+
+    def acquire(self, slot):
+        """
+        Take a job of slot, the first of the candidates the limit of which
+        allows it; returns whether it did.
+        """
+        limit = self.limits.get(slot)
+        if limit is not None and not self.counts.acquire(slot, limit):
+            return False
+        self._now = self._passes[slot]
+        self._passes[slot] += 1.0 / self.weights[slot]
+        return True
+
+    def done(self, job):
+        """A job returned by the Reserver finished"""
+        slot = getattr(job, 'slot', SHARED)
+        if slot in self.limits:
+            self.counts.release(slot)
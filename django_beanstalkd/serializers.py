@@ -0,0 +1,162 @@
+"""
+Encoding of job data and large job bodies.
+
+Payloads stay plain JSON (for job data) or the plain string (for bodies)
+unless another serializer is configured or they are large enough to be
+compressed. Encoded payloads start with a version header:
+
+    ~1<serializer><compression><encoding><payload>
+
+serializer:  j (JSON), m (msgpack), s (a plain string, for job bodies)
+compression: - (none), z (zlib), x (zstd)
+encoding:    r (raw bytes), b (base64, for text columns)
+
+Plain JSON never starts with "~", so rows written before the header existed
+are still read correctly.
+
+Settings:
+    BEANSTALK_SERIALIZER: "json" (default) or "msgpack"
+    BEANSTALK_COMPRESSION: None (default), "zlib" or "zstd"
+    BEANSTALK_COMPRESSION_THRESHOLD: payloads of at least this many bytes are
+                                     compressed (default 4096)
+"""
+import base64
+import json
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+HEADER = '~1'
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImproperlyConfigured('The msgpack serializer requires msgpack to be installed')
+    return msgpack
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured('zstd compression requires zstandard to be installed')
+    return zstandard
+
+
+SERIALIZERS = {
+    'json': 'j',
+    'msgpack': 'm',
+}
+
+COMPRESSIONS = {
+    None: '-',
+    'zlib': 'z',
+    'zstd': 'x',
+}
+
+
+def _serialize(serializer, obj):
+    if serializer == 'j':
+        return json.dumps(obj, separators=(',', ':'))
+    elif serializer == 'm':
+        return _msgpack().packb(obj, use_bin_type=True)
+    return obj
+
+
+def _deserialize(serializer, payload):
+    if serializer == 'j':
+        return json.loads(payload)
+    elif serializer == 'm':
+        return _msgpack().unpackb(payload, raw=False)
+    return payload
+
+
+def _compress(compression, payload):
+    if compression == 'z':
+        return zlib.compress(payload)
+    elif compression == 'x':
+        return _zstandard().ZstdCompressor().compress(payload)
+    return payload
+
+
+def _decompress(compression, payload):
+    if compression == 'z':
+        return zlib.decompress(payload)
+    elif compression == 'x':
+        return _zstandard().ZstdDecompressor().decompress(payload)
+    return payload
+
+
+def _settings():
+    try:
+        serializer = SERIALIZERS[getattr(settings, 'BEANSTALK_SERIALIZER', 'json')]
+        compression = COMPRESSIONS[getattr(settings, 'BEANSTALK_COMPRESSION', None)]
+    except KeyError, e:
+        raise ImproperlyConfigured('Unknown beanstalk serializer or compression %s' % e)
+    return serializer, compression, getattr(settings, 'BEANSTALK_COMPRESSION_THRESHOLD', 4096)
+
+
+def _encode(serializer, payload, text):
+    compression = '-'
+    configured_compression, threshold = _settings()[1:]
+    if len(payload) >= threshold:
+        compression = configured_compression
+        payload = _compress(compression, payload)
+    if serializer == 'j' and compression == '-':
+        return payload
+
+    # only uncompressed JSON is known to be text
+    encoding = 'b' if text else 'r'
+    if encoding == 'b':
+        payload = base64.b64encode(payload)
+    return '%s%s%s%s%s' % (HEADER, serializer, compression, encoding, payload)
+
+
+def _decode(data):
+    serializer, compression, encoding = data[2:5]
+    payload = data[5:]
+    if encoding == 'b':
+        payload = base64.b64decode(payload)
+    return serializer, _decompress(compression, payload)
+
+
+def dumps(obj, text=True):
+    """
+    Serializes obj with the configured serializer. With text=True, the
+    result is safe to store in a text column.
+    """
+    serializer = _settings()[0]
+    return _encode(serializer, _serialize(serializer, obj), text)
+
+
+def loads(data):
+    """Inverse of dumps; also reads plain JSON"""
+    if not data.startswith(HEADER):
+        return json.loads(data)
+    serializer, payload = _decode(data)
+    return _deserialize(serializer, payload)
+
+
+def compress_body(body, text=False):
+    """
+    Returns the encoded body if it's large enough to be compressed and
+    compression is configured, otherwise None.
+    """
+    compression, threshold = _settings()[1:]
+    if compression == '-' or len(body) < threshold:
+        return None
+    return _encode('s', body, text)
+
+
+def encode_body(body, text=True):
+    """Returns body encoded for a text column, compressed if configured"""
+    return compress_body(body, text) or _encode('s', body, text)
+
+
+def decode_body(data):
+    """Inverse of compress_body and encode_body"""
+    return _decode(data)[1]
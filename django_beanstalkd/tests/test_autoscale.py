@@ -0,0 +1,92 @@
+from django.test import SimpleTestCase
+
+from django_beanstalkd.autoscale import Autoscaler, TubeStats, parse_autoscale
+from django_beanstalkd.retry import ManualClock
+
+
+class StubStats(object):
+    def __init__(self):
+        self.counts = {'current-jobs-ready': 0, 'total-jobs': 0, 'cmd-delete': 0}
+
+    def total(self, key):
+        return self.counts[key]
+
+
+class StubClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def stats_tubes(self, tubes):
+        self.calls += 1
+        return dict((tube, {'current-jobs-ready': 2}) for tube in tubes)
+
+
+class AutoscalerTest(SimpleTestCase):
+    def setUp(self):
+        self.clock = ManualClock(1000.0)
+        self.stats = StubStats()
+        self.autoscaler = Autoscaler(1, 8, self.stats, drain_time=30, hysteresis=0.25, up_cooldown=10,
+                                     down_cooldown=60, clock=self.clock)
+
+    def poll(self, workers, after=10, ready=0, put=0, deleted=0):
+        """Polls after seconds in which put jobs were put and deleted deleted, ready being ready"""
+        self.clock.advance(after)
+        self.stats.counts['current-jobs-ready'] = ready
+        self.stats.counts['total-jobs'] += put
+        self.stats.counts['cmd-delete'] += deleted
+        return self.autoscaler.poll(workers)
+
+    def test_first_poll_keeps_the_workers(self):
+        self.assertEqual(self.poll(2, ready=1000), 2)
+
+    def test_grows_to_clear_the_backlog(self):
+        self.poll(2)
+        # 3 put/s and 1 done/s per busy worker: 3 workers keep up, 3 more clear 90 jobs in 30s
+        self.assertEqual(self.poll(2, ready=90, put=30, deleted=20), 6)
+        # the up cooldown
+        self.assertEqual(self.poll(6, after=5, ready=90, put=15, deleted=10), 6)
+        self.assertEqual(self.poll(6, after=5, ready=90, put=15, deleted=10), 8)
+
+    def test_bounds(self):
+        self.poll(2)
+        self.assertEqual(self.poll(2, ready=10000, put=1000, deleted=20), 8)
+        self.clock.advance(60)
+        self.assertEqual(self.poll(8), 7)
+        self.autoscaler.low = 7
+        self.clock.advance(60)
+        self.assertEqual(self.poll(7), 7)
+
+    def test_shrinks_one_worker_at_a_time_past_the_hysteresis(self):
+        self.poll(6)
+        self.autoscaler.per_worker = 1.0
+        # 5 workers wanted: within the margin
+        self.assertEqual(self.poll(6, put=50, deleted=50), 6)
+        # 2 wanted, one retired per down cooldown
+        self.assertEqual(self.poll(6, put=20, deleted=20), 5)
+        self.assertEqual(self.poll(5, after=30, put=60, deleted=60), 5)
+        self.assertEqual(self.poll(5, after=30, put=60, deleted=60), 4)
+
+    def test_keeps_the_workers_when_a_server_restarted(self):
+        self.poll(2, put=1000, deleted=1000)
+        self.stats.counts['total-jobs'] = self.stats.counts['cmd-delete'] = 0
+        self.assertEqual(self.poll(2, ready=1000), 2)
+
+
+class TubeStatsTest(SimpleTestCase):
+    def test_cached(self):
+        clock = ManualClock()
+        client = StubClient()
+        stats = TubeStats(client, ['a', 'b'], max_age=1.0, clock=clock)
+        self.assertEqual(stats.total('current-jobs-ready'), 4)
+        self.assertEqual(stats.total('cmd-delete'), 0)
+        self.assertEqual(client.calls, 1)
+        clock.advance(1)
+        stats.total('current-jobs-ready')
+        self.assertEqual(client.calls, 2)
+
+
+class ParseAutoscaleTest(SimpleTestCase):
+    def test_parse(self):
+        self.assertEqual(parse_autoscale('2,16'), (2, 16))
+        for value in ('2', '0,4', '4,2', 'a,b'):
+            self.assertRaises(ValueError, parse_autoscale, value)
@@ -0,0 +1,59 @@
+import time
+
+from django.test import TransactionTestCase
+
+from django_beanstalkd import BeanstalkClient, batched_beanstalk_job, batching
+from django_beanstalkd.retry import RetryPolicy
+
+from .utils import take_bodies
+
+
+failures = set()
+
+
+@batched_beanstalk_job(max_items=3, max_wait=100, max_retries=2, retry_policy=RetryPolicy(jitter=False))
+def reindex(pks):
+    return dict((index, 'failed') for index, pk in enumerate(pks) if pk in failures)
+
+
+class BatchingTest(TransactionTestCase):
+    tube = 'tests.reindex'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def tearDown(self):
+        batching.flush()
+        failures.clear()
+
+    def take_batches(self):
+        return [batching.decode_batch(body) for body in take_bodies(self.tube)]
+
+    def test_full_batches_are_put_at_once(self):
+        client = BeanstalkClient()
+        self.assertEqual([client.call_batched(self.tube, pk) for pk in range(3)][:2], [None, None])
+        client.call_batched(self.tube, 3)
+        self.assertEqual(self.take_batches(), [([0, 1, 2], 0, 0)])
+        batching.flush()
+        self.assertEqual(self.take_batches(), [([3], 0, 0)])
+
+    def test_batches_are_put_after_max_wait(self):
+        BeanstalkClient().call_batched(self.tube, 1)
+        self.assertEqual(self.take_batches(), [])
+        time.sleep(0.3)
+        self.assertEqual(self.take_batches(), [([1], 0, 0)])
+
+    def test_only_failed_items_are_retried(self):
+        failures.update([2, 3])
+        reindex(batching.encode_batch([1, 2, 3]))
+        [(items, attempt, delay)] = self.take_batches()
+        self.assertEqual((items, attempt, delay), ([2, 3], 1, 1))
+
+        # the retry policy is given the delay of the last retry
+        reindex(batching.encode_batch(items, attempt, delay))
+        self.assertEqual(self.take_batches(), [([2, 3], 2, 2)])
+
+    def test_gives_up_after_max_retries(self):
+        failures.add(1)
+        reindex(batching.encode_batch([1], 2, 2))
+        self.assertEqual(self.take_batches(), [])
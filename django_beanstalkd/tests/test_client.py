@@ -0,0 +1,83 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TransactionTestCase
+
+from django_beanstalkd import BeanstalkClient, connect_beanstalkd
+from django_beanstalkd.client import put_many
+from django_beanstalkd.envelope import SpilledBody, job_tube
+
+from .utils import take_bodies
+
+
+class CallManyTest(SimpleTestCase):
+    tube = 'tests.call_many'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def test_returns_the_job_ids_in_order(self):
+        client = BeanstalkClient()
+        job_ids = client.call_many(self.tube, [str(i) for i in range(7)], chunk_size=3)
+        self.assertEqual(len(job_ids), 7)
+        self.assertEqual(job_ids, sorted(job_ids))
+        self.assertEqual(take_bodies(self.tube), [str(i) for i in range(7)])
+
+    def test_unicode_bodies_are_refused_before_anything_is_written(self):
+        beanstalk = connect_beanstalkd()
+        try:
+            beanstalk.use(self.tube)
+            self.assertRaises(AssertionError, put_many, beanstalk, ['ascii', u'caf\xe9'])
+            # the connection is still in step with the server
+            self.assertEqual(len(put_many(beanstalk, ['after'])), 1)
+        finally:
+            beanstalk.close()
+        self.assertEqual(take_bodies(self.tube), ['after'])
+
+
+class EnvelopeTest(SimpleTestCase):
+    tube = 'tests.envelope'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def raw_bodies(self):
+        beanstalk = connect_beanstalkd()
+        try:
+            beanstalk.watch(self.tube)
+            beanstalk.ignore('default')
+            jobs = []
+            while True:
+                job = beanstalk.reserve(timeout=0)
+                if job is None:
+                    return jobs
+                jobs.append((job.body, job_tube(job)[:2]))
+                job.delete()
+        finally:
+            beanstalk.close()
+
+    def test_off_by_default(self):
+        BeanstalkClient().call(self.tube, 'plain')
+        self.assertEqual(self.raw_bodies(), [('plain', (self.tube, 'plain'))])
+
+    def test_prefixes_the_tube(self):
+        with self.settings(BEANSTALK_JOB_ENVELOPE=True):
+            BeanstalkClient().call_many(self.tube, ['wrapped'])
+        self.assertEqual(self.raw_bodies(), [('\0tests.envelope\0wrapped', (self.tube, 'wrapped'))])
+
+
+class SpillTest(TransactionTestCase):
+    tube = 'tests.spill'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def test_large_bodies_are_stored_in_the_database(self):
+        with self.settings(BEANSTALK_JOB_ENVELOPE=True, BEANSTALK_SPILL_THRESHOLD=100):
+            BeanstalkClient().call(self.tube, 'x' * 200)
+        [body] = take_bodies(self.tube)
+        self.assertTrue(isinstance(body, SpilledBody))
+        self.assertEqual(body.load(), 'x' * 200)
+
+    def test_spilling_needs_the_envelope(self):
+        with self.settings(BEANSTALK_SPILL_THRESHOLD=100):
+            self.assertRaises(ImproperlyConfigured, BeanstalkClient().call, self.tube, 'x' * 200)
+        self.assertEqual(take_bodies(self.tube), [])
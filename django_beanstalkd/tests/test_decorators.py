@@ -0,0 +1,55 @@
+import json
+import threading
+
+from django.test import TransactionTestCase
+
+from django_beanstalkd import retry_data_beanstalk_job
+from django_beanstalkd.executors import ThreadExecutor
+from django_beanstalkd.models import JobData
+from django_beanstalkd.retry import RetryPolicy
+
+from .utils import take_bodies
+
+
+@retry_data_beanstalk_job(max_retries=5, retry_policy=RetryPolicy(jitter=False))
+def load_profile(data):
+    pass
+
+
+class RetryDataConcurrencyTest(TransactionTestCase):
+    tube = 'tests.load_profile'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def tearDown(self):
+        if 'get' in vars(JobData.objects):
+            del JobData.objects.get
+
+    def test_jobs_running_at_once_keep_their_own_data(self):
+        first_looking_up = threading.Event()
+        second_looking_up = threading.Event()
+        get = JobData.objects.get
+
+        def get_after_the_second_job_started(**kwargs):
+            if kwargs['pk'] == 1001:
+                first_looking_up.set()
+                # the second job loads its data in the meantime
+                second_looking_up.wait(5)
+            else:
+                second_looking_up.set()
+            return get(**kwargs)
+        JobData.objects.get = get_after_the_second_job_started
+
+        executor = ThreadExecutor(2, lambda task: load_profile(task.body) or True)
+        executor.submit(None, self.tube, json.dumps({'jobdata_pk': 1001}))
+        first_looking_up.wait(5)
+        executor.submit(None, self.tube, json.dumps({'jobdata_pk': 1002, 'attempt': 3}))
+        finished = []
+        while len(finished) < 2:
+            finished += executor.finished(timeout=5)
+
+        # both rows are missing, so both jobs were put again with their own data
+        retries = sorted(json.loads(body) for body in take_bodies(self.tube))
+        self.assertEqual(retries, [{'jobdata_pk': 1001, 'attempt': 2, 'delay': 2},
+                                   {'jobdata_pk': 1002, 'attempt': 4, 'delay': 8}])
@@ -0,0 +1,82 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TransactionTestCase
+
+from django_beanstalkd import BeanstalkClient, DataBeanstalkClient, dedupe
+from django_beanstalkd.connection import connect_beanstalkd
+from django_beanstalkd.envelope import unwrap
+from django_beanstalkd.executors import InFlightJob, set_current_job
+from django_beanstalkd.management.commands.beanstalk_worker import Command
+
+from .utils import take_bodies
+
+
+class DedupeTest(TransactionTestCase):
+    tube = 'tests.dedupe'
+
+    def setUp(self):
+        take_bodies(self.tube)
+        dedupe.set_store(None)
+
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+        dedupe.set_store(None)
+
+    def reserve(self):
+        beanstalk = connect_beanstalkd()
+        beanstalk.watch(self.tube)
+        return beanstalk.reserve(timeout=0)
+
+    def test_drops_calls_while_a_job_is_pending(self):
+        client = BeanstalkClient()
+        with self.settings(BEANSTALK_JOB_ENVELOPE=True):
+            self.assertNotEqual(client.call(self.tube, 'a', dedupe_key='key'), None)
+            self.assertEqual(client.call(self.tube, 'b', dedupe_key='key'), None)
+            self.assertNotEqual(client.call(self.tube, 'c', dedupe_key='other'), None)
+
+            # the worker releases the key once the job is done
+            job = self.reserve()
+            tube, body, enqueued_at, dedupe_key, member = unwrap(job.body)
+            Command().finish_job(job, tube, True, dedupe_key)
+            self.assertNotEqual(client.call(self.tube, 'd', dedupe_key='key'), None)
+        self.assertEqual(take_bodies(self.tube), ['c', 'd'])
+
+    def test_needs_the_envelope(self):
+        self.assertRaises(ImproperlyConfigured, BeanstalkClient().call, self.tube, 'a', dedupe_key='key')
+        self.assertRaises(ImproperlyConfigured, DataBeanstalkClient().call, self.tube, {}, dedupe_key='key')
+        self.assertEqual(take_bodies(self.tube), [])
+        # nothing was claimed
+        with self.settings(BEANSTALK_JOB_ENVELOPE=True):
+            self.assertNotEqual(BeanstalkClient().call(self.tube, 'a', dedupe_key='key'), None)
+
+    def test_retries_take_over_the_key(self):
+        client = BeanstalkClient()
+        with self.settings(BEANSTALK_JOB_ENVELOPE=True):
+            client.call(self.tube, 'first', dedupe_key='key')
+            job = self.reserve()
+            tube, body, enqueued_at, dedupe_key, member = unwrap(job.body)
+            task = InFlightJob(job, tube, body, dedupe_key)
+            set_current_job(task)
+            try:
+                self.assertNotEqual(client.call_again(self.tube, 'retry'), None)
+            finally:
+                set_current_job(None)
+            self.assertEqual(task.dedupe_key, None)
+            job.delete()
+            # the retry is still pending
+            self.assertEqual(client.call(self.tube, 'again', dedupe_key='key'), None)
+        self.assertEqual(take_bodies(self.tube), ['retry'])
+
+    def test_refuses_process_local_caches(self):
+        caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with self.settings(CACHES=caches):
+            self.assertRaises(ImproperlyConfigured, dedupe.CacheStore)
+
+    def test_memory_store_keeps_keys_shortly(self):
+        store = dedupe.MemoryStore(ttl=0.05)
+        self.assertTrue(store.add('key', 3600))
+        self.assertFalse(store.add('key', 3600))
+        time.sleep(0.1)
+        self.assertTrue(store.add('key', 3600))
@@ -0,0 +1,94 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from django_beanstalkd import BeanstalkClient, DataBeanstalkClient, dedupe
+from django_beanstalkd.models import JobData
+
+from .utils import take_bodies
+
+
+class Rollback(Exception):
+    pass
+
+
+class DeferredTest(TransactionTestCase):
+    tube = 'tests.deferred'
+
+    def setUp(self):
+        take_bodies(self.tube)
+
+    def test_put_on_commit(self):
+        client = BeanstalkClient()
+        with transaction.atomic():
+            self.assertEqual(client.call(self.tube, 'a'), None)
+            self.assertEqual(client.call_many(self.tube, ['b', 'c']), [None, None])
+            self.assertEqual(take_bodies(self.tube), [])
+        self.assertEqual(take_bodies(self.tube), ['a', 'b', 'c'])
+
+    def test_dropped_on_rollback(self):
+        client = BeanstalkClient()
+        try:
+            with transaction.atomic():
+                client.call(self.tube, 'a')
+                raise Rollback
+        except Rollback:
+            pass
+        client.call(self.tube, 'b')
+        self.assertEqual(take_bodies(self.tube), ['b'])
+
+    def test_savepoint_rollback_drops_the_puts_of_its_block(self):
+        client = BeanstalkClient()
+        with transaction.atomic():
+            client.call(self.tube, 'outer')
+            try:
+                with transaction.atomic():
+                    client.call(self.tube, 'inner')
+                    raise Rollback
+            except Rollback:
+                pass
+            with transaction.atomic():
+                client.call(self.tube, 'kept')
+        self.assertEqual(take_bodies(self.tube), ['outer', 'kept'])
+
+    def test_turned_off(self):
+        with transaction.atomic():
+            self.assertNotEqual(BeanstalkClient(defer=False).call(self.tube, 'a'), None)
+            with self.settings(BEANSTALK_DEFER_ON_COMMIT=False):
+                self.assertNotEqual(BeanstalkClient().call(self.tube, 'b'), None)
+            self.assertEqual(take_bodies(self.tube), ['a', 'b'])
+
+    def test_job_data_is_visible_to_the_job(self):
+        client = DataBeanstalkClient()
+        with transaction.atomic():
+            client.call(self.tube, {'a': 1})
+            self.assertEqual(take_bodies(self.tube), [])
+        pks = take_bodies(self.tube)
+        self.assertEqual([JobData.objects.get(pk=pk).data_dict for pk in pks], [{'a': 1}])
+
+        try:
+            with transaction.atomic():
+                client.call(self.tube, {'a': 2})
+                raise Rollback
+        except Rollback:
+            pass
+        self.assertEqual(take_bodies(self.tube), [])
+        self.assertEqual(JobData.objects.count(), 1)
+
+    def test_rollback_releases_dedupe_keys(self):
+        dedupe.set_store(None)
+        client = BeanstalkClient()
+        try:
+            with self.settings(BEANSTALK_JOB_ENVELOPE=True):
+                try:
+                    with transaction.atomic():
+                        client.call(self.tube, 'a', dedupe_key='key')
+                        raise Rollback
+                except Rollback:
+                    pass
+                with transaction.atomic():
+                    client.call(self.tube, 'b', dedupe_key='key')
+        finally:
+            cache.clear()
+            dedupe.set_store(None)
+        self.assertEqual(take_bodies(self.tube), ['b'])
@@ -0,0 +1,176 @@
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+from django_beanstalkd import (BeanstalkBatchError, BeanstalkClient, BeanstalkRetryError, DataBeanstalkClient,
+                               backoff_beanstalk_job, beanstalk_job, groups)
+from django_beanstalkd.connection import connect_beanstalkd
+from django_beanstalkd.envelope import job_tube
+from django_beanstalkd.executors import InFlightJob
+from django_beanstalkd.management.commands.beanstalk_worker import Command
+from django_beanstalkd.models import JobData, JobGroup
+from django_beanstalkd.retry import RetryPolicy
+
+from .utils import take_jobs
+
+
+@backoff_beanstalk_job(max_retries=1, uses_db=False, retry_policy=RetryPolicy(max_delay=0))
+def fetch_shard(data):
+    if data['fail']:
+        raise BeanstalkRetryError('unavailable')
+    return data['shard']
+
+
+@beanstalk_job(uses_db=False)
+def merge_shards(arg):
+    pass
+
+
+class FailingClient(DataBeanstalkClient):
+    """Puts the first member, fails to put the second and loses the connection before the third"""
+
+    def _put_many(self, func, bodies, priority, delay, ttr, chunk_size=None):
+        raise BeanstalkBatchError([1, None, None], [(1, 'JOB_TOO_BIG'), (2, 'SOCKET_ERROR')])
+
+
+class GroupTestMixin(object):
+    tubes = ('tests.fetch_shard', 'tests.merge_shards')
+
+    def setUp(self):
+        for tube in self.tubes:
+            take_jobs(tube)
+        self.worker = Command()
+        self.worker.jobs = {'tests.fetch_shard': fetch_shard}
+        self.worker.hooks = []
+        self.beanstalk = connect_beanstalkd()
+        self.beanstalk.watch('tests.fetch_shard')
+        self.beanstalk.ignore('default')
+
+    def tearDown(self):
+        self.beanstalk.close()
+        for tube in self.tubes:
+            take_jobs(tube)
+        groups.set_backend(None)
+
+    def call_group(self, fails):
+        """Put a group fetching a shard per item of fails, which tells whether its first run fails"""
+        args = [json.dumps({'shard': shard, 'fail': fail}) for shard, fail in enumerate(fails)]
+        return BeanstalkClient().call_group('tests.fetch_shard', args, callback='tests.merge_shards')
+
+    def work(self, fail=None):
+        """Run the next job like the worker does, returning its member"""
+        job = self.beanstalk.reserve(timeout=1)
+        job_name, body, enqueued_at, dedupe_key, member = job_tube(job)
+        if fail is not None:
+            data = json.loads(body)
+            data['fail'] = fail
+            body = json.dumps(data)
+        task = InFlightJob(job, job_name, body, dedupe_key, member)
+        succeeded = self.worker.call_job(task)
+        groups.flush()
+        self.worker.finish_job(job, job_name, succeeded, task.dedupe_key)
+        return member
+
+    def callbacks(self):
+        return [json.loads(body) for stats, (tube, body, enqueued_at, dedupe_key, member)
+                in take_jobs('tests.merge_shards')]
+
+    def test_callback_gets_the_results_in_order(self):
+        group_id = self.call_group([False, False, False])
+        for i in range(2):
+            self.work()
+        self.assertEqual(self.callbacks(), [])
+        self.work()
+        self.assertEqual(self.callbacks(), [{'group_id': group_id, 'results': [0, 1, 2]}])
+
+    def test_retry_takes_the_place_of_its_job(self):
+        group_id = self.call_group([True, False])
+        self.assertEqual(self.work(), (group_id, 0))
+        self.assertEqual(groups.get_results(group_id), [None, None])
+
+        # the retry comes first, with the backoff job's priority
+        self.assertEqual(self.work(fail=False), (group_id, 0))
+        self.assertEqual(groups.get_results(group_id), [0, None])
+        self.assertEqual(self.callbacks(), [])
+
+        self.assertEqual(self.work(), (group_id, 1))
+        self.assertEqual(self.callbacks(), [{'group_id': group_id, 'results': [0, 1]}])
+
+    def test_member_giving_up_is_buried(self):
+        group_id = self.call_group([True, False])
+        self.work()
+        # the retry fails too, the decorator gives up
+        self.work()
+        self.work()
+        self.assertEqual(self.callbacks(), [])
+        self.assertEqual(groups.get_results(group_id), [None, 1])
+        [(stats, (tube, body, enqueued_at, dedupe_key, member))] = take_jobs('tests.fetch_shard')
+        self.assertEqual(stats['state'], 'buried')
+        self.assertEqual(member, (group_id, 0))
+
+
+@override_settings(BEANSTALK_JOB_ENVELOPE=True)
+class CacheGroupTest(GroupTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(CacheGroupTest, self).setUp()
+        groups.set_backend(groups.CacheBackend())
+
+    def tearDown(self):
+        super(CacheGroupTest, self).tearDown()
+        groups.CacheBackend().cache.clear()
+
+    def test_needs_atomic_increments(self):
+        # the file based cache of the tests
+        self.assertRaises(ImproperlyConfigured, groups.CacheBackend, 'default')
+
+    def start(self, size):
+        group_id = 'test-group'
+        groups.start(group_id, size, 'tests.merge_shards')
+        return group_id
+
+    def test_counts_a_member_whose_worker_died_when_it_ran_again(self):
+        backend = groups.get_backend()
+        group_id = self.start(2)
+        # recorded, but the worker died before counting it
+        backend.cache.add(backend._key(group_id, 0), (0,), backend.ttl)
+        self.assertEqual(backend.complete([(group_id, 1, 1)]), [])
+        self.assertEqual(backend.complete([(group_id, 0, 0)]), [group_id])
+
+    def test_counts_a_member_whose_worker_died_before_the_last_one(self):
+        backend = groups.get_backend()
+        group_id = self.start(2)
+        backend.cache.add(backend._key(group_id, 0), (0,), backend.ttl)
+        self.assertEqual(backend.complete([(group_id, 0, 0)]), [])
+        self.assertEqual(backend.complete([(group_id, 1, 1)]), [group_id])
+        self.assertEqual(groups.get_results(group_id), [0, 1])
+
+
+@override_settings(BEANSTALK_JOB_ENVELOPE=True)
+class DatabaseGroupTest(GroupTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(DatabaseGroupTest, self).setUp()
+        groups.set_backend(groups.DatabaseBackend())
+
+    def test_forgotten_when_the_puts_fail(self):
+        dicts = [{'shard': shard} for shard in range(3)]
+        self.assertRaises(BeanstalkBatchError, FailingClient().call_group, 'tests.fetch_shard', dicts,
+                          callback='tests.merge_shards')
+        self.assertEqual(JobGroup.objects.count(), 0)
+        # the job put and the one lost with the connection may run
+        self.assertEqual([data.data_dict for data in JobData.objects.order_by('pk')], [dicts[0], dicts[2]])
+
+    def test_forgotten_when_the_deferred_puts_fail(self):
+        with transaction.atomic():
+            FailingClient().call_group('tests.fetch_shard', [{'shard': shard} for shard in range(3)],
+                                       callback='tests.merge_shards')
+            self.assertEqual(JobGroup.objects.count(), 1)
+        self.assertEqual(JobGroup.objects.count(), 0)
+
+
+class GroupConfigurationTest(SimpleTestCase):
+    def test_needs_the_envelope(self):
+        self.assertRaises(ImproperlyConfigured, BeanstalkClient().call_group, 'tests.fetch_shard', ['1'])
+        self.assertRaises(ImproperlyConfigured, DataBeanstalkClient().call_group, 'tests.fetch_shard', [{}])
@@ -0,0 +1,145 @@
+import StringIO
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from django_beanstalkd.connection import connect_beanstalkd
+from django_beanstalkd.envelope import wrap
+from django_beanstalkd.inspection import PeekScan, Scan, kick_buried, kick_jobs, reput_jobs
+
+from .utils import take_jobs
+
+
+class ReputTest(SimpleTestCase):
+    tube = 'tests.reput'
+    to_tube = 'tests.reput_to'
+
+    def setUp(self):
+        take_jobs(self.tube)
+        take_jobs(self.to_tube)
+        self.beanstalk = connect_beanstalkd()
+        self.beanstalk.use(self.tube)
+        self.beanstalk.watch(self.tube)
+        for arg in ('a', 'b', 'c'):
+            self.beanstalk.put(wrap(self.tube, arg))
+            self.beanstalk.reserve(timeout=0).bury()
+
+    def tearDown(self):
+        self.beanstalk.close()
+
+    def test_moves_the_jobs(self):
+        jobs = list(Scan(self.beanstalk, self.tube))
+        put, failed = reput_jobs(self.beanstalk, jobs, self.to_tube)
+        self.assertEqual((len(put), failed), (3, []))
+        self.assertEqual(take_jobs(self.tube), [])
+        moved = take_jobs(self.to_tube)
+        self.assertEqual([(stats['state'], unwrapped[:2]) for stats, unwrapped in moved],
+                         [('ready', (self.to_tube, arg)) for arg in ('a', 'b', 'c')])
+
+    def test_drops_the_copy_of_a_job_done_meanwhile(self):
+        jobs = list(Scan(self.beanstalk, self.tube))
+        # a worker reserves the kicked job and deletes it
+        self.beanstalk.kick_job(jobs[1].id)
+        worker = connect_beanstalkd()
+        worker.watch(self.tube)
+        worker.reserve(timeout=0).delete()
+        worker.close()
+
+        put, failed = reput_jobs(self.beanstalk, jobs, self.to_tube)
+        self.assertEqual([job.id for job in put], [jobs[0].id, jobs[2].id])
+        self.assertEqual([unwrapped[1] for stats, unwrapped in take_jobs(self.to_tube)], ['a', 'c'])
+
+
+class PeekScanTest(SimpleTestCase):
+    tube = 'tests.peek_scan'
+
+    def setUp(self):
+        take_jobs(self.tube)
+        self.beanstalk = connect_beanstalkd()
+        self.beanstalk.use(self.tube)
+        self.beanstalk.watch(self.tube)
+        for arg in ('a', 'b', 'c'):
+            self.beanstalk.put(wrap(self.tube, arg))
+            self.beanstalk.reserve(timeout=0).bury()
+        self.beanstalk.put(wrap(self.tube, 'delayed'), delay=60)
+
+    def tearDown(self):
+        self.beanstalk.close()
+
+    def test_reput(self):
+        scan = PeekScan(self.beanstalk, self.tube)
+        for job in scan:
+            self.assertEqual(reput_jobs(self.beanstalk, [job], self.tube), ([job], []))
+        self.assertEqual(scan.found, 3)
+        jobs = take_jobs(self.tube)
+        self.assertEqual([(stats['state'], unwrapped[1]) for stats, unwrapped in jobs],
+                         [('delayed', 'delayed'), ('ready', 'a'), ('ready', 'b'), ('ready', 'c')])
+
+    def test_jobs_buried_again_are_not_kicked_twice(self):
+        kicked = []
+        for job in PeekScan(self.beanstalk, self.tube):
+            kick_jobs(self.beanstalk, [job])
+            kicked.append(job.unwrapped())
+            # a worker fails at it again
+            self.beanstalk.reserve(timeout=0).bury()
+        self.assertEqual(kicked, ['a', 'b', 'c'])
+
+    def test_a_job_left_alone_ends_the_scan(self):
+        self.assertEqual([job.unwrapped() for job in PeekScan(self.beanstalk, self.tube)], ['a'])
+
+    def test_kick_buried(self):
+        self.assertEqual(kick_buried(self.beanstalk, self.tube, 2), 2)
+        self.assertEqual(kick_buried(self.beanstalk, self.tube, 2), 1)
+        # kick would take the delayed job now
+        self.assertEqual(kick_buried(self.beanstalk, self.tube, 2), 0)
+        self.assertEqual([stats['state'] for stats, unwrapped in take_jobs(self.tube)],
+                         ['ready', 'ready', 'ready', 'delayed'])
+
+
+class AdminCommandTest(SimpleTestCase):
+    tube = 'tests.admin'
+
+    def setUp(self):
+        take_jobs(self.tube)
+        self.beanstalk = connect_beanstalkd()
+        self.beanstalk.use(self.tube)
+        self.beanstalk.watch(self.tube)
+        for arg in ('a', 'b', 'c'):
+            self.beanstalk.put(wrap(self.tube, arg))
+            self.beanstalk.reserve(timeout=0).bury()
+        self.beanstalk.put(wrap(self.tube, 'delayed'), delay=60)
+        self.stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        self.beanstalk.close()
+
+    def states(self):
+        return [(stats['state'], unwrapped[1]) for stats, unwrapped in take_jobs(self.tube)]
+
+    def test_kick(self):
+        call_command('beanstalk_admin', tube=self.tube, kick=True, burst='2', limit='2')
+        self.assertEqual(self.states(), [('ready', 'a'), ('ready', 'b'), ('buried', 'c'), ('delayed', 'delayed')])
+
+    def test_kick_delayed(self):
+        call_command('beanstalk_admin', tube=self.tube, kick=True, state='delayed')
+        self.assertEqual(self.states(), [('buried', 'a'), ('buried', 'b'), ('buried', 'c'), ('ready', 'delayed')])
+
+    def test_kick_matching(self):
+        call_command('beanstalk_admin', tube=self.tube, kick=True, match='^[ac]$')
+        self.assertEqual(self.states(), [('ready', 'a'), ('buried', 'b'), ('ready', 'c'), ('delayed', 'delayed')])
+
+    def test_reput_and_export(self):
+        export = os.path.join(tempfile.mkdtemp(), 'jobs.jsonl')
+        try:
+            call_command('beanstalk_admin', tube=self.tube, reput=True, export=export)
+            with open(export) as lines:
+                self.assertEqual([json.loads(line)['body'] for line in lines], ['a', 'b', 'c'])
+        finally:
+            shutil.rmtree(os.path.dirname(export))
+        self.assertEqual(self.states(), [('delayed', 'delayed'), ('ready', 'a'), ('ready', 'b'), ('ready', 'c')])
@@ -0,0 +1,42 @@
+import socket
+
+from django.test import SimpleTestCase
+
+from django_beanstalkd.metrics import StatsdBackend
+
+
+class StatsdBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.backend = StatsdBackend('127.0.0.1', self.receiver.getsockname()[1], 'tests')
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def test_aggregates_until_flushed(self):
+        for _ in range(3):
+            self.backend.incr('jobs_reserved', 'tube')
+        self.backend.timing('job_duration', 'tube', 0.1)
+        self.backend.timing('job_duration', 'tube', 0.3)
+        self.backend.timing('queue_wait', 'tube', 0.5)
+        self.backend.flush()
+        self.assertEqual(self.receiver.recv(65536).split('\n'), [
+            'tests.tube.jobs_reserved:3|c',
+            'tests.tube.job_duration:200.000|ms|@0.5',
+            'tests.tube.queue_wait:500.000|ms',
+        ])
+
+    def test_splits_packets(self):
+        self.backend.max_packet_size = 60
+        self.backend.incr('jobs_reserved', 'first')
+        self.backend.incr('jobs_reserved', 'second')
+        self.backend.flush()
+        self.assertEqual(self.receiver.recv(65536), 'tests.first.jobs_reserved:1|c')
+        self.assertEqual(self.receiver.recv(65536), 'tests.second.jobs_reserved:1|c')
+
+    def test_nothing_to_flush(self):
+        self.backend.flush()
+        self.assertRaises(socket.timeout, self.receiver.recv, 65536)
@@ -0,0 +1,128 @@
+import datetime
+import time
+
+from django.test import SimpleTestCase
+
+from django_beanstalkd.periodic import Cron, Every, PeriodicJob, PeriodicScheduler
+from django_beanstalkd.retry import ManualClock
+
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class CronTest(SimpleTestCase):
+    def next_after(self, expression, *start):
+        return datetime.datetime.fromtimestamp(Cron(expression).next_after(timestamp(*start)))
+
+    def test_fields(self):
+        cron = Cron('*/15 9-17/4 1,15 jan-mar,dec sun,7')
+        self.assertEqual(cron.minutes, set([0, 15, 30, 45]))
+        self.assertEqual(cron.hours, set([9, 13, 17]))
+        self.assertEqual(cron.days, set([1, 15]))
+        self.assertEqual(cron.months, set([1, 2, 3, 12]))
+        self.assertEqual(cron.weekdays, set([0]))
+
+    def test_a_single_value_with_a_step_runs_to_the_end(self):
+        self.assertEqual(Cron('5/20 * * * *').minutes, set([5, 25, 45]))
+
+    def test_aliases(self):
+        self.assertEqual(self.next_after('@daily', 2026, 6, 1, 12, 0), datetime.datetime(2026, 6, 2, 0, 0))
+        self.assertEqual(self.next_after('@weekly', 2026, 6, 1, 12, 0), datetime.datetime(2026, 6, 7, 0, 0))
+
+    def test_invalid(self):
+        for expression in ('* * * *', '60 * * * *', '* 5-1 * * *', '* * 0 * *', '*/0 * * * *', '* * * foo *'):
+            self.assertRaises(ValueError, Cron, expression)
+        self.assertRaises(ValueError, Cron('0 0 31 2 *').next_after, timestamp(2026, 1, 1))
+
+    def test_next_after(self):
+        # Friday after the run: the next one is on Monday
+        self.assertEqual(self.next_after('30 4 * * mon-fri', 2026, 6, 5, 5, 0), datetime.datetime(2026, 6, 8, 4, 30))
+        # strictly after
+        self.assertEqual(self.next_after('30 4 * * *', 2026, 6, 5, 4, 30), datetime.datetime(2026, 6, 6, 4, 30))
+
+    def test_restricted_days_match_either_field(self):
+        self.assertEqual(self.next_after('0 0 1 * mon', 2026, 6, 1, 0, 0), datetime.datetime(2026, 6, 8, 0, 0))
+
+    def test_days_starting_with_a_star_are_unrestricted(self):
+        # like vixie cron: odd days that are Mondays, not odd days or Mondays
+        self.assertEqual(self.next_after('0 0 */2 * mon', 2026, 6, 1, 0, 0), datetime.datetime(2026, 6, 15, 0, 0))
+        self.assertEqual(self.next_after('0 0 13 * */3', 2026, 6, 1, 0, 0), datetime.datetime(2026, 6, 13, 0, 0))
+
+
+class EveryTest(SimpleTestCase):
+    def test_runs_are_aligned(self):
+        self.assertEqual(Every(60).next_after(6000), 6060)
+        self.assertEqual(Every(60).next_after(6001), 6060)
+        self.assertEqual(Every(datetime.timedelta(minutes=5)).next_after(6001), 6300)
+        self.assertRaises(ValueError, Every, 0)
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.calls = []
+
+    def call(self, func, arg='', priority=None, delay=0, ttr=None):
+        self.calls.append((func, delay))
+
+
+class LeaderTest(SimpleTestCase):
+    def setUp(self):
+        self.clock = ManualClock(6000.0)
+        self.client = RecordingClient()
+        self.jobs = {'tests.tick': PeriodicJob('tests.tick', Every(60))}
+        self.schedulers = []
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.close()
+
+    def scheduler(self):
+        # a lock tube per test, so no lock job is left over from another one
+        with self.settings(BEANSTALK_PERIODIC_LOCK_TUBE='tests.lock.%s' % self._testMethodName):
+            scheduler = PeriodicScheduler(self.jobs, client=self.client, lookahead=120, lease=30, clock=self.clock)
+        self.schedulers.append(scheduler)
+        return scheduler
+
+    def test_one_leader_at_a_time(self):
+        first, second = self.scheduler(), self.scheduler()
+        self.assertTrue(first.elect(timeout=0))
+        self.assertFalse(second.elect(timeout=0))
+        self.assertTrue(first.still_leading())
+
+    def test_puts_the_runs_within_the_lookahead(self):
+        leader = self.scheduler()
+        leader.elect(timeout=0)
+        leader.put_due()
+        self.assertEqual(self.client.calls, [('tests.tick', 60), ('tests.tick', 120)])
+        self.clock.advance(60)
+        leader.put_due()
+        self.assertEqual(self.client.calls[2:], [('tests.tick', 120)])
+
+    def test_hand_over(self):
+        first, second = self.scheduler(), self.scheduler()
+        first.elect(timeout=0)
+        first.put_due()
+        first.stop()
+        first.run()
+
+        self.clock.advance(60)
+        self.assertTrue(second.elect(timeout=1))
+        self.assertEqual(second.horizon, 6120)
+        second.put_due()
+        # the runs at 6060 and 6120 were put by the first leader
+        self.assertEqual(self.client.calls, [('tests.tick', 60), ('tests.tick', 120), ('tests.tick', 120)])
+
+    def test_successor_of_a_leader_that_died(self):
+        first, second = self.scheduler(), self.scheduler()
+        first.elect(timeout=0)
+        first.put_due()
+        # beanstalkd releases the lock job of a connection that went away
+        first.conn.close()
+        first.conn = None
+
+        self.assertTrue(second.elect(timeout=1))
+        # the runs within the lookahead may have been put, so they're skipped
+        self.assertEqual(second.horizon, 6120)
+        second.put_due()
+        self.assertEqual(self.client.calls, [('tests.tick', 60), ('tests.tick', 120)])
@@ -0,0 +1,82 @@
+import socket
+
+from django.test import SimpleTestCase
+from fake_beanstalkd import FakeBeanstalkdServer
+
+from django_beanstalkd import BeanstalkClient, BeanstalkError
+from django_beanstalkd.connection import connect_beanstalkd
+from django_beanstalkd.reserver import Reserver
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class MultiServerTest(SimpleTestCase):
+    tube = 'tests.reserver'
+
+    def setUp(self):
+        self.servers = [FakeBeanstalkdServer(), FakeBeanstalkdServer()]
+        for server in self.servers:
+            server.start()
+        self.addresses = [('127.0.0.1', server.port) for server in self.servers]
+        self.reserver = Reserver(self.addresses, [self.tube])
+
+    def tearDown(self):
+        self.reserver.close()
+        for server in self.servers:
+            server.shutdown()
+
+    def put(self, server, body):
+        return server.backend.put(self.tube, body)
+
+    def test_reserves_from_every_server(self):
+        self.put(self.servers[1], 'second')
+        job = self.reserver.reserve(timeout=1)
+        self.assertEqual((job.body, job.conn.server), ('second', self.addresses[1]))
+        job.delete()
+        self.put(self.servers[0], 'first')
+        job = self.reserver.reserve(timeout=1)
+        self.assertEqual((job.body, job.conn.server), ('first', self.addresses[0]))
+        job.delete()
+        self.assertEqual(self.reserver.reserve(timeout=0), None)
+
+    def test_skips_servers_that_are_down(self):
+        reserver = Reserver([('127.0.0.1', unused_port()), self.addresses[1]], [self.tube])
+        try:
+            self.put(self.servers[1], 'up')
+            self.assertEqual(reserver.reserve(timeout=1).body, 'up')
+        finally:
+            reserver.close()
+
+    def test_no_server_up(self):
+        reserver = Reserver([('127.0.0.1', unused_port())], [self.tube])
+        self.assertRaises(BeanstalkError, reserver.reserve, 0)
+
+    def test_give_back_hands_jobs_to_other_workers(self):
+        self.put(self.servers[0], 'first')
+        job = self.reserver.reserve()
+        self.assertEqual(job.body, 'first')
+        # a reserve is still pending on the second server
+        self.reserver.give_back()
+        self.put(self.servers[1], 'second')
+        other = connect_beanstalkd(*self.addresses[1])
+        try:
+            other.watch(self.tube)
+            self.assertEqual(other.reserve(timeout=1).body, 'second')
+        finally:
+            other.close()
+        # the job returned already is still ours
+        job.delete()
+        self.assertEqual(self.servers[0].backend.jobs, {})
+
+    def test_client_fails_over(self):
+        servers = ['127.0.0.1:%d' % unused_port(), '127.0.0.1:%d' % self.servers[1].port]
+        with self.settings(BEANSTALK_SERVERS=servers, BEANSTALK_ROUTER='round_robin'):
+            BeanstalkClient().call_many(self.tube, ['a', 'b'])
+            BeanstalkClient().call(self.tube, 'c')
+        self.assertEqual(sorted(job.body for job in self.servers[1].backend.jobs.values()), ['a', 'b', 'c'])
@@ -0,0 +1,212 @@
+import json
+import random
+
+from django.test import SimpleTestCase, TransactionTestCase
+
+from django_beanstalkd import BeanstalkRetryError, backoff_beanstalk_job, retry_data_beanstalk_job
+from django_beanstalkd.models import JobData
+from django_beanstalkd.retry import CircuitBreaker, ManualClock, RetryPolicy
+
+from .utils import take_bodies, take_jobs
+
+
+class PausingClient(object):
+    def __init__(self):
+        self.paused = []
+
+    def pause_tube(self, tube, delay):
+        self.paused.append((tube, delay))
+
+
+class RetryPolicyTest(SimpleTestCase):
+    def test_exponential_without_jitter_doubles_up_to_max_delay(self):
+        policy = RetryPolicy('exponential', base=1, max_delay=100, jitter=False)
+        self.assertEqual([policy.delay(attempt) for attempt in range(9)], [1, 2, 4, 8, 16, 32, 64, 100, 100])
+
+    def test_exponential_jitter_stays_within_bounds(self):
+        policy = RetryPolicy('exponential', base=2, max_delay=300, random=random.Random(1))
+        for attempt in range(20):
+            for i in range(50):
+                self.assertTrue(0 <= policy.delay(attempt) <= min(2 * 2 ** attempt, 300))
+
+    def test_exponential_jitter_spreads_delays(self):
+        policy = RetryPolicy('exponential', base=1, max_delay=600, random=random.Random(1))
+        self.assertTrue(len(set(policy.delay(8) for i in range(100))) > 50)
+
+    def test_decorrelated_stays_within_bounds(self):
+        policy = RetryPolicy('decorrelated', base=2, max_delay=60, random=random.Random(2))
+        previous = None
+        for attempt in range(200):
+            delay = policy.delay(attempt, previous)
+            self.assertTrue(2 <= delay <= min(max(previous or 2, 2) * 3, 60))
+            previous = delay
+
+    def test_huge_attempts_are_capped(self):
+        for strategy in RetryPolicy.STRATEGIES:
+            policy = RetryPolicy(strategy, base=1, max_delay=30, random=random.Random(3))
+            self.assertTrue(policy.delay(10 ** 6, 10 ** 9) <= 30)
+
+    def test_same_seed_same_delays(self):
+        for strategy in RetryPolicy.STRATEGIES:
+            delays = []
+            for i in range(2):
+                policy = RetryPolicy(strategy, base=1, max_delay=600, random=random.Random(42))
+                previous = None
+                run = []
+                for attempt in range(10):
+                    previous = policy.delay(attempt, previous)
+                    run.append(previous)
+                delays.append(run)
+            self.assertEqual(delays[0], delays[1])
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, RetryPolicy, 'linear')
+
+    def test_zero_is_not_the_default(self):
+        policy = RetryPolicy('exponential', base=0, max_delay=0, random=random.Random(4))
+        self.assertEqual(policy.delay(3), 0)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.clock = ManualClock(1000.0)
+        self.client = PausingClient()
+        self.breaker = CircuitBreaker(threshold=0.5, min_calls=4, window=60, pause=30, clock=self.clock,
+                                      client=self.client)
+
+    def test_trips_and_pauses_the_tube(self):
+        for succeeded in (True, False, True):
+            self.assertFalse(self.breaker.record('tests.sync', succeeded))
+        self.assertTrue(self.breaker.record('tests.sync', False))
+        self.assertEqual(self.client.paused, [('tests.sync', 30)])
+        self.assertTrue(self.breaker.is_open('tests.sync'))
+        self.assertFalse(self.breaker.is_open('tests.other'))
+
+    def test_zero_is_not_the_default(self):
+        breaker = CircuitBreaker(threshold=0, min_calls=0, window=0, pause=0, clock=self.clock, client=self.client)
+        self.assertEqual((breaker.threshold, breaker.min_calls, breaker.window, breaker.pause), (0, 0, 0, 0))
+
+    def test_needs_min_calls(self):
+        for i in range(3):
+            self.assertFalse(self.breaker.record('tests.sync', False))
+        self.assertEqual(self.client.paused, [])
+
+    def test_forgets_outcomes_older_than_the_window(self):
+        for i in range(3):
+            self.breaker.record('tests.sync', False)
+        self.clock.advance(61)
+        for succeeded in (True, True, True, False):
+            self.assertFalse(self.breaker.record('tests.sync', succeeded))
+        self.assertEqual(self.client.paused, [])
+
+    def test_recovers_after_the_pause(self):
+        for i in range(4):
+            self.breaker.record('tests.sync', False)
+        # jobs that were running when the tube was paused don't count
+        self.clock.advance(10)
+        self.assertFalse(self.breaker.record('tests.sync', False))
+        self.assertTrue(self.breaker.is_open('tests.sync'))
+
+        self.clock.advance(20)
+        self.assertFalse(self.breaker.is_open('tests.sync'))
+        # counting starts over
+        for succeeded in (False, False, True):
+            self.assertFalse(self.breaker.record('tests.sync', succeeded))
+        self.assertTrue(self.breaker.record('tests.sync', False))
+        self.assertEqual(self.client.paused, [('tests.sync', 30), ('tests.sync', 30)])
+
+
+backoff_policy = RetryPolicy(random=random.Random())
+backoff_breaker = CircuitBreaker(min_calls=1000, clock=ManualClock(), client=PausingClient())
+
+
+@backoff_beanstalk_job(max_retries=2, uses_db=False, retry_policy=backoff_policy, circuit_breaker=backoff_breaker)
+def sync_account(data):
+    if data['fail']:
+        raise BeanstalkRetryError('unavailable')
+
+
+data_policy = RetryPolicy('decorrelated', random=random.Random())
+data_breaker = CircuitBreaker(min_calls=1, clock=ManualClock(), client=PausingClient())
+
+
+@retry_data_beanstalk_job(max_retries=3, retry_policy=data_policy, circuit_breaker=data_breaker)
+def import_row(data):
+    pass
+
+
+class DelayAssertions(object):
+    def assertDelayed(self, stats, delay):
+        self.assertEqual(stats['state'], 'delayed' if delay else 'ready')
+        # the fake beanstalkd reports the whole seconds left
+        self.assertTrue(delay - 1 <= stats['delay'] <= delay)
+
+
+class BackoffJobTest(DelayAssertions, TransactionTestCase):
+    tube = 'tests.sync_account'
+
+    def setUp(self):
+        take_bodies(self.tube)
+        backoff_policy.random.seed(5)
+        backoff_breaker._outcomes.clear()
+
+    def failures(self):
+        return [succeeded for at, succeeded in backoff_breaker._outcomes[self.tube]]
+
+    def test_retries_with_the_policy_delay(self):
+        expected = RetryPolicy(random=random.Random(5))
+        sync_account(json.dumps({'fail': True}))
+
+        [(stats, unwrapped)] = take_jobs(self.tube)
+        body = unwrapped[1]
+        delay = expected.delay(0)
+        self.assertEqual(json.loads(body), {'fail': True, '__attempt': 1, '__delay': delay})
+        self.assertDelayed(stats, delay)
+        self.assertEqual(self.failures(), [False])
+
+        sync_account(body)
+        [body] = take_bodies(self.tube)
+        self.assertEqual(json.loads(body)['__attempt'], 2)
+        self.assertEqual(json.loads(body)['__delay'], expected.delay(1, delay))
+
+    def test_gives_up_after_max_retries(self):
+        sync_account(json.dumps({'fail': True, '__attempt': 2}))
+        self.assertEqual(take_bodies(self.tube), [])
+        self.assertEqual(self.failures(), [False])
+
+    def test_success_is_recorded(self):
+        sync_account(json.dumps({'fail': False}))
+        self.assertEqual(take_bodies(self.tube), [])
+        self.assertEqual(self.failures(), [True])
+
+
+class RetryDataJobTest(DelayAssertions, TransactionTestCase):
+    tube = 'tests.import_row'
+
+    def setUp(self):
+        take_bodies(self.tube)
+        data_policy.random.seed(6)
+        data_breaker._outcomes.clear()
+
+    def test_missing_data_is_retried_but_not_a_failure(self):
+        expected = RetryPolicy('decorrelated', random=random.Random(6))
+        import_row(json.dumps({'jobdata_pk': 12345}))
+
+        [(stats, unwrapped)] = take_jobs(self.tube)
+        body = unwrapped[1]
+        delay = expected.delay(1, None)
+        self.assertEqual(json.loads(body), {'jobdata_pk': 12345, 'attempt': 2, 'delay': delay})
+        self.assertDelayed(stats, delay)
+        self.assertEqual(len(data_breaker._outcomes[self.tube]), 0)
+        self.assertFalse(data_breaker.is_open(self.tube))
+
+        import_row(body)
+        [body] = take_bodies(self.tube)
+        self.assertEqual(json.loads(body), {'jobdata_pk': 12345, 'attempt': 3, 'delay': expected.delay(2, delay)})
+
+    def test_success_is_recorded(self):
+        data = JobData(job_name=self.tube)
+        data.data_dict = {'row': 1}
+        data.save()
+        import_row(json.dumps({'jobdata_pk': data.pk}))
+        self.assertEqual([succeeded for at, succeeded in data_breaker._outcomes[self.tube]], [True])
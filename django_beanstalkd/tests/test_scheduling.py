@@ -0,0 +1,120 @@
+from django.test import SimpleTestCase
+
+from django_beanstalkd.connection import connect_beanstalkd, get_servers
+from django_beanstalkd.reserver import Reserver
+from django_beanstalkd.scheduling import SHARED, SlotCounts, TubeScheduler, get_options, select_tubes
+
+from .utils import take_bodies
+
+
+def run(scheduler, ready, picks):
+    """The slots the scheduler picks while all slots in ready have jobs"""
+    picked = []
+    for i in range(picks):
+        for slot in scheduler.candidates(ready):
+            if scheduler.acquire(slot):
+                picked.append(slot)
+                break
+    return picked
+
+
+class TubeSchedulerTest(SimpleTestCase):
+    def test_slots(self):
+        scheduler = TubeScheduler(['a', 'b', 'c', 'd'], weights={'b': 2}, limits={'c': 1, 'x': 1})
+        self.assertEqual(scheduler.slots, [('b', ['b']), ('c', ['c']), (SHARED, ['a', 'd'])])
+        self.assertEqual(scheduler.limits, {'c': 1})
+        self.assertTrue(scheduler.enabled)
+        self.assertFalse(TubeScheduler(['a', 'b']).enabled)
+
+    def test_weights_must_be_positive(self):
+        self.assertRaises(ValueError, TubeScheduler, ['a'], weights={'a': 0})
+
+    def test_runs_slots_in_proportion_to_their_weights(self):
+        scheduler = TubeScheduler(['heavy', 'light'], weights={'heavy': 10})
+        picked = run(scheduler, ['heavy', SHARED], 22)
+        self.assertEqual((picked.count('heavy'), picked.count(SHARED)), (20, 2))
+
+    def test_idle_slots_dont_catch_up(self):
+        scheduler = TubeScheduler(['a', 'b'], weights={'a': 2, 'b': 2})
+        run(scheduler, ['a'], 10)
+        # b had no work, so it doesn't get the next five jobs in a row
+        self.assertEqual(run(scheduler, ['a', 'b'], 4), ['b', 'a', 'b', 'a'])
+
+    def test_limited_slots(self):
+        scheduler = TubeScheduler(['limited', 'other'], limits={'limited': 2})
+        self.assertEqual(run(scheduler, ['limited'], 3), ['limited', 'limited'])
+        self.assertFalse(scheduler.can_reserve('limited'))
+        self.assertTrue(scheduler.can_reserve(SHARED))
+
+        class Job(object):
+            slot = 'limited'
+        scheduler.done(Job())
+        self.assertTrue(scheduler.can_reserve('limited'))
+
+
+class SlotCountsTest(SimpleTestCase):
+    def test_limit_holds_across_workers(self):
+        counts = SlotCounts(['a', 'b'], workers=2)
+        self.assertTrue(counts.acquire('a', 2))
+        counts.row = 1
+        self.assertTrue(counts.acquire('a', 2))
+        self.assertFalse(counts.acquire('a', 2))
+        self.assertTrue(counts.acquire('b', 2))
+        self.assertEqual((counts.running('a'), counts.running('b')), (2, 1))
+
+        counts.release('a')
+        self.assertEqual(counts.running('a'), 1)
+        # the worker of row 0 exited
+        counts.clear(0)
+        self.assertEqual((counts.running('a'), counts.running('b')), (0, 1))
+
+
+class OptionsTest(SimpleTestCase):
+    def test_settings_take_precedence(self):
+        class Job(object):
+            weight = 5
+            concurrency = 3
+        jobs = {'a': Job(), 'b': object()}
+        with self.settings(BEANSTALK_TUBE_WEIGHTS={'b': 2}, BEANSTALK_TUBE_CONCURRENCY={'a': 0}):
+            self.assertEqual(get_options(jobs), ({'a': 5, 'b': 2}, {}))
+
+    def test_select_tubes(self):
+        tubes = ['app.index', 'app.mail', 'other.index']
+        self.assertEqual(select_tubes(tubes, include='app.*'), ['app.index', 'app.mail'])
+        self.assertEqual(select_tubes(tubes, exclude='*.index, app.mail'), [])
+        self.assertEqual(select_tubes(tubes, include='*.index', exclude='other.*'), ['app.index'])
+
+
+class ScheduledReserverTest(SimpleTestCase):
+    tubes = ['tests.heavy', 'tests.light']
+
+    def setUp(self):
+        for tube in self.tubes:
+            take_bodies(tube)
+
+    def tearDown(self):
+        for tube in self.tubes:
+            take_bodies(tube)
+
+    def test_reserves_by_weight(self):
+        beanstalk = connect_beanstalkd()
+        try:
+            for tube in self.tubes:
+                beanstalk.use(tube)
+                for i in range(8):
+                    beanstalk.put(tube)
+        finally:
+            beanstalk.close()
+
+        scheduler = TubeScheduler(self.tubes, weights={'tests.heavy': 3})
+        reserver = Reserver(get_servers(), self.tubes, scheduler=scheduler)
+        try:
+            bodies = []
+            for i in range(8):
+                job = reserver.reserve(timeout=1)
+                bodies.append(job.body)
+                job.delete()
+                scheduler.done(job)
+        finally:
+            reserver.close()
+        self.assertEqual((bodies.count('tests.heavy'), bodies.count('tests.light')), (6, 2))
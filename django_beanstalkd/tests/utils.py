@@ -0,0 +1,91 @@
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from ..connection import connect_beanstalkd
+from ..envelope import unwrap
+
+
+def take_jobs(tube):
+    """
+    Deletes the ready, delayed and buried jobs of tube, returning their
+    (stats, unwrapped envelope) in the order of their ids
+    """
+    beanstalk = connect_beanstalkd()
+    try:
+        beanstalk.use(tube)
+        jobs = []
+        for peek in (beanstalk.peek_ready, beanstalk.peek_delayed, beanstalk.peek_buried):
+            while True:
+                job = peek()
+                if job is None:
+                    break
+                jobs.append((job.jid, job.stats(), unwrap(job.body)))
+                job.delete()
+        return [(stats, unwrapped) for jid, stats, unwrapped in sorted(jobs)]
+    finally:
+        beanstalk.close()
+
+
+def take_bodies(tube):
+    """Like take_jobs, returning only the bodies"""
+    return [unwrapped[1] for stats, unwrapped in take_jobs(tube)]
+
+
+class AtomicCache(BaseCache):
+    """
+    A cache with atomic add and incr like memcached's, for the tests. It's
+    shared by the threads of the process only, so it pretends to be shared
+    by the clients and workers.
+    """
+    _entries = {}  # key -> (value, expiry)
+    _lock = threading.Lock()
+
+    def __init__(self, location, params):
+        super(AtomicCache, self).__init__(params)
+
+    def _expiry(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else time.time() + timeout
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return None
+        return entry
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._entries[key] = (value, self._expiry(timeout))
+            return True
+
+    def get(self, key, default=None, version=None):
+        with self._lock:
+            entry = self._get(self.make_key(key, version))
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._lock:
+            self._entries[self.make_key(key, version)] = (value, self._expiry(timeout))
+
+    def delete(self, key, version=None):
+        with self._lock:
+            self._entries.pop(self.make_key(key, version), None)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version)
+        with self._lock:
+            entry = self._get(key)
+            if entry is None:
+                raise ValueError("Key '%s' not found" % key)
+            self._entries[key] = (entry[0] + delta, entry[1])
+            return entry[0] + delta
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Runs the tests against SQLite and the fake beanstalkd of the benchmarks,
+started in this process:
+
+    python runtests.py [django_beanstalkd.tests.test_client ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from django.conf import settings
+from fake_beanstalkd import FakeBeanstalkdServer
+
+
+def main(labels):
+    server = FakeBeanstalkdServer()
+    server.start()
+    temp_dir = tempfile.mkdtemp(prefix='beanstalk-tests-')
+    settings.configure(
+        SECRET_KEY='tests',
+        INSTALLED_APPS=['django_beanstalkd'],
+        # a file, so the threads of the executors share the test database
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:',
+                               'TEST_NAME': os.path.join(temp_dir, 'tests.sqlite3')}},
+        # shared by the processes of a deployment, unlike the local memory cache
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                            'LOCATION': os.path.join(temp_dir, 'cache')},
+                # job groups need atomic increments
+                'groups': {'BACKEND': 'django_beanstalkd.tests.utils.AtomicCache'}},
+        BEANSTALK_SERVER='127.0.0.1:%d' % server.port,
+        BEANSTALK_GROUP_CACHE='groups',
+    )
+    from django.test.runner import DiscoverRunner
+    try:
+        return DiscoverRunner(verbosity=1).run_tests(labels or ['django_beanstalkd'])
+    finally:
+        server.shutdown()
+        shutil.rmtree(temp_dir, True)
+
+
+if __name__ == '__main__':
+    sys.exit(bool(main(sys.argv[1:])))
@@ -15,6 +15,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['pyyaml', 'beanstalkc'],
+    extras_require={
+        'async': ['trollius'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',